@@ -1,40 +1,63 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 from uuid import uuid4
 from typing import List, Union
 
 import os
 import json
-import requests
+import asyncio
+import httpx
 import re
+import sys
+import hashlib
+import time
+
+# faiss, numpy and scipy (utils.embed_store, utils.corpus_index) are imported
+# by the handlers that need them, and by the background warm-up, so a
+# recycled worker accepts requests without waiting for them
+from utils.admission import AdmissionLimiter, Overloaded
+from utils.history_store import HistoryStore
+from utils.index_cache import INDEX_GENERATION_PATH, INDEX_MODE, INDEX_WATCH_INTERVAL, GenerationWatcher
+from utils.jobs import (
+    get_job, ingest_admission, prune_jobs, record_skipped_job, save_job_suggestions, shutdown_executor,
+    submit_ingest_job, update_corpus_index,
+)
+from utils.llm_client import LLM_MODEL, LLMError, chat_completion, close_client, stream_chat_completion
+from utils.metrics import (
+    METRICS_DIR, Gauge, MetricsMiddleware, registry, span, start_snapshots, track_cache, track_module_cache
+)
+from utils.prompt_builder import (
+    PROMPT_HISTORY_TOKENS, HistorySummaries, format_context, input_budget, log_prompt, select_chunks
+)
+from utils.response_cache import RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_KEY_CHUNKS, ResponseCache
+from utils.suggestions import SUGGESTIONS_LLM_FALLBACK, SUGGESTIONS_SOURCE, rank_suggestions
+from utils.tokens import estimate_tokens
+from utils.warmup import HotSet, Warmup
 
-from utils.embed_store import embed_and_store, query_vector_store
-from utils.extract_text import extract_text
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 load_dotenv()
 
-# stores chat history as json 
+# stores chat history as append-only jsonl, with the recent tail kept in memory
 HISTORY_DIR = "history_logs"
-os.makedirs(HISTORY_DIR, exist_ok=True)
+history_store = HistoryStore(HISTORY_DIR)
+# older messages reach the prompt as a rolling summary (see utils/prompt_builder.py)
+history_summaries = HistorySummaries(history_store)
 
-def get_history_file(user_id):
-    return os.path.join(HISTORY_DIR, f"{user_id}.json")
-
-def load_history(user_id):
-    filepath = get_history_file(user_id)
-    if os.path.exists(filepath):
-        with open(filepath, "r") as f:
-            return json.load(f)
-    return []
+def load_history(user_id, limit=None):
+    if limit is not None:
+        return history_store.tail(user_id, limit)
+    return history_store.load(user_id)
 
 def save_to_history(user_id, role, message):
-    filepath = get_history_file(user_id)
-    history = load_history(user_id)
-    history.append({"role": role, "message": message})
-    with open(filepath, "w") as f:
-        json.dump(history, f, indent=2)
+    history_store.append(user_id, [(role, message)])
 
 def analyze_query_completeness(query, chat_history, context_length=0):
     """
@@ -69,9 +92,52 @@ def analyze_query_completeness(query, chat_history, context_length=0):
 
     return word_count > 12
 
+def parse_suggestions(raw, limit=4):
+    suggestions = []
+    for line in raw.strip().split('\n'):
+        clean = re.sub(r'^\d+\.?\s*', '', line.strip())
+        clean = clean.strip('."\'')
+        if 1 < len(clean.split()) <= 3:
+            suggestions.append(clean)
+    return suggestions[:limit]
+
+async def generate_suggestions(prompt, max_tokens, timeout=15):
+    try:
+        with span("suggestions"):
+            raw = await chat_completion(
+                [{"role": "user", "content": prompt}],
+                max_tokens=max_tokens,
+                temperature=0.7,
+                timeout=timeout
+            )
+        return parse_suggestions(raw)
+    except (LLMError, Overloaded, httpx.HTTPError, KeyError, ValueError) as e:
+        print(f">> Error generating suggestions: {e}")
+        return []
+
+def local_suggestions(query, file_names, results=()):
+    """
+    Suggestions ranked from the phrases stored with the documents when they
+    were indexed (see utils/suggestions.py); no llm call.
+    """
+    from utils.embed_store import document_suggestions
+
+    candidates = []
+    for name in file_names:
+        candidates.extend(document_suggestions(name) or [])
+    return rank_suggestions(query, candidates, results)
+
 class QueryRequest(BaseModel):
     query: str
     file_name: str = None
+    nprobe: int = Field(None, gt=0)
+    ef_search: int = Field(None, gt=0)
+
+class QueryBatchRequest(BaseModel):
+    queries: List[str]
+    file_name: Union[List[str], str, None] = None
+    nprobe: int = Field(None, gt=0)
+    ef_search: int = Field(None, gt=0)
 
 app = FastAPI()
 
@@ -81,17 +147,132 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # lets browser clients read the id to quote in bug reports
+    expose_headers=["X-Request-ID"],
 )
+# request ids, stage timings and the slow request log; see utils/metrics.py
+app.add_middleware(MetricsMiddleware)
+
+@app.exception_handler(Overloaded)
+async def overloaded_response(request: Request, exc: Overloaded):
+    # shed load early rather than let requests time out in a queue
+    return JSONResponse(
+        status_code=503,
+        content={"error": "Server busy", "detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+# documents queried recently are preloaded by the next worker to start
+hot_set = HotSet()
+warmup = Warmup(hot_set, corpus=INDEX_MODE != "document")
+
+@app.on_event("startup")
+async def prune_history():
+    await run_in_threadpool(history_store.prune_expired)
+
+@app.on_event("startup")
+async def prune_job_records():
+    await run_in_threadpool(prune_jobs)
+
+@app.on_event("startup")
+async def start_warmup():
+    warmup.start()
+
+def refresh_indexes():
+    # the retrieval modules are imported by the first query; before that nothing is cached
+    embed_store = sys.modules.get("utils.embed_store")
+    if embed_store is not None:
+        for name in embed_store.refresh_documents():
+            response_cache.invalidate_document(name)
+    corpus_index = sys.modules.get("utils.corpus_index")
+    if corpus_index is not None:
+        corpus_index.refresh_corpus_index()
+
+# every worker maps the same artifacts read-only; a re-index anywhere (another
+# worker, an ingest process) bumps the generation file and each worker refreshes
+index_watcher = GenerationWatcher(INDEX_GENERATION_PATH, refresh_indexes, INDEX_WATCH_INTERVAL)
+
+@app.on_event("startup")
+async def start_index_watcher():
+    index_watcher.start()
+
+@app.on_event("shutdown")
+async def shutdown_llm_client():
+    await close_client()
+    shutdown_executor()
+    index_watcher.stop()
+    hot_set.flush()
 
 UPLOAD_DIR = os.getenv("UPLOAD_DIR", "documents")
 PROMPT_DIR = os.getenv("PROMPT_DIR", "prompts")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(PROMPT_DIR, exist_ok=True)
 
-def process_and_store(file_path, file_name):
-    text = extract_text(file_path)
-    embed_and_store(text, file_name)
-    
+CORPUS_TOP_K = int(os.getenv("CORPUS_TOP_K", "6"))
+
+# searches run at once on the threadpool, and how many more may wait (up to
+# RETRIEVAL_QUEUE_TIMEOUT seconds) before requests get a 503
+RETRIEVAL_MAX_CONCURRENCY = int(os.getenv("RETRIEVAL_MAX_CONCURRENCY", str(os.cpu_count() or 4)))
+RETRIEVAL_QUEUE_SIZE = int(os.getenv("RETRIEVAL_QUEUE_SIZE", "64"))
+RETRIEVAL_QUEUE_TIMEOUT = float(os.getenv("RETRIEVAL_QUEUE_TIMEOUT", "5"))
+retrieval_admission = AdmissionLimiter(
+    "retrieval", RETRIEVAL_MAX_CONCURRENCY, RETRIEVAL_QUEUE_SIZE, RETRIEVAL_QUEUE_TIMEOUT
+)
+
+# /query-batch: queries per request, and answers generated at once per batch so
+# a bulk job leaves the rest of LLM_MAX_CONCURRENCY to interactive queries
+QUERY_BATCH_MAX_QUERIES = int(os.getenv("QUERY_BATCH_MAX_QUERIES", "1000"))
+QUERY_BATCH_CONCURRENCY = int(os.getenv("QUERY_BATCH_CONCURRENCY", "4"))
+
+# uploads are spooled to disk in blocks instead of being read into memory at once
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+
+# answers to repeated queries against unchanged documents skip both llm calls
+response_cache = ResponseCache()
+
+track_cache("response", response_cache)
+track_module_cache("document", "utils.embed_store", "document_cache")
+PROCESS_RSS_BYTES = registry.register(Gauge(
+    "process_resident_memory_bytes", "Resident memory of this worker, mapped index pages included.",
+))
+
+def _write_block(f, digest, block):
+    digest.update(block)
+    f.write(block)
+
+async def save_upload(file, file_path):
+    """
+    Writes the upload to file_path and returns the sha256 of its bytes,
+    hashing and writing each block on the threadpool.
+    """
+    digest = hashlib.sha256()
+    f = await run_in_threadpool(open, file_path, "wb")
+    try:
+        while True:
+            block = await file.read(UPLOAD_CHUNK_SIZE)
+            if not block:
+                break
+            await run_in_threadpool(_write_block, f, digest, block)
+    finally:
+        await run_in_threadpool(f.close)
+    return digest.hexdigest()
+
+def reuse_indexed_upload(file_name, source_hash):
+    """
+    Returns why the upload needs no processing (the same bytes are already
+    indexed under this name, or under another name and are copied over),
+    or None.
+    """
+    from utils.embed_store import copy_document, document_source_hash, find_document_by_source_hash
+
+    if document_source_hash(file_name) == source_hash:
+        return "unchanged"
+    indexed_as = find_document_by_source_hash(source_hash)
+    if indexed_as is not None:
+        copy_document(indexed_as, file_name)
+        return f"duplicate of {indexed_as}"
+    return None
+
 @app.get("/")
 def read_root():
     return {"message": "Backend is running"}
@@ -102,28 +283,54 @@ async def chat(request: Request):
     user_id = data.get("user_id") or str(uuid4())
     query = data["query"]
 
-    save_to_history(user_id, "user", query)
-    chat_history = load_history(user_id)
-    response = f"I received: '{query}' and have {len(chat_history)} messages in history."
-    save_to_history(user_id, "bot", response)
+    await run_in_threadpool(save_to_history, user_id, "user", query)
+    message_count = await run_in_threadpool(history_store.count, user_id)
+    response = f"I received: '{query}' and have {message_count} messages in history."
+    await run_in_threadpool(save_to_history, user_id, "bot", response)
 
     return {"response": response, "user_id": user_id}
 
+# the event loop only keeps weak references to tasks; these outlive their request
+background_tasks = set()
+
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(file: UploadFile = File(...), wait: bool = Form(False)):
     file_path = os.path.join(UPLOAD_DIR, file.filename)
-    with open(file_path, "wb") as f:
-        f.write(await file.read())
-
-    process_and_store(file_path, file.filename)
-    print(f"Parsed filename list: {file.filename}")
+    # turned away before the upload is saved; the slot is held until the ingest job ends
+    ingest_admission.try_acquire()
+    # how long uploads hold a slot sets the Retry-After of the ones turned away
+    started = time.monotonic()
+    future = None
+    try:
+        source_hash = await save_upload(file, file_path)
+
+        skipped = await run_in_threadpool(reuse_indexed_upload, file.filename, source_hash)
+        if skipped:
+            suggestions = await run_in_threadpool(local_suggestions, "", [file.filename])
+            job_id = record_skipped_job(file.filename, skipped, suggested_questions=suggestions)
+            print(f"Skipped processing {file.filename}: {skipped} (job {job_id})")
+            if skipped != "unchanged":
+                # the copy joins the corpus index as an ingest job's document would
+                corpus_task = asyncio.ensure_future(run_in_threadpool(update_corpus_index))
+                background_tasks.add(corpus_task)
+                corpus_task.add_done_callback(background_tasks.discard)
+        else:
+            # answers for the old version would otherwise survive until their ttl
+            await run_in_threadpool(response_cache.invalidate_document, file.filename)
+            # extraction and indexing run on the ingestion process pool
+            job_id, future = submit_ingest_job(file_path, file.filename, source_hash)
+            print(f"Parsed filename list: {file.filename} (job {job_id})")
+    finally:
+        if future is None:
+            ingest_admission.release(time.monotonic() - started)
+        else:
+            future.add_done_callback(lambda _: ingest_admission.release(time.monotonic() - started))
 
     custom_prompt = f"You are an expert assistant for queries related to the document titled '{file.filename}'. Answer with clear and concise explanations based only on the given context."
     with open(os.path.join(PROMPT_DIR, f"{file.filename}.json"), "w") as f:
         json.dump({"system_prompt": custom_prompt}, f)
 
     # 👉 New: Generate initial suggested questions
-    api_key = os.getenv("OPENROUTER_API_KEY")
     suggestion_prompt = (
         f"The user has just uploaded a file titled '{file.filename}'.\n"
         "Generate 3-4 short suggested questions (2–3 words) that could help explore the document.\n"
@@ -131,125 +338,135 @@ async def upload_file(file: UploadFile = File(...)):
         "Respond with a numbered list."
     )
 
-    suggestions = []
-    try:
-        suggestion_response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "model": "mistralai/mistral-7b-instruct",
-                "messages": [{"role": "user", "content": suggestion_prompt}],
-                "max_tokens": 80,
-                "temperature": 0.7
-            },
-            timeout=15
-        )
+    async def store_suggestions():
+        suggestions = await generate_suggestions(suggestion_prompt, max_tokens=80)
+        save_job_suggestions(job_id, suggestions)
+        return suggestions
 
-        if suggestion_response.status_code == 200:
-            raw = suggestion_response.json()["choices"][0]["message"]["content"]
-            for line in raw.strip().split('\n'):
-                clean = re.sub(r'^\d+\.?\s*', '', line.strip())
-                clean = clean.strip('."\'')
-                if 1 < len(clean.split()) <= 3:
-                    suggestions.append(clean)
-            suggestions = suggestions[:4]
+    # otherwise the ingest job records suggestions from the document itself
+    suggestion_task = None
+    if SUGGESTIONS_SOURCE == "llm":
+        suggestion_task = asyncio.ensure_future(store_suggestions())
+        background_tasks.add(suggestion_task)
+        suggestion_task.add_done_callback(background_tasks.discard)
+
+    if not wait:
+        return {
+            "message": f"{file.filename} uploaded, " + ("already indexed." if skipped else "processing started."),
+            "filename": file.filename,
+            "job_id": job_id,
+            "status_url": f"/jobs/{job_id}",
+            "suggested_questions": []
+        }
+
+    try:
+        job = await asyncio.wrap_future(future) if future is not None else get_job(job_id)
     except Exception as e:
-        print(f">> Error generating upload suggestions: {e}")
+        job = {"status": "failed", "error": str(e)}
+    suggestions = await suggestion_task if suggestion_task is not None else job.get("suggested_questions")
+    if job["status"] != "done":
+        raise HTTPException(status_code=500, detail=f"Processing failed: {job.get('error')}")
+    if not suggestions and suggestion_task is None and SUGGESTIONS_LLM_FALLBACK:
+        suggestions = await store_suggestions()
 
     return {
         "message": f"{file.filename} uploaded, processed, and prompt saved.",
         "filename": file.filename,
+        "job_id": job_id,
         "suggested_questions": suggestions
     }
 
 
-@app.post("/query")
-async def query_document(
-    query: str = Form(...),
-    file_name: Union[List[str], str, None] = Form(None),
-    user_id: str = Form(None)
-):
-    if not query or not query.strip():
-        raise HTTPException(status_code=400, detail="Query cannot be empty")
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
-    print(f">> Received query: '{query}' for files: '{file_name}'")
 
-    if isinstance(file_name, str):
-        file_name = [file_name]
-    elif file_name is None:
-        file_name = []
+def use_corpus_index(file_count):
+    if INDEX_MODE == "corpus":
+        return file_count > 0
+    if INDEX_MODE == "auto":
+        return file_count > 1
+    return False
 
-    context_parts = []
-    high_quality_match = False
-
-    for fname in file_name:
-        try:
-            result = query_vector_store(query, fname)
-            if isinstance(result, dict):
-                ctx = result.get("text", "")
-                score = result.get("score", 0.0)
-            else:
-                ctx = str(result)
-                score = 0.0
-
-            if len(ctx) > 100 and score >= 0.6:
-                high_quality_match = True
-
-            context_parts.append(f"Document context for {fname}:\n{ctx}")
-        except Exception as e:
-            print(f">> Error querying vector store for {fname}: {e}")
-
-    if context_parts:
-        document_list = ", ".join(file_name)
-        context = f"The following document(s) are relevant: {document_list}.\n\n" + "\n\n".join(context_parts)
-    else:
-        context = "No specific document context available."
-
-    print(">>> Final context sent to LLM:\n", context)
-
-    prompt_file = file_name[0] if file_name else None
-    prompt_path = os.path.join(PROMPT_DIR, f"{prompt_file}.json") if prompt_file else None
-
-    chat_history = load_history(user_id) if user_id else []
-
-    conversation_context = ""
-    if chat_history:
-        recent_messages = chat_history[-6:]
-        for message in recent_messages:
-            role = "User" if message['role'] == 'user' else "Assistant"
-            conversation_context += f"{role}: {message['message']}\n"
+async def retrieve_context(query, file_names, nprobe=None, ef_search=None):
+    """
+    Retrieved chunks of file_names for query, best first; plan_query picks
+    the ones that make the prompt. nprobe / ef_search override ANN_NPROBE /
+    ANN_EF_SEARCH for approximate indexes (see utils.ann_index).
+    """
+    return (await retrieve_context_batch([query], file_names, nprobe, ef_search))[0]
 
-    has_enough_info = analyze_query_completeness(query, chat_history, context_length=len(context))
-    if high_quality_match:
-        has_enough_info = True
+async def retrieve_context_batch(queries, file_names, nprobe=None, ef_search=None):
+    """
+    retrieve_context for each of queries, searching each document (or the
+    corpus index) once for all of them.
+    """
+    from utils.corpus_index import query_corpus_batch
+    from utils.embed_store import query_vector_store_batch
+
+    hot_set.touch(file_names)
+    # a request waits here (or is turned away) rather than in the threadpool queue
+    async with retrieval_admission.slot():
+        batch = None
+        if use_corpus_index(len(file_names)):
+            # one globally ranked search over all the requested documents
+            try:
+                with span("retrieval"):
+                    batch = await run_in_threadpool(
+                        query_corpus_batch, queries, file_names, CORPUS_TOP_K, nprobe, ef_search
+                    )
+            except Exception as e:
+                print(f">> Error querying corpus index for {file_names}: {e}")
+        if batch is None:
+            # not (yet) covered by the corpus index: each document is searched on its own
+            batch = [[] for _ in queries]
+            for fname in file_names:
+                try:
+                    with span("retrieval"):
+                        found = await run_in_threadpool(
+                            query_vector_store_batch, queries, fname, nprobe=nprobe, ef_search=ef_search
+                        )
+                    for results, result in zip(batch, found):
+                        results.extend(result["chunks"])
+                except Exception as e:
+                    print(f">> Error querying vector store for {fname}: {e}")
+
+    for results in batch:
+        results.sort(key=lambda r: r["score"], reverse=True)
+    return batch
+
+def normalize_file_names(file_name):
+    if isinstance(file_name, str):
+        return [file_name]
+    if file_name is None:
+        return []
+    return file_name
+
+DEFAULT_SYSTEM_PROMPT = (
+    "If user tells hi or asks what you can do tell them You are {file_name}, and analyze the file and behave as if you are that file"
+    "Your approach: First understand the file completely, then behave like the file and reply from the file info."
+)
 
-    if prompt_path and os.path.exists(prompt_path):
-        with open(prompt_path, "r") as f:
-            base_system_prompt = json.load(f)["system_prompt"]
-    else:
-        base_system_prompt = (
-            "If user tells hi or asks what you can do tell them You are {file_name}, and analyze the file and behave as if you are that file"
-            "Your approach: First understand the file completely, then behave like the file and reply from the file info."
-        )
+SOLUTION_INSTRUCTIONS = (
+    "Respond in a conversational, helpful tone. Give practical solutions based on pdf if possible or else use your knowledge without formal structure. "
+    "Be friendly, direct, and focus on actually helping them solve their issue. "
+    "Start with a brief acknowledgment, then provide clear steps or explanations. "
+    "Avoid formal headings like 'Problem Summary' or 'Root Cause Analysis' - just have a natural conversation. "
+    "IMPORTANT: When including code examples, always format them properly using markdown code blocks with triple backticks (```) and specify the language when appropriate (```html, ```css, ```javascript, etc.)."
+)
 
-    try:
-        api_key = os.getenv("OPENROUTER_API_KEY")
-        if not api_key:
-            return {"error": "Missing API key."}
+CLARIFICATION_INSTRUCTIONS = (
+    "The user's query lacks sufficient detail for you to provide an effective solution. Tell them not to get angry because of follow up questions, they can help you solve problem better"
+    "Ask ONE specific, targeted follow-up question to gather the most critical missing information and also ask if its related or not. "
+    "Do not provide solutions yet - focus only on understanding the problem better. "
+    "Make your question clear and actionable."
+)
 
-        if has_enough_info:
-            system_prompt = (
-                f"{base_system_prompt}\n\n"
-                "Respond in a conversational, helpful tone. Give practical solutions based on pdf if possible or else use your knowledge without formal structure. "
-                "Be friendly, direct, and focus on actually helping them solve their issue. "
-                "Start with a brief acknowledgment, then provide clear steps or explanations. "
-                "Avoid formal headings like 'Problem Summary' or 'Root Cause Analysis' - just have a natural conversation. "
-                "IMPORTANT: When including code examples, always format them properly using markdown code blocks with triple backticks (```) and specify the language when appropriate (```html, ```css, ```javascript, etc.)."
-            )
-            user_prompt = f"""
+SOLUTION_USER_PROMPT = """
 Conversation history:
 {conversation_context}
 
@@ -260,15 +477,8 @@ Document context: {context}
 Please help the user with their question. Be conversational and be the document itself.
 IMPORTANT: Don't use mention document name in each and every response unless user asks something related to it.If the user asks something out of document answer by yourself.
 """
-        else:
-            system_prompt = (
-                f"{base_system_prompt}\n\n"
-                "The user's query lacks sufficient detail for you to provide an effective solution. Tell them not to get angry because of follow up questions, they can help you solve problem better"
-                "Ask ONE specific, targeted follow-up question to gather the most critical missing information and also ask if its related or not. "
-                "Do not provide solutions yet - focus only on understanding the problem better. "
-                "Make your question clear and actionable."
-            )
-            user_prompt = f"""
+
+CLARIFICATION_USER_PROMPT = """
 Conversation history:
 {conversation_context}
 
@@ -278,112 +488,409 @@ This query needs more detail. Ask ONE focused follow-up question to understand t
 Consider what specific information would be most helpful: error details, context, timing, impact, or steps already tried.
 """
 
-        payload = {
-            "model": "mistralai/mistral-7b-instruct",
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            "max_tokens": 400 if has_enough_info else 100,
-            "temperature": 0.6
-        }
+SOLUTION_MAX_TOKENS = 400
+CLARIFICATION_MAX_TOKENS = 100
 
-        response_main = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            },
-            json=payload,
-            timeout=30
+def load_system_prompt(file_names):
+    prompt_file = file_names[0] if file_names else None
+    prompt_path = os.path.join(PROMPT_DIR, f"{prompt_file}.json") if prompt_file else None
+    if prompt_path and os.path.exists(prompt_path):
+        with open(prompt_path, "r") as f:
+            return json.load(f)["system_prompt"]
+    return DEFAULT_SYSTEM_PROMPT
+
+async def plan_query(query, file_name, user_id, results=None, nprobe=None, ef_search=None):
+    """
+    Retrieval, history and prompts shared by /query and /query-stream.
+    The prompt stays within the model's input budget: the fixed text and
+    query first, then history (a rolling summary plus recent messages),
+    then the best non-overlapping chunks in what is left. results are the
+    query's chunks when already retrieved (see retrieve_context_batch).
+    """
+    from utils.embed_store import RETRIEVAL_TOKEN_BUDGET
+
+    if results is None:
+        results = await retrieve_context(query, file_name, nprobe, ef_search)
+    base_system_prompt = load_system_prompt(file_name)
+
+    # sized for the answer mode, which carries the context and the longer reply
+    budget = input_budget(LLM_MODEL, SOLUTION_MAX_TOKENS) - estimate_tokens(
+        base_system_prompt + SOLUTION_INSTRUCTIONS + SOLUTION_USER_PROMPT + query
+    )
+    with span("history"):
+        conversation_context, chat_history = await run_in_threadpool(
+            history_summaries.render, user_id, max(0, min(PROMPT_HISTORY_TOKENS, budget // 3))
         )
+    budget -= estimate_tokens(conversation_context)
+    with span("prompt"):
+        chunks = select_chunks(results, max(0, min(budget, RETRIEVAL_TOKEN_BUDGET)))
+        context, high_quality_match, sources = format_context(chunks, file_name)
 
-        ai_reply = ""
-        if response_main.status_code == 200:
-            data = response_main.json()
-            ai_reply = data["choices"][0]["message"]["content"].strip()
+    with span("completeness"):
+        has_enough_info = analyze_query_completeness(query, chat_history, context_length=len(context))
+    if high_quality_match:
+        has_enough_info = True
 
-            if user_id:
-                save_to_history(user_id, "user", query)
-                save_to_history(user_id, "bot", ai_reply)
-        else:
-            return {"error": "Main AI request failed", "body": response_main.text}
-
-        suggestion_prompt = (
-            f"Based on this query: \"{query}\"\n\n" 
-            "Generate 4 short follow-up questions (2–3 words each) that a user might ask next to understand or explore the topic further.\n"
-            "If the user query strongly suggests a need for a specific tool (e.g., analytics tool, testing tool, automation framework), include one such tool-related suggestion. "
-            "But do this **only** if it is clearly beneficial and not speculative.\n"
-            "Examples of good suggestions: 'Try JMeter', 'Use Postman', 'Analyze with Excel'.\n"
-            "Examples to avoid: vague or forced tool mentions.\n\n"
-            "Respond as a simple numbered list only."
+    analysis_mode = "solution" if has_enough_info else "clarification"
+    cache_key = None
+    if RESPONSE_CACHE_ENABLED:
+        chunk_ids = [[source["file_name"], source["chunk_id"]] for source in sources]
+        cache_key = response_cache.make_key(
+            query, file_name, analysis_mode, chunk_ids if RESPONSE_CACHE_KEY_CHUNKS else None,
+            conversation=conversation_context,
         )
 
+    if has_enough_info:
+        system_prompt = f"{base_system_prompt}\n\n{SOLUTION_INSTRUCTIONS}"
+        user_prompt = SOLUTION_USER_PROMPT.format(
+            conversation_context=conversation_context, query=query, context=context
+        )
+    else:
+        system_prompt = f"{base_system_prompt}\n\n{CLARIFICATION_INSTRUCTIONS}"
+        user_prompt = CLARIFICATION_USER_PROMPT.format(
+            conversation_context=conversation_context, query=query
+        )
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+    log_prompt(messages, context, chunks, conversation_context)
+
+    suggestions = None
+    if SUGGESTIONS_SOURCE == "local":
+        with span("suggestions"):
+            suggestions = await run_in_threadpool(local_suggestions, query, file_name, results)
+
+    suggestion_prompt = (
+        f"Based on this query: \"{query}\"\n\n" 
+        "Generate 4 short follow-up questions (2–3 words each) that a user might ask next to understand or explore the topic further.\n"
+        "If the user query strongly suggests a need for a specific tool (e.g., analytics tool, testing tool, automation framework), include one such tool-related suggestion. "
+        "But do this **only** if it is clearly beneficial and not speculative.\n"
+        "Examples of good suggestions: 'Try JMeter', 'Use Postman', 'Analyze with Excel'.\n"
+        "Examples to avoid: vague or forced tool mentions.\n\n"
+        "Respond as a simple numbered list only."
+    )
+
+    return {
+        "sources": sources,
+        "has_enough_info": has_enough_info,
+        "analysis_mode": analysis_mode,
+        "messages": messages,
+        "max_tokens": SOLUTION_MAX_TOKENS if has_enough_info else CLARIFICATION_MAX_TOKENS,
+        "suggestions": suggestions,
+        "suggestion_prompt": suggestion_prompt,
+        "cache_key": cache_key,
+    }
 
-        suggestion_response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "model": "mistralai/mistral-7b-instruct",
-                "messages": [
-                    {"role": "user", "content": suggestion_prompt}
-                ],
-                "max_tokens": 60,
-                "temperature": 0.7
-            },
-            timeout=15
+def build_response(ai_reply, suggestions, has_enough_info):
+    return {
+        "result": ai_reply,
+        "needs_more_info": not has_enough_info,
+        "follow_up_question": ai_reply if not has_enough_info else None,
+        "suggested_questions": suggestions if suggestions else [],
+        "analysis_mode": "solution" if has_enough_info else "clarification",
+        "suggestions_note": "You can ask any of these next:"
+    }
+
+async def cached_response(plan, query, user_id):
+    if plan["cache_key"] is None:
+        return None
+    with span("cache_lookup"):
+        cached = response_cache.get(plan["cache_key"])
+    if cached is not None:
+        print(">> Response cache hit")
+        if user_id:
+            await run_in_threadpool(history_store.append, user_id, [("user", query), ("bot", cached["result"])])
+    return cached
+
+async def answer(plan):
+    with span("llm"):
+        return await chat_completion(
+            plan["messages"],
+            max_tokens=plan["max_tokens"],
+            temperature=0.6,
+            timeout=30
         )
 
-        suggestions = []
-        if suggestion_response.status_code == 200:
-            raw = suggestion_response.json()["choices"][0]["message"]["content"]
-            lines = raw.strip().split('\n')
-            for line in lines:
-                clean_line = re.sub(r'^\d+\.?\s*', '', line.strip())
-                clean_line = clean_line.strip('."\'')
-                word_count = len(clean_line.split())
-                if 1 < word_count <= 3:
-                    suggestions.append(clean_line)
-            suggestions = suggestions[:4]
+async def follow_up_suggestions(plan):
+    # the llm is asked when configured to, or when the documents have no stored phrases
+    if plan["suggestions"] or (plan["suggestions"] is not None and not SUGGESTIONS_LLM_FALLBACK):
+        return plan["suggestions"]
+    return await generate_suggestions(plan["suggestion_prompt"], max_tokens=60)
 
-        return {
-            "result": ai_reply,
-            "needs_more_info": not has_enough_info,
-            "follow_up_question": ai_reply if not has_enough_info else None,
-            "suggested_questions": suggestions if suggestions else [],
-            "analysis_mode": "solution" if has_enough_info else "clarification",
-            "suggestions_note": "You can ask any of these next:"
-        }
+async def generate_response(query, file_name, user_id, plan):
+    """
+    The /query response from the llm, recorded in the history and the
+    response cache; raises LLMError and httpx.HTTPError.
+    """
+    # llm suggestions only depend on the query, so they run alongside the main answer
+    ai_reply, suggestions = await asyncio.gather(answer(plan), follow_up_suggestions(plan))
+    ai_reply = ai_reply.strip()
 
+    if user_id:
+        await run_in_threadpool(history_store.append, user_id, [("user", query), ("bot", ai_reply)])
 
+    response = build_response(ai_reply, suggestions, plan["has_enough_info"])
+    if plan["cache_key"] is not None:
+        await run_in_threadpool(response_cache.put, plan["cache_key"], response, file_name)
+    return response
 
-    except requests.RequestException as e:
+@app.post("/query")
+async def query_document(
+    query: str = Form(...),
+    file_name: Union[List[str], str, None] = Form(None),
+    user_id: str = Form(None),
+    nprobe: int = Form(None, gt=0),
+    ef_search: int = Form(None, gt=0)
+):
+    if not query or not query.strip():
+        raise HTTPException(status_code=400, detail="Query cannot be empty")
+
+    print(f">> Received query: '{query}' for files: '{file_name}'")
+
+    file_name = normalize_file_names(file_name)
+    plan = await plan_query(query, file_name, user_id, nprobe=nprobe, ef_search=ef_search)
+
+    cached = await cached_response(plan, query, user_id)
+    if cached is not None:
+        return cached
+
+    try:
+        api_key = os.getenv("OPENROUTER_API_KEY")
+        if not api_key:
+            return {"error": "Missing API key."}
+
+        try:
+            return await generate_response(query, file_name, user_id, plan)
+        except LLMError as e:
+            return {"error": "Main AI request failed", "body": e.body}
+
+    except httpx.HTTPError as e:
         print(f">> Network error during AI call: {e}")
         return {"error": "Network error", "details": str(e)}
+    except Overloaded:
+        raise
     except Exception as e:
         print(f">> Exception during AI call: {e}")
         raise HTTPException(status_code=500, detail=f"AI service error: {str(e)}")
 
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def stream_query_events(query, file_name, user_id, plan, cached):
+    """
+    Server-sent events for /query-stream: "context" (retrieval metadata),
+    "token" for each piece of the answer, then "suggestions" last.
+    Failures end the stream with an "error" event.
+    """
+    yield sse_event("context", {
+        "sources": plan["sources"],
+        "analysis_mode": plan["analysis_mode"],
+        "needs_more_info": not plan["has_enough_info"],
+        "cached": cached is not None,
+    })
+    if cached is not None:
+        yield sse_event("token", {"text": cached["result"]})
+        yield sse_event("suggestions", {
+            "suggested_questions": cached["suggested_questions"],
+            "suggestions_note": cached["suggestions_note"],
+        })
+        return
+
+    suggestion_task = asyncio.ensure_future(follow_up_suggestions(plan))
+    try:
+        parts = []
+        try:
+            with span("llm"):
+                async for text in stream_chat_completion(
+                    plan["messages"],
+                    max_tokens=plan["max_tokens"],
+                    temperature=0.6,
+                    timeout=30
+                ):
+                    parts.append(text)
+                    yield sse_event("token", {"text": text})
+        except LLMError as e:
+            yield sse_event("error", {"error": "Main AI request failed", "body": e.body})
+            return
+        except httpx.HTTPError as e:
+            print(f">> Network error during AI stream: {e}")
+            yield sse_event("error", {"error": "Network error", "details": str(e)})
+            return
+        except Overloaded as e:
+            # the response has started; the client gets the 503 as an event
+            yield sse_event("error", {"error": "Server busy", "detail": str(e), "retry_after": e.retry_after})
+            return
+
+        ai_reply = "".join(parts).strip()
+        suggestions = await suggestion_task
+        if user_id:
+            await run_in_threadpool(history_store.append, user_id, [("user", query), ("bot", ai_reply)])
+
+        response = build_response(ai_reply, suggestions, plan["has_enough_info"])
+        if plan["cache_key"] is not None:
+            await run_in_threadpool(response_cache.put, plan["cache_key"], response, file_name)
+        yield sse_event("suggestions", {
+            "suggested_questions": response["suggested_questions"],
+            "suggestions_note": response["suggestions_note"],
+        })
+    finally:
+        # the client went away or the answer failed
+        if not suggestion_task.done():
+            suggestion_task.cancel()
+
+@app.post("/query-stream")
+async def query_document_stream(
+    query: str = Form(...),
+    file_name: Union[List[str], str, None] = Form(None),
+    user_id: str = Form(None),
+    nprobe: int = Form(None, gt=0),
+    ef_search: int = Form(None, gt=0)
+):
+    if not query or not query.strip():
+        raise HTTPException(status_code=400, detail="Query cannot be empty")
+
+    print(f">> Received streaming query: '{query}' for files: '{file_name}'")
+
+    file_name = normalize_file_names(file_name)
+    plan = await plan_query(query, file_name, user_id, nprobe=nprobe, ef_search=ef_search)
+
+    cached = await cached_response(plan, query, user_id)
+    if cached is None and not os.getenv("OPENROUTER_API_KEY"):
+        return {"error": "Missing API key."}
+
+    return StreamingResponse(
+        stream_query_events(query, file_name, user_id, plan, cached),
+        media_type="text/event-stream",
+        # no proxy buffering, or the first token waits for the whole answer
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def answer_batch(queries, file_name, concurrency=QUERY_BATCH_CONCURRENCY,
+                       nprobe=None, ef_search=None):
+    """
+    Yields (position, response) for each of queries as its answer is ready.
+    All of them are retrieved up front (see retrieve_context_batch), then
+    answered like /query, at most concurrency at a time. Batches have no
+    user, so they neither read nor write chat history. A failed answer is
+    yielded as an {"error"} response and the batch goes on.
+    """
+    batch = await retrieve_context_batch(queries, file_name, nprobe, ef_search)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(position):
+        async with semaphore:
+            query = queries[position]
+            try:
+                plan = await plan_query(query, file_name, None, results=batch[position])
+                cached = await cached_response(plan, query, None)
+                if cached is not None:
+                    return position, cached
+                return position, await generate_response(query, file_name, None, plan)
+            except LLMError as e:
+                return position, {"error": "Main AI request failed", "body": e.body}
+            except httpx.HTTPError as e:
+                print(f">> Network error during batch AI call: {e}")
+                return position, {"error": "Network error", "details": str(e)}
+            except Overloaded as e:
+                return position, {"error": "Server busy", "detail": str(e), "retry_after": e.retry_after}
+            except Exception as e:
+                # e.g. a 200 from the upstream carrying an error body; one query must not end the batch
+                print(f">> Error answering batch query {position}: {e!r}")
+                return position, {"error": "AI service error", "details": str(e)}
+
+    tasks = [asyncio.ensure_future(run(position)) for position in range(len(queries))]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        # the client went away; stop spending llm calls on it
+        for task in tasks:
+            task.cancel()
+
+async def stream_batch_events(queries, file_name, nprobe=None, ef_search=None):
+    """
+    Server-sent events for /query-batch: a "result" per query in the
+    order they finish, carrying its position in the batch, then "done",
+    or "error" if the batch could not be retrieved.
+    """
+    try:
+        async for position, response in answer_batch(queries, file_name, nprobe=nprobe, ef_search=ef_search):
+            yield sse_event("result", {"index": position, "query": queries[position], **response})
+    except Overloaded as e:
+        yield sse_event("error", {"error": "Server busy", "detail": str(e), "retry_after": e.retry_after})
+        return
+    yield sse_event("done", {"count": len(queries)})
+
+@app.post("/query-batch")
+async def query_document_batch(request: QueryBatchRequest):
+    if not request.queries or any(not query.strip() for query in request.queries):
+        raise HTTPException(status_code=400, detail="Queries cannot be empty")
+    if len(request.queries) > QUERY_BATCH_MAX_QUERIES:
+        raise HTTPException(
+            status_code=400, detail=f"At most {QUERY_BATCH_MAX_QUERIES} queries per batch"
+        )
+    if not os.getenv("OPENROUTER_API_KEY"):
+        return {"error": "Missing API key."}
+
+    file_name = normalize_file_names(request.file_name)
+    print(f">> Received batch of {len(request.queries)} queries for files: '{file_name}'")
+
+    return StreamingResponse(
+        stream_batch_events(request.queries, file_name, request.nprobe, request.ef_search),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/query-json")
 async def query_document_json(request: QueryRequest):
-    return await query_document(request.query, request.file_name)
+    return await query_document(
+        request.query, request.file_name, None, nprobe=request.nprobe, ef_search=request.ef_search
+    )
+
+_process = None
+
+def current_process():
+    # created per worker: a preloading master forks the app into other pids
+    global _process
+    if _process is None or _process.pid != os.getpid():
+        _process = psutil.Process(os.getpid())
+    return _process
 
 @app.get("/health")
 async def health_check():
-    try:
-        import psutil
-        process = psutil.Process(os.getpid())
-        memory_mb = process.memory_info().rss / 1024 / 1024
-        return {
-            "status": "healthy",
-            "memory_mb": round(memory_mb, 2),
-            "version": "optimized"
-        }
-    except ImportError:
+    if psutil is None:
         return {"status": "healthy", "version": "optimized"}
+    memory_mb = current_process().memory_info().rss / 1024 / 1024
+    return {
+        "status": "healthy",
+        "memory_mb": round(memory_mb, 2),
+        "version": "optimized"
+    }
+
+def record_memory():
+    if psutil is not None:
+        PROCESS_RSS_BYTES.set(current_process().memory_info().rss)
+
+registry.collectors.append(record_memory)
+
+@app.on_event("startup")
+async def start_metrics_snapshots():
+    if METRICS_DIR:
+        start_snapshots()
+
+@app.get("/metrics")
+async def metrics():
+    # Prometheus text format; with METRICS_DIR set, every worker's series
+    # labelled by pid, whichever worker serves the scrape
+    body = registry.render_workers(METRICS_DIR) if METRICS_DIR else registry.render()
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/ready")
+async def readiness_check():
+    # 503 until the warm-up has loaded the hot documents, so a load balancer
+    # can hold traffic back from a freshly started worker
+    return JSONResponse(status_code=200 if warmup.ready else 503, content=warmup.state())
 
 if __name__ == "__main__":
     import uvicorn
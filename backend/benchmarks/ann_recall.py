@@ -0,0 +1,165 @@
+"""
+Recall vs latency of the approximate index tiers against the exact flat index.
+
+    cd backend
+    python -m benchmarks.ann_recall --chunks 200000
+    python -m benchmarks.ann_recall --types ivf --nprobe 1 8 32 --json ivf.json
+
+Every tier is built over the same synthetic TF-IDF vectors (see
+benchmarks/synthetic.py) and searched one query at a time, as /query does.
+recall@k is the share of the flat index's top k each setting returns (rows
+tied with the k-th best count); pick
+ANN_NPROBE / ANN_EF_SEARCH (and the tier thresholds) from the table.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from benchmarks.synthetic import generate_topic_texts, generate_topics
+
+
+def search_all(index, queries, k, params=None):
+    """
+    (ids per query, per-query seconds)
+    """
+    ids, samples = [], []
+    for query in queries:
+        start = time.perf_counter()
+        _, rows = index.search(query[None, :], k, params=params)
+        samples.append(time.perf_counter() - start)
+        ids.append(rows[0])
+    return np.array(ids), samples
+
+
+def recall_at_k(found, vectors, queries, kth_scores):
+    """
+    Share of returned rows scoring at least the exact k-th best score, so
+    rows tied with the flat index's k-th result count as found.
+    """
+    hits = [
+        np.sum(vectors[row[row >= 0]] @ query >= kth - 1e-6) / len(row)
+        for row, query, kth in zip(found, queries, kth_scores)
+    ]
+    return float(np.mean(hits))
+
+
+def report_row(tier, setting, recall, samples, build_seconds, nbytes):
+    ms = np.array(samples) * 1000
+    return {
+        "tier": tier,
+        "setting": setting,
+        "recall": recall,
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "qps": len(samples) / sum(samples),
+        "build_s": build_seconds,
+        "mb": nbytes / (1024 * 1024),
+    }
+
+
+def format_row(row):
+    return (
+        f"{row['tier']:<7} {row['setting']:<14} {row['recall']:>8.3f} {row['p50_ms']:>9.3f}"
+        f" {row['p95_ms']:>9.3f} {row['qps']:>10.0f} {row['build_s']:>9.2f} {row['mb']:>9.1f}"
+    )
+
+
+def print_header(k):
+    print(
+        f"{'tier':<7} {'setting':<14} {f'recall@{k}':>8} {'p50 ms':>9}"
+        f" {'p95 ms':>9} {'qps':>10} {'build s':>9} {'MB':>9}"
+    )
+
+
+def build_vectors(args):
+    from utils.embed_store import SimpleVectorizer, normalized
+
+    topics = generate_topics(args.topics, args.vocabulary, seed=args.seed)
+    texts = generate_topic_texts(topics, args.chunks, seed=args.seed)
+    queries = generate_topic_texts(topics, args.queries, words_per_text=args.query_words, seed=args.seed + 1)
+    vectorizer = SimpleVectorizer(max_features=args.dims)
+    vectors = normalized(np.ascontiguousarray(vectorizer.fit_transform(texts), dtype=np.float32))
+    query_vectors = normalized(np.ascontiguousarray(vectorizer.transform(queries), dtype=np.float32))
+    # queries sharing no term with the vocabulary have no neighbors to recall
+    return vectors, query_vectors[np.abs(query_vectors).sum(axis=1) > 0]
+
+
+def run(args):
+    import faiss
+    from utils.ann_index import build_index, search_params, tier_of
+
+    vectors, queries = build_vectors(args)
+    print(f"{len(vectors)} chunks x {vectors.shape[1]} dims, {len(queries)} queries", flush=True)
+    print_header(args.k)
+
+    rows = []
+
+    def timed_build(tier):
+        start = time.perf_counter()
+        index = build_index(vectors, tier)
+        return index, time.perf_counter() - start, len(faiss.serialize_index(index))
+
+    flat, seconds, nbytes = timed_build("flat")
+    truth, samples = search_all(flat, queries, args.k)
+    kth_scores = [float(vectors[row[-1]] @ query) for row, query in zip(truth, queries)]
+    rows.append(report_row("flat", "exact", 1.0, samples, seconds, nbytes))
+    print(format_row(rows[-1]), flush=True)
+
+    settings = {"hnsw": ("ef_search", args.ef_search), "ivf": ("nprobe", args.nprobe), "ivfpq": ("nprobe", args.nprobe)}
+    for tier in args.types:
+        index, seconds, nbytes = timed_build(tier)
+        # rows are labelled with the tier built, which is smaller when there
+        # are too few chunks to train the one asked for
+        built = tier_of(index)
+        if built != tier:
+            print(f"warning: too few chunks to train {tier}, measured {built} instead", file=sys.stderr, flush=True)
+        if built == "flat":
+            found, samples = search_all(index, queries, args.k)
+            rows.append(report_row(built, "exact", 1.0, samples, seconds, nbytes))
+            print(format_row(rows[-1]), flush=True)
+            continue
+        name, values = settings[built]
+        for value in values:
+            params = search_params(index, **{name: value})
+            found, samples = search_all(index, queries, args.k, params)
+            recall = recall_at_k(found, vectors, queries, kth_scores)
+            rows.append(report_row(built, f"{name}={value}", recall, samples, seconds, nbytes))
+            print(format_row(rows[-1]), flush=True)
+    return rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="ANN index recall vs latency")
+    parser.add_argument("--chunks", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--dims", type=int, default=300, help="vectorizer max_features")
+    parser.add_argument("--vocabulary", type=int, default=5000)
+    parser.add_argument("--topics", type=int, default=200)
+    parser.add_argument("--query-words", type=int, default=12)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--types", nargs="+", default=["hnsw", "ivf", "ivfpq"], choices=["hnsw", "ivf", "ivfpq"])
+    parser.add_argument("--nprobe", nargs="+", type=int, default=[1, 4, 16, 64])
+    parser.add_argument("--ef-search", nargs="+", type=int, default=[16, 32, 64, 128, 256])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rows = run(args)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": rows}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
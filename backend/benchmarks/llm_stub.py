@@ -0,0 +1,80 @@
+"""
+OpenAI-style chat completions stub so benchmarks run offline:
+
+    python -m benchmarks.llm_stub --port 8999 --latency 0.05
+    OPENROUTER_URL=http://127.0.0.1:8999/v1/chat/completions uvicorn app:app
+"""
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWER = (
+    "Start by collecting the measurements for each batch, then plot them on the "
+    "control chart and investigate any point outside the limits."
+)
+SUGGESTIONS = "1. Control limits\n2. Sample size\n3. Pareto chart\n4. Root cause"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        time.sleep(self.latency)
+        prompt = payload.get("messages", [{}])[-1].get("content", "")
+        content = SUGGESTIONS if "numbered list" in prompt else ANSWER
+        if payload.get("stream"):
+            self._stream(content)
+            return
+        body = json.dumps({"choices": [{"message": {"role": "assistant", "content": content}}]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, content):
+        # one server-sent event per word, as a streaming upstream would send them
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for word in content.split(" "):
+            delta = {"choices": [{"delta": {"content": word + " "}}]}
+            self.wfile.write(f"data: {json.dumps(delta)}\n\n".encode())
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(port=0, latency=0.0):
+    """
+    Serves the stub on a daemon thread; returns (server, url).
+    """
+    handler = type("Handler", (StubHandler,), {"latency": latency})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local LLM stub server")
+    parser.add_argument("--port", type=int, default=8999)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per completion")
+    args = parser.parse_args()
+    server, url = start_stub_server(args.port, args.latency)
+    print(f"LLM stub listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
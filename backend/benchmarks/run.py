@@ -0,0 +1,285 @@
+"""
+Ingestion and retrieval benchmarks over synthetic documents.
+
+    cd backend
+    python -m benchmarks.run --pages 10 100 --formats pdf docx txt
+    python -m benchmarks.run --json results.json
+    python -m benchmarks.run --baseline results.json    # exits 1 on a regression
+
+Every stage reports throughput, p50/p95/p99 latency per operation and the
+process peak RSS after the stage. The LLM is a local stub, so /query runs
+offline and its latency is the app's own plus --llm-latency.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from benchmarks.llm_stub import start_stub_server
+from benchmarks.synthetic import generate_pages, generate_queries, write_document
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class Recorder:
+    def __init__(self):
+        self.results = []
+
+    def record(self, stage, samples, count, unit):
+        """
+        samples are per-operation seconds; count is the number of units
+        (pages, chunks, queries) processed across them.
+        """
+        total = sum(samples)
+        ms = np.array(samples) * 1000
+        result = {
+            "stage": stage,
+            "ops": len(samples),
+            "count": count,
+            "unit": unit,
+            "seconds": total,
+            "throughput": count / total if total else 0.0,
+            "p50_ms": float(np.percentile(ms, 50)),
+            "p95_ms": float(np.percentile(ms, 95)),
+            "p99_ms": float(np.percentile(ms, 99)),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        self.results.append(result)
+        print(format_result(result), flush=True)
+        return result
+
+
+def format_result(result):
+    rss = f"{result['peak_rss_mb']:.0f}" if result["peak_rss_mb"] is not None else "-"
+    return (
+        f"{result['stage']:<28} {result['ops']:>6} {result['throughput']:>12.1f} {result['unit'] + '/s':<10}"
+        f" {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f} {rss:>8}"
+    )
+
+
+def print_header():
+    print(
+        f"{'stage':<28} {'ops':>6} {'throughput':>12} {'':<10}"
+        f" {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'rss MB':>8}"
+    )
+
+
+def timed_iter(iterable):
+    """
+    Yields (item, seconds spent producing it).
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        yield item, time.perf_counter() - start
+
+
+def timed_call(fn, *args, **kwargs):
+    start = time.perf_counter()
+    value = fn(*args, **kwargs)
+    return value, time.perf_counter() - start
+
+
+def bench_document(recorder, fmt, num_pages, queries, args):
+    import faiss
+    from utils.extract_text import iter_text_pages
+    from utils.embed_store import (
+        EMBED_BATCH_SIZE, SimpleVectorizer, StreamingChunker, document_cache,
+        load_document, normalized, query_vector_store, query_vector_store_batch, search_vector_store,
+    )
+    from utils.processor import process_and_store
+
+    label = f"{fmt}/{num_pages}p"
+    file_name = f"bench_{num_pages}.{fmt}"
+    path = os.path.join("documents", file_name)
+    write_document(path, fmt, generate_pages(num_pages, args.words_per_page, seed=args.seed))
+
+    pages, samples = [], []
+    for page, seconds in timed_iter(iter_text_pages(path)):
+        pages.append(page)
+        samples.append(seconds)
+    recorder.record(f"{label} extract", samples, len(pages), "pages")
+
+    chunker = StreamingChunker()
+    chunks, samples = [], []
+    for page in pages:
+        new_chunks, seconds = timed_call(chunker.feed, page)
+        chunks.extend(new_chunks)
+        samples.append(seconds)
+    new_chunks, seconds = timed_call(chunker.finish)
+    chunks.extend(new_chunks)
+    samples[-1] += seconds
+    chunks = [chunk for chunk in chunks if chunk.strip()]
+    recorder.record(f"{label} chunk", samples, len(chunks), "chunks")
+
+    vectorizer = SimpleVectorizer(max_features=300)
+    _, seconds = timed_call(vectorizer.fit_transform, chunks)
+    recorder.record(f"{label} fit_transform", [seconds], len(chunks), "chunks")
+
+    batches, samples = [], []
+    for start in range(0, len(chunks), EMBED_BATCH_SIZE):
+        vectors, seconds = timed_call(vectorizer.transform, chunks[start:start + EMBED_BATCH_SIZE])
+        batches.append(normalized(vectors))
+        samples.append(seconds)
+    recorder.record(f"{label} transform", samples, len(chunks), "chunks")
+
+    index = faiss.IndexFlatIP(len(vectorizer.vocabulary))
+    _, seconds = timed_call(index.add, np.vstack(batches))
+    recorder.record(f"{label} faiss build", [seconds], len(chunks), "chunks")
+
+    samples = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(normalized(vectorizer.transform([query])), 3)
+        samples.append(time.perf_counter() - start)
+    recorder.record(f"{label} faiss search", samples, len(queries), "queries")
+
+    _, seconds = timed_call(process_and_store, path, file_name)
+    recorder.record(f"{label} ingest", [seconds], len(pages), "pages")
+
+    document_cache.invalidate(file_name)
+    _, seconds = timed_call(load_document, file_name)
+    recorder.record(f"{label} index load", [seconds], 1, "loads")
+
+    samples = [timed_call(query_vector_store, query, file_name)[1] for query in queries]
+    recorder.record(f"{label} retrieval", samples, len(queries), "queries")
+
+    for mode in ("bm25", "hybrid"):
+        samples = [timed_call(search_vector_store, query, file_name, mode=mode)[1] for query in queries]
+        recorder.record(f"{label} {mode} retrieval", samples, len(queries), "queries")
+
+    # one transform and one faiss search for every query
+    _, seconds = timed_call(query_vector_store_batch, queries, file_name)
+    recorder.record(f"{label} batch retrieval", [seconds], len(queries), "queries")
+    return file_name
+
+
+def bench_query_endpoint(recorder, file_names, queries):
+    from fastapi.testclient import TestClient
+    import app as backend_app
+
+    samples = []
+    with TestClient(backend_app.app) as client:
+        for i, query in enumerate(queries):
+            # alternate single-document and multi-document requests
+            files = file_names[i % len(file_names)] if i % 2 else file_names
+            start = time.perf_counter()
+            response = client.post("/query", data={"query": query, "file_name": files})
+            samples.append(time.perf_counter() - start)
+            if response.status_code != 200 or "error" in response.json():
+                raise RuntimeError(f"/query failed: {response.text}")
+    recorder.record("/query end-to-end", samples, len(queries), "queries")
+
+    with TestClient(backend_app.app) as client:
+        start = time.perf_counter()
+        response = client.post("/query-batch", json={"queries": queries, "file_name": file_names[0]})
+        seconds = time.perf_counter() - start
+    results = response.text.count("event: result\n")
+    if response.status_code != 200 or results != len(queries) or '"error"' in response.text:
+        raise RuntimeError(f"/query-batch failed: {response.text[:500]}")
+    recorder.record("/query-batch end-to-end", [seconds], len(queries), "queries")
+
+
+def find_regressions(results, baseline, tolerance):
+    previous = {result["stage"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(result["stage"])
+        if before is None:
+            continue
+        if before["throughput"] and result["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(f"{result['stage']}: throughput {before['throughput']:.1f} -> {result['throughput']:.1f}")
+        if before["p95_ms"] and result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{result['stage']}: p95 {before['p95_ms']:.2f}ms -> {result['p95_ms']:.2f}ms")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Ingestion and retrieval benchmarks")
+    parser.add_argument("--formats", nargs="+", default=["pdf", "docx", "txt"], choices=["pdf", "docx", "txt"])
+    parser.add_argument("--pages", nargs="+", type=int, default=[10, 50], help="document sizes in pages")
+    parser.add_argument("--words-per-page", type=int, default=350)
+    parser.add_argument("--queries", type=int, default=200, help="retrieval queries per document")
+    parser.add_argument("--http-queries", type=int, default=50, help="/query requests; 0 skips the endpoint")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="stub LLM seconds per completion")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="keep documents and indexes here instead of a temp dir")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="roledoc-bench-")
+    os.makedirs(os.path.join(workdir, "documents"), exist_ok=True)
+
+    server, url = start_stub_server(latency=args.llm_latency)
+    os.environ.update({
+        "OPENROUTER_URL": url,
+        "OPENROUTER_API_KEY": "benchmark",
+        "JOBS_DIR": os.path.join(workdir, "jobs"),
+        # every /query should pay for retrieval and the llm, not hit a cached answer
+        "RESPONSE_CACHE_ENABLED": "false",
+    })
+    # the backend keeps its indexes, uploads and history relative to the working directory
+    os.chdir(workdir)
+
+    recorder = Recorder()
+    queries = generate_queries(args.queries, seed=args.seed)
+    try:
+        print_header()
+        file_names = [
+            bench_document(recorder, fmt, num_pages, queries, args)
+            for fmt in args.formats
+            for num_pages in args.pages
+        ]
+        if args.http_queries and file_names:
+            bench_query_endpoint(recorder, file_names, generate_queries(args.http_queries, seed=args.seed + 1))
+    finally:
+        server.shutdown()
+        os.chdir(BACKEND_DIR)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": recorder.results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        regressions = find_regressions(recorder.results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+import random
+
+from docx import Document
+
+WORDS = (
+    "process control chart sample measure variation limit signal cause defect "
+    "quality data team customer supplier report review method analysis result "
+    "cost time frequency category pareto histogram scatter flow diagram step "
+    "inspection standard target deviation average range batch machine operator "
+    "training safety maintenance schedule budget risk audit policy record value"
+).split()
+
+HEADINGS = (
+    "Overview", "Procedure", "Examples", "Common mistakes", "Data collection",
+    "Interpretation", "Responsibilities", "Scope", "Definitions", "References",
+)
+
+# characters per line when laying text out on a pdf page
+PDF_LINE_CHARS = 90
+PDF_LINE_HEIGHT = 12
+PDF_PAGE_HEIGHT = 792
+
+
+def _sentence(rng):
+    words = rng.choices(WORDS, k=rng.randint(8, 18))
+    return " ".join(words).capitalize() + "."
+
+
+def generate_pages(num_pages, words_per_page=350, seed=0):
+    """
+    Pages of plain text with numbered section headings ("3.2 Procedure"),
+    so the section splitter and chunker see realistic structure.
+    """
+    rng = random.Random(seed)
+    pages = []
+    section = 0
+    for _ in range(num_pages):
+        lines = []
+        words = 0
+        while words < words_per_page:
+            if rng.random() < 0.25:
+                section += 1
+                lines.append(f"{section}. {rng.choice(HEADINGS)}")
+            paragraph = " ".join(_sentence(rng) for _ in range(rng.randint(2, 5)))
+            lines.append(paragraph)
+            words += len(paragraph.split())
+        pages.append("\n".join(lines))
+    return pages
+
+
+def write_txt(path, pages):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(pages))
+
+
+def write_docx(path, pages):
+    doc = Document()
+    for page in pages:
+        for line in page.split("\n"):
+            doc.add_paragraph(line)
+    doc.save(path)
+
+
+def _pdf_lines(page):
+    lines = []
+    for paragraph in page.split("\n"):
+        line = ""
+        for word in paragraph.split():
+            if line and len(line) + len(word) + 1 > PDF_LINE_CHARS:
+                lines.append(line)
+                line = word
+            else:
+                line = f"{line} {word}" if line else word
+        lines.append(line)
+    return lines
+
+
+def _pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, pages):
+    """
+    Minimal text-only PDF (Helvetica, one content stream per page); enough
+    for pdfplumber without pulling in a PDF writer dependency.
+    """
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_ids = []
+    for page in pages:
+        lines = _pdf_lines(page)
+        # shrink the leading so long pages still fit inside the media box
+        leading = min(PDF_LINE_HEIGHT, (PDF_PAGE_HEIGHT - 60) / max(len(lines), 1))
+        text = "\n".join(f"({_pdf_escape(line)}) Tj T*" for line in lines)
+        stream = f"BT /F1 9 Tf {leading:.2f} TL 40 {PDF_PAGE_HEIGHT - 40} Td\n{text}\nET".encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 %d] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (PDF_PAGE_HEIGHT, content_id)
+        )
+        page_ids.append(len(objects))
+    kids = " ".join(f"{i} 0 R" for i in page_ids).encode()
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+WRITERS = {"pdf": write_pdf, "docx": write_docx, "txt": write_txt}
+
+
+def write_document(path, fmt, pages):
+    WRITERS[fmt](path, pages)
+
+
+def generate_queries(count, seed=0):
+    rng = random.Random(seed)
+    templates = (
+        "how does {} affect {}",
+        "what is the {} {}",
+        "explain {} and {} in the procedure",
+        "{} {} limits",
+    )
+    return [rng.choice(templates).format(*rng.sample(WORDS, 2)) for _ in range(count)]
+
+
+SYLLABLES = ("ka", "lo", "mi", "ren", "tor", "vas", "qui", "pel", "dan", "sor", "bri", "zu", "fen", "gal", "hox", "jer")
+
+
+def generate_topics(num_topics=200, vocabulary=5000, words_per_topic=40, seed=0):
+    """
+    (topics, words): a pseudo-word vocabulary and word clusters drawn from
+    it, for generate_topic_texts.
+    """
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < vocabulary:
+        words.add("".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))))
+    words = sorted(words)
+    return [rng.sample(words, words_per_topic) for _ in range(num_topics)], words
+
+
+def generate_topic_texts(topics, count, words_per_text=60, topic_share=0.7, seed=0):
+    """
+    Texts drawn mostly from one topic each: a clustered, higher-dimensional
+    vector space than generate_pages gives, for nearest-neighbor benchmarks.
+    """
+    topic_words, words = topics
+    rng = random.Random(seed)
+    on_topic = max(1, int(words_per_text * topic_share))
+    return [
+        " ".join(rng.choices(rng.choice(topic_words), k=on_topic) + rng.choices(words, k=words_per_text - on_topic))
+        for _ in range(count)
+    ]
@@ -12,14 +12,24 @@ export PYTHONUNBUFFERED=1
 # Limit Python memory usage
 export MALLOC_TRIM_THRESHOLD_=100000
 
+# Workers share document indexes through the page cache (the artifacts are
+# memory-mapped read-only), so each extra worker costs its interpreter and
+# caches, not another copy of every index. Raise WEB_CONCURRENCY up to the
+# core count when memory allows.
+WEB_CONCURRENCY=${WEB_CONCURRENCY:-1}
+export WEB_CONCURRENCY
+
+# One /metrics view across workers
+if [ "$WEB_CONCURRENCY" -gt 1 ]; then
+    export METRICS_DIR=${METRICS_DIR:-metrics}
+fi
+
 # Start with optimized settings
 exec uvicorn app:app \
     --host 0.0.0.0 \
     --port ${PORT:-8000} \
-    --workers 1 \
-    --worker-class uvicorn.workers.UvicornWorker \
-    --max-requests 1000 \
-    --max-requests-jitter 100 \
-    --preload \
+    --workers $WEB_CONCURRENCY \
+    --limit-max-requests 1000 \
+    --limit-max-requests-jitter 100 \
     --access-log \
     --log-level info
@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+
+@pytest.fixture
+def vector_dir(tmp_path, monkeypatch):
+    """
+    Points utils.embed_store and utils.corpus_index at an empty VECTOR_DIR
+    under tmp_path.
+    """
+    import utils.corpus_index as corpus_index
+    import utils.embed_store as embed_store
+
+    directory = tmp_path / "vector_db"
+    directory.mkdir()
+    monkeypatch.setattr(embed_store, "VECTOR_DIR", str(directory))
+    monkeypatch.setattr(embed_store, "SOURCE_HASH_DIR", str(directory / "source_hashes"))
+    monkeypatch.setattr(embed_store, "INDEX_GENERATION_PATH", str(directory / "generation"))
+    monkeypatch.setattr(corpus_index, "CORPUS_DIR", str(directory / "corpus"))
+    monkeypatch.setattr(corpus_index, "INDEX_GENERATION_PATH", str(directory / "generation"))
+    embed_store.document_cache.clear()
+    embed_store.suggestion_cache.clear()
+    corpus_index.corpus_cache.clear()
+    yield str(directory)
+    embed_store.document_cache.clear()
+    embed_store.suggestion_cache.clear()
+    corpus_index.corpus_cache.clear()
@@ -0,0 +1,144 @@
+"""
+Document artifacts written by embed_and_store_pages read back the same,
+in the current format and as the older versions it still reads, and legacy
+JSON artifacts migrate to it.
+"""
+import os
+import json
+
+import faiss
+import numpy as np
+import pytest
+
+import utils.embed_store as embed_store
+from utils.artifact_format import (
+    FORMAT_VERSION, MAGIC, VERSION_SECTIONS, DocumentArtifact, _header, chunk_hash,
+)
+
+PAGES = [
+    "1. Scope\nThis procedure covers supplier audits and corrective actions.\n"
+    "2. Control charts\nControl charts track process variation against the control limits.\n",
+    "3. Pareto analysis\nA Pareto chart ranks defect causes by frequency.\n"
+    "Audits are scheduled every quarter by the quality team.\n",
+]
+SOURCE_HASH = "5" * 64
+
+
+def downgrade(path, version):
+    """
+    Rewrites the artifact at path as the given older version: its sections
+    are a prefix of the current ones, so only the header changes.
+    """
+    artifact = DocumentArtifact(path)
+    fields = [field for name in VERSION_SECTIONS[version] for field in artifact.sections[name]]
+    header = _header(version).pack(MAGIC, version, 0, artifact.num_terms, artifact.num_chunks, *fields)
+    artifact.buffer.close()
+    with open(path, "r+b") as f:
+        f.write(header)
+
+
+@pytest.fixture
+def document(vector_dir):
+    embed_store.embed_and_store_pages(PAGES, "doc.txt", source_hash=SOURCE_HASH)
+    return embed_store.artifact_path("doc.txt")
+
+
+def test_round_trip(document):
+    artifact = DocumentArtifact(document)
+    expected = list(embed_store.iter_chunks(PAGES))
+    assert artifact.version == FORMAT_VERSION
+    assert list(artifact.chunks()) == expected
+    assert [bytes(digest) for digest in artifact.chunk_hashes()] == [chunk_hash(chunk) for chunk in expected]
+    assert artifact.meta()["source_sha256"] == SOURCE_HASH
+    assert artifact.index().ntotal == len(expected)
+
+    vectorizer = embed_store.vectorizer_from_arrays(artifact.terms(), artifact.idf())
+    assert embed_store.vocabulary_terms(vectorizer) == artifact.terms()
+    np.testing.assert_allclose(vectorizer._idf_array(), artifact.idf())
+    # the stored vectors are the ones the stored vocabulary gives the chunks
+    vectors = embed_store.normalized(vectorizer.transform(expected))
+    np.testing.assert_allclose(artifact.index().reconstruct_n(0, len(expected)), vectors, atol=1e-6)
+
+    bm25 = artifact.bm25()
+    assert bm25 is not None and bm25.num_docs == len(expected)
+
+
+@pytest.mark.parametrize("version", sorted(set(VERSION_SECTIONS) - {FORMAT_VERSION}))
+def test_older_versions_read(document, version):
+    current = embed_store.query_vector_store("pareto defect causes", "doc.txt")
+    downgrade(document, version)
+    embed_store.document_cache.clear()
+
+    artifact = DocumentArtifact(document)
+    assert artifact.version == version
+    assert list(artifact.chunks()) == list(embed_store.iter_chunks(PAGES))
+    assert (artifact.chunk_hashes() is None) == (version < 2)
+    assert artifact.bm25() is None
+    assert embed_store.document_source_hash("doc.txt") == (None if version < 2 else SOURCE_HASH)
+    # a missing bm25 section is rebuilt on load
+    assert embed_store.query_vector_store("pareto defect causes", "doc.txt") == current
+
+
+@pytest.mark.parametrize("version", [1, 2])
+def test_reindex_over_older_version(document, version):
+    downgrade(document, version)
+    revised = PAGES + ["4. Records\nAudit records are kept for five years.\n"]
+    assert embed_store.embed_and_store_pages(revised, "doc.txt") == len(list(embed_store.iter_chunks(revised)))
+
+    artifact = DocumentArtifact(document)
+    assert artifact.version == FORMAT_VERSION
+    assert list(artifact.chunks()) == list(embed_store.iter_chunks(revised))
+
+
+def write_legacy_json(file_name, chunks):
+    # the JSON artifacts written before the binary format, with an L2 index of raw vectors
+    vectorizer = embed_store.SimpleVectorizer(max_features=300)
+    vectors = np.ascontiguousarray(vectorizer.fit_transform(chunks), dtype=np.float32)
+    index = faiss.IndexFlatL2(vectors.shape[1])
+    index.add(vectors)
+    index_path, chunks_path, vectorizer_path = embed_store.legacy_artifact_paths(file_name)
+    faiss.write_index(index, index_path)
+    with open(chunks_path, "w", encoding="utf-8") as f:
+        json.dump(chunks, f)
+    with open(vectorizer_path, "w", encoding="utf-8") as f:
+        json.dump({"vocab": vectorizer.vocabulary, "idf": vectorizer.idf_values}, f)
+
+
+def test_migrate_legacy_json(vector_dir, monkeypatch):
+    from utils import migrate_artifacts
+
+    monkeypatch.setattr(migrate_artifacts, "VECTOR_DIR", vector_dir)
+    chunks = embed_store.split_into_chunks("\n".join(PAGES))
+    write_legacy_json("old.txt", chunks)
+    before = embed_store.query_vector_store("control limits variation", "old.txt")
+    embed_store.document_cache.clear()
+
+    assert migrate_artifacts.migrate() == (["old.txt"], [], [])
+    assert not any(os.path.exists(path) for path in embed_store.legacy_artifact_paths("old.txt"))
+    artifact = DocumentArtifact(embed_store.artifact_path("old.txt"))
+    assert artifact.version == FORMAT_VERSION
+    assert list(artifact.chunks()) == chunks
+    assert artifact.bm25() is not None
+    after = embed_store.query_vector_store("control limits variation", "old.txt")
+    assert after["text"] == before["text"]
+    assert after["score"] == pytest.approx(before["score"], abs=1e-5)
+    # a second run has nothing left to do
+    assert migrate_artifacts.migrate() == ([], [], [])
+
+
+def test_migrate_dry_run(vector_dir, monkeypatch, capsys):
+    from utils import migrate_artifacts
+
+    monkeypatch.setattr(migrate_artifacts, "VECTOR_DIR", vector_dir)
+    write_legacy_json("old.txt", embed_store.split_into_chunks("\n".join(PAGES)))
+    # legacy files next to a current artifact (indexing removes them, so written after)
+    embed_store.embed_and_store_pages(PAGES[:1], "stale.txt")
+    write_legacy_json("stale.txt", embed_store.split_into_chunks(PAGES[0]))
+
+    migrate_artifacts.main(["--dry-run"])
+    assert capsys.readouterr().out.splitlines() == [
+        "would migrate old.txt",
+        "would remove stale legacy files for stale.txt",
+    ]
+    assert not os.path.exists(embed_store.artifact_path("old.txt"))
+    assert all(os.path.exists(path) for path in embed_store.legacy_artifact_paths("stale.txt"))
@@ -0,0 +1,119 @@
+"""
+BM25Index.search (MaxScore with block skipping) against scoring every
+document by brute force.
+"""
+import math
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from utils.bm25 import BLOCK_SIZE, BM25_B, BM25_K1, BM25Index, decode_varints, encode_varints
+
+# block bounds are stored as float32
+TOLERANCE = 1e-5
+
+
+def make_corpus(num_docs, vocabulary, seed):
+    # Zipf-like term frequencies, so some terms span many blocks and most are rare
+    rng = np.random.default_rng(seed)
+    weights = 1 / np.arange(1, vocabulary + 1)
+    weights /= weights.sum()
+    return [
+        [f"t{term}" for term in rng.choice(vocabulary, rng.integers(1, 40), p=weights)]
+        for _ in range(num_docs)
+    ]
+
+
+def brute_force_scores(docs, tokens, k1=BM25_K1, b=BM25_B):
+    num_docs = len(docs)
+    avgdl = sum(len(doc) for doc in docs) / num_docs
+    doc_freq = Counter(term for doc in docs for term in set(doc))
+    counts = [Counter(doc) for doc in docs]
+    scores = np.zeros(num_docs)
+    for term in set(tokens):
+        if not doc_freq[term]:
+            continue
+        idf = math.log(1 + (num_docs - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+        for i, doc in enumerate(docs):
+            tf = counts[i][term]
+            if tf:
+                scores[i] += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(doc) / avgdl))
+    return scores
+
+
+def assert_top_k(results, scores, top_k, allowed=None):
+    candidates = [i for i in range(len(scores)) if scores[i] > 0 and (allowed is None or allowed[i])]
+    expected = sorted((scores[i] for i in candidates), reverse=True)[:top_k]
+    assert [score for _, score in results] == pytest.approx(expected, abs=TOLERANCE)
+    for doc, score in results:
+        assert score == pytest.approx(scores[doc], abs=TOLERANCE)
+        assert allowed is None or allowed[doc]
+    assert len({doc for doc, _ in results}) == len(results)
+
+
+CORPORA = {
+    "small": (40, 30, 0),
+    "one_block": (BLOCK_SIZE, 200, 1),
+    "many_blocks": (12 * BLOCK_SIZE + 5, 400, 2),
+}
+
+
+@pytest.fixture(scope="module", params=sorted(CORPORA))
+def corpus(request):
+    docs = make_corpus(*CORPORA[request.param])
+    return docs, BM25Index.from_texts(docs)
+
+
+def queries(docs, seed=3, count=40):
+    rng = np.random.default_rng(seed)
+    terms = sorted({term for doc in docs for term in doc})
+    for _ in range(count):
+        query = list(rng.choice(terms, rng.integers(1, 7)))
+        # repeated and unknown terms
+        yield query + query[:1] + ["unknown"]
+
+
+@pytest.mark.parametrize("top_k", [1, 3, 10, 10_000])
+def test_search_matches_brute_force(corpus, top_k):
+    docs, index = corpus
+    for tokens in queries(docs):
+        assert_top_k(index.search(tokens, top_k), brute_force_scores(docs, tokens), top_k)
+
+
+def test_search_with_allowed_mask(corpus):
+    docs, index = corpus
+    allowed = np.random.default_rng(4).random(len(docs)) < 0.3
+    for tokens in queries(docs, seed=5, count=20):
+        assert_top_k(index.search(tokens, 5, allowed=allowed), brute_force_scores(docs, tokens), 5, allowed)
+
+
+def test_score_and_bound(corpus):
+    docs, index = corpus
+    for tokens in queries(docs, seed=6, count=10):
+        expected = brute_force_scores(docs, tokens)
+        picked = np.random.default_rng(7).permutation(len(docs))[:25]
+        np.testing.assert_allclose(index.score(tokens, picked), expected[picked], atol=TOLERANCE)
+        assert index.max_query_score(tokens) >= expected.max() - TOLERANCE
+
+
+def test_no_match():
+    index = BM25Index.from_texts([["alpha", "beta"], ["gamma"]])
+    assert index.search(["delta"], 5) == []
+    assert index.search([], 5) == []
+    assert index.search(["alpha"], 0) == []
+
+
+def test_varints_round_trip():
+    values = [0, 1, 127, 128, 300, 2 ** 21, 2 ** 32 - 1]
+    assert decode_varints(encode_varints(values)).tolist() == values
+
+
+def test_postings(corpus):
+    docs, index = corpus
+    terms = index.terms()
+    assert terms == sorted({term for doc in docs for term in doc})
+    for term_id, term in enumerate(terms):
+        expected = [(i, doc.count(term)) for i, doc in enumerate(docs) if term in doc]
+        doc_ids, tfs = index.postings(term_id)
+        assert list(zip(doc_ids.tolist(), tfs.tolist())) == expected
@@ -0,0 +1,180 @@
+"""
+The corpus index, one vectorizer and faiss index over every indexed
+document, ranks the chunks of the documents queried the same as refitting
+a vectorizer on the whole library and BM25 on the queried documents.
+"""
+import math
+import os
+from collections import Counter
+
+import numpy as np
+import pytest
+
+import utils.ann_index as ann_index
+import utils.corpus_index as corpus_index
+import utils.embed_store as embed_store
+from utils.tokens import tokenize
+
+WORDS = [
+    "audit", "supplier", "control", "chart", "limit", "pareto", "defect", "cause",
+    "quality", "process", "variation", "sample", "batch", "scrap", "rework", "review",
+    "calibration", "gauge", "tolerance", "inspection", "training", "record", "customer",
+]
+QUERIES = ["supplier audit review", "control chart limits", "gauge calibration records", "unknown words"]
+TOLERANCE = 1e-5
+
+
+def write_documents(names, seed=0):
+    rng = np.random.default_rng(seed)
+    for name in names:
+        pages = [" ".join(rng.choice(WORDS, 300)) + "." for _ in range(4)]
+        embed_store.embed_and_store_pages(pages, name)
+
+
+@pytest.fixture
+def documents(vector_dir, monkeypatch):
+    monkeypatch.setattr(corpus_index, "CORPUS_MAX_FEATURES", 10_000)
+    names = [f"doc{i}.txt" for i in range(3)]
+    write_documents(names)
+    corpus_index.sync_corpus_index()
+    return names
+
+
+def chunk_rows(names):
+    return [
+        (name, chunk_id, str(chunk))
+        for name in names for chunk_id, chunk in enumerate(embed_store.load_document(name)[1])
+    ]
+
+
+def refit_scores(library, queried, query, mode):
+    """
+    Brute-force scores of the queried chunks (a boolean mask over library).
+    """
+    vectorizer = embed_store.SimpleVectorizer(max_features=10_000)
+    vectors = embed_store.normalized(vectorizer.fit_transform(library))[queried]
+    cosine = np.clip(vectors @ embed_store.normalized(vectorizer.transform([query]))[0], 0, 1)
+    if mode == "vector":
+        return cosine
+
+    tokens = [tokenize(chunk) for chunk, keep in zip(library, queried) if keep]
+    lengths = np.array([len(chunk_tokens) for chunk_tokens in tokens])
+    doc_freq = Counter(term for chunk_tokens in tokens for term in set(chunk_tokens))
+    k1, b = corpus_index.BM25_K1, corpus_index.BM25_B
+    lexical = np.zeros(len(tokens))
+    bound = 0.0
+    for term in set(tokenize(query)):
+        if not doc_freq[term]:
+            continue
+        idf = math.log(1 + (len(tokens) - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+        tfs = np.array([chunk_tokens.count(term) for chunk_tokens in tokens])
+        weights = idf * tfs * (k1 + 1) / (tfs + k1 * (1 - b + b * lengths / lengths.mean()))
+        lexical += weights
+        bound += weights.max()
+    if not bound:
+        return np.zeros(len(tokens)) if mode == "bm25" else cosine
+    if mode == "bm25":
+        return lexical / bound
+    return embed_store.HYBRID_ALPHA * cosine + (1 - embed_store.HYBRID_ALPHA) * lexical / bound
+
+
+def assert_matches_refit(names, library_names, mode, **options):
+    library = chunk_rows(library_names)
+    queried = np.array([name in names for name, _, _ in library])
+    rows = [row for row, keep in zip(library, queried) if keep]
+    index = corpus_index.get_corpus_index()
+    batch = index.search_batch(QUERIES, names, top_k=5, min_score=0.0, mode=mode, **options)
+    for query, results in zip(QUERIES, batch):
+        scores = refit_scores([text for _, _, text in library], queried, query, mode)
+        expected = sorted(scores, reverse=True)[:5]
+        if mode == "bm25":
+            # only chunks with a query term are found
+            expected = [score for score in expected if score > 0]
+        assert [result["score"] for result in results] == pytest.approx(expected, abs=TOLERANCE)
+        for result in results:
+            row = next(i for i, (name, chunk_id, _) in enumerate(rows)
+                       if (name, chunk_id) == (result["file_name"], result["chunk_id"]))
+            assert result["text"] == rows[row][2]
+            assert result["score"] == pytest.approx(scores[row], abs=TOLERANCE)
+
+
+@pytest.mark.parametrize("mode", embed_store.RETRIEVAL_MODES)
+@pytest.mark.parametrize("subset", [slice(None), slice(0, 2), slice(1, 3), slice(2, 3)])
+def test_matches_refit(documents, mode, subset):
+    assert_matches_refit(documents[subset], documents, mode)
+
+
+def test_file_names_restrict_results(documents):
+    results = corpus_index.query_corpus_batch(["supplier audit"], [documents[1]], top_k=10)[0]
+    assert results and {result["file_name"] for result in results} == {documents[1]}
+    # documents that are not indexed are left out
+    assert corpus_index.query_corpus_batch(["supplier audit"], ["missing.txt"]) == [[]]
+
+
+def test_sync_adds_segment(documents, monkeypatch):
+    monkeypatch.setattr(corpus_index, "CORPUS_REFIT_FRACTION", 10.0)
+    index = corpus_index.get_corpus_index()
+    assert len(index.segments) == 1 and corpus_index.get_corpus_index() is index
+    fitted = corpus_index._read_manifest()
+
+    # until synced, a re-indexed document is not covered and callers search it on their own
+    write_documents([documents[2], "doc3.txt"], seed=1)
+    assert corpus_index.query_corpus_batch(QUERIES, documents[1:]) is None
+    assert corpus_index.sync_corpus_index()
+    assert not corpus_index.sync_corpus_index()
+
+    index = corpus_index.get_corpus_index()
+    assert len(index.segments) == 2
+    assert index.documents[documents[2]][0] == index.documents["doc3.txt"][0] != index.documents[documents[0]][0]
+    # both segments are in the vocabulary fitted on the original library
+    manifest = corpus_index._read_manifest()
+    assert (manifest["terms"], manifest["idf"]) == (fitted["terms"], fitted["idf"])
+    batch = index.search_batch(QUERIES, documents + ["doc3.txt"], top_k=20, min_score=0.0, mode="hybrid")
+    assert {result["file_name"] for result in batch[0]} == set(documents + ["doc3.txt"])
+
+    # a deleted document's rows are dropped, and its segment once nothing else uses it
+    os.remove(embed_store.artifact_path(documents[2]))
+    os.remove(embed_store.artifact_path("doc3.txt"))
+    assert corpus_index.sync_corpus_index()
+    index = corpus_index.get_corpus_index()
+    assert set(index.documents) == set(documents[:2]) and len(index.segments) == 1
+    assert len(os.listdir(corpus_index.CORPUS_DIR)) == 3
+
+
+def test_sync_refits_past_threshold(documents, monkeypatch):
+    monkeypatch.setattr(corpus_index, "CORPUS_REFIT_FRACTION", 0.1)
+    write_documents(["doc3.txt"], seed=1)
+    corpus_index.sync_corpus_index()
+    assert len(corpus_index.get_corpus_index().segments) == 1
+    assert_matches_refit(documents[1:] + ["doc3.txt"], documents + ["doc3.txt"], "hybrid")
+
+
+def test_tier_for_library_size(vector_dir, monkeypatch):
+    # one document (21 chunks) stays flat; the library of three is searched by HNSW
+    monkeypatch.setattr(corpus_index, "CORPUS_MAX_FEATURES", 10_000)
+    monkeypatch.setattr(ann_index, "ANN_HNSW_MIN_CHUNKS", 50)
+    names = [f"doc{i}.txt" for i in range(3)]
+    write_documents(names)
+    assert ann_index.tier_of(embed_store.load_document(names[0])[0]) == "flat"
+    corpus_index.sync_corpus_index()
+    (segment,) = corpus_index.get_corpus_index().segments.values()
+    assert ann_index.tier_of(segment) == "hnsw" and segment.ntotal == 63
+
+    # ef_search past the library size makes the HNSW search exhaustive
+    assert_matches_refit(names[1:], names, "vector", ef_search=128)
+
+
+def test_ivf_tier(vector_dir, monkeypatch):
+    monkeypatch.setattr(corpus_index, "CORPUS_MAX_FEATURES", 10_000)
+    monkeypatch.setattr(ann_index, "ANN_IVF_MIN_CHUNKS", 100)
+    names = [f"doc{i}.txt" for i in range(5)]
+    write_documents(names)
+    corpus_index.sync_corpus_index()
+    (segment,) = corpus_index.get_corpus_index().segments.values()
+    assert ann_index.tier_of(segment) == "ivf" and segment.nlist == 2
+
+    # probing every list is exact; hybrid fusion reconstructs rows through
+    # the direct map read back from disk
+    assert_matches_refit(names[::2], names, "hybrid", nprobe=2)
+    results = corpus_index.query_corpus_batch(QUERIES, names[:1], top_k=5, nprobe=1)
+    assert all(result["file_name"] == names[0] for batch in results for result in batch)
@@ -0,0 +1,55 @@
+"""
+With default settings a PDF of PDF_PARALLEL_MIN_PAGES pages or more is
+extracted on a process pool sized to the idle cores, and reads back the
+same as extracting it serially.
+"""
+import multiprocessing
+import os
+
+import pytest
+
+import utils.extract_text as extract_text
+import utils.jobs as jobs
+from benchmarks.synthetic import generate_pages, write_pdf
+
+
+@pytest.fixture(scope="module")
+def long_pdf(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("pdf") / "manual.pdf")
+    write_pdf(path, generate_pages(extract_text.PDF_PARALLEL_MIN_PAGES + 1, words_per_page=40))
+    return path
+
+
+@pytest.fixture
+def four_cores(monkeypatch):
+    # an ingestion node with more than one core
+    monkeypatch.setattr(os, "cpu_count", lambda: 4)
+
+
+@pytest.fixture
+def parallel_calls(monkeypatch, four_cores):
+    calls = []
+    parallel = extract_text.iter_pages_from_pdf_parallel
+
+    def spy(file_path, num_pages, workers, *args, **kwargs):
+        calls.append(workers)
+        return parallel(file_path, num_pages, workers, *args, **kwargs)
+
+    monkeypatch.setattr(extract_text, "iter_pages_from_pdf_parallel", spy)
+    return calls
+
+
+def test_default_settings_extract_in_parallel(long_pdf, parallel_calls):
+    assert extract_text.PDF_EXTRACT_WORKERS == 0
+    pages = list(extract_text.iter_pages_from_pdf(long_pdf))
+    assert parallel_calls == [4]
+    assert pages == list(extract_text.iter_pages_from_pdf(long_pdf, workers=1))
+    assert len(pages) == extract_text.PDF_PARALLEL_MIN_PAGES + 1
+
+
+def test_running_jobs_share_the_cores(monkeypatch, four_cores):
+    running = multiprocessing.get_context("spawn").Value("i", 2)
+    monkeypatch.setattr(jobs, "_running_jobs", running)
+    assert extract_text.pdf_extract_workers() == 2
+    running.value = 8
+    assert extract_text.pdf_extract_workers() == 1
@@ -0,0 +1,61 @@
+"""
+StreamingChunker (through iter_chunks) against split_into_chunks over the
+joined pages, however the text is split into pages.
+"""
+import pytest
+
+from utils.embed_store import CHUNK_WIDTH, iter_chunks, split_into_chunks
+
+LONG_LINE = " ".join(f"word{i}" for i in range(400))
+
+TEXTS = {
+    "empty": "",
+    "blank": "\n\n   \n\t\n",
+    "plain": "Quality control keeps a process stable.\nCharts show the variation over time.\n",
+    "headings": (
+        "Introduction text before any section.\n"
+        "1. Scope\nThis procedure covers audits.\n"
+        "2. Responsibilities\nThe quality team owns the records.\n"
+        "Step 3 Review\nResults are reviewed monthly.\n"
+    ),
+    "consecutive_headings": "1. First\n2. Second\n3. Third\nContent for the third.\n",
+    "trailing_heading": "Some content.\n1. Appendix\n",
+    "heading_first": "1. Overview\nThe whole document is one section.",
+    "nested_numbers": "1.2.3) Detail\nNested numbering.\nSection 4: Closing\nThe end.\n",
+    "long_section": "1. Long\n" + "\n".join([LONG_LINE] * 3) + "\n2. Short\nDone.\n",
+    "unbroken_word": "x" * (3 * CHUNK_WIDTH) + "\nafter\n",
+}
+
+
+def page_splits(text):
+    """
+    The text as one page, a page per line, and split at every line boundary.
+    """
+    lines = text.split("\n")
+    yield [text]
+    yield lines
+    for cut in range(1, len(lines)):
+        yield ["\n".join(lines[:cut]), "\n".join(lines[cut:])]
+
+
+@pytest.mark.parametrize("name", sorted(TEXTS))
+def test_matches_split_into_chunks(name):
+    text = TEXTS[name]
+    expected = split_into_chunks(text)
+    for pages in page_splits(text):
+        assert list(iter_chunks(pages)) == expected, pages
+
+
+def test_no_pages():
+    assert list(iter_chunks([])) == []
+
+
+@pytest.mark.parametrize("name", ["plain", "headings", "long_section"])
+def test_small_carry_keeps_words(name):
+    # sections longer than the carry limit are emitted early; only whitespace at the seams may differ
+    text = TEXTS[name]
+    expected = split_into_chunks(text)
+    for pages in page_splits(text):
+        chunks = list(iter_chunks(pages, max_carry_chars=64))
+        assert " ".join(chunks).split() == " ".join(expected).split(), pages
+        assert all(len(chunk) <= CHUNK_WIDTH for chunk in chunks if " " in chunk)
@@ -0,0 +1,35 @@
+"""
+Heading suggestions are only offered when asking them retrieves something:
+the chunker keeps a heading's number but not its title.
+"""
+from collections import Counter
+
+import utils.embed_store as embed_store
+from utils.suggestions import PhraseCollector
+from utils.tokens import tokenize
+
+PAGES = [
+    "1. Scope\nThis scope covers supplier audits and corrective actions.\n"
+    "Step 2: Procedure\nRecord every finding in the audit log.\n",
+]
+
+
+def test_heading_without_chunk_text_dropped():
+    phrases = PhraseCollector()
+    for heading in ("1. Scope", "Step 2: Procedure"):
+        phrases.add_heading(heading)
+    doc_freq = Counter(tokenize("This scope covers supplier audits"))
+    texts = [candidate["text"] for candidate in phrases.finish(doc_freq, 1)]
+    assert "Scope" in texts
+    assert "Procedure" not in texts
+
+
+def test_stored_suggestions_retrievable(vector_dir):
+    embed_store.embed_and_store_pages(PAGES, "audit.txt")
+    chunks = " ".join(embed_store.load_document("audit.txt")[1])
+    assert "Procedure" not in chunks
+    suggestions = embed_store.document_suggestions("audit.txt")
+    assert "Procedure" not in [candidate["text"] for candidate in suggestions]
+    for candidate in suggestions:
+        result = embed_store.query_vector_store(candidate["text"], "audit.txt")
+        assert result["text"], candidate
@@ -0,0 +1,155 @@
+import math
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import asynccontextmanager
+
+from utils.metrics import ADMISSION_IN_FLIGHT, ADMISSION_QUEUE_DEPTH, ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS
+
+# Retry-After bounds, in seconds
+RETRY_AFTER_MIN = 1
+RETRY_AFTER_MAX = 300
+# weight of the latest hold time in the moving average behind Retry-After
+HOLD_TIME_SMOOTHING = 0.2
+
+
+class Overloaded(Exception):
+    """
+    A call turned away by an AdmissionLimiter; the app answers 503 with
+    a Retry-After of retry_after seconds.
+    """
+
+    def __init__(self, pool, reason, retry_after):
+        super().__init__(f"{pool} is overloaded ({reason}), retry in {retry_after}s")
+        self.pool = pool
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("loop", "future", "granted")
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.future = loop.create_future()
+        self.granted = False
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdmissionLimiter:
+    """
+    At most limit calls at once, and at most queue_size more waiting, each
+    for up to queue_timeout seconds, first come first served. Anything
+    past that fails fast with Overloaded instead of piling up behind work
+    that would time out anyway, so the admitted calls keep their latency.
+    Slots can be released from any thread (ingest jobs end on the
+    process pool's callback thread).
+    """
+
+    def __init__(self, name, limit, queue_size, queue_timeout):
+        self.name = name
+        self.limit = max(1, limit)
+        self.queue_size = max(0, queue_size)
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.hold_seconds = float(RETRY_AFTER_MIN)
+        self._waiters = deque()
+        self._lock = threading.Lock()
+        self._update_gauges()
+
+    @property
+    def queued(self):
+        # try_acquire admits up to queue_size past limit; those wait in the pool
+        return len(self._waiters) + max(0, self.active - self.limit)
+
+    def _update_gauges(self):
+        ADMISSION_IN_FLIGHT.set(min(self.active, self.limit), pool=self.name)
+        ADMISSION_QUEUE_DEPTH.set(self.queued, pool=self.name)
+
+    def retry_after(self):
+        # time for the calls ahead to drain, going by how long slots are held
+        seconds = self.hold_seconds * (self.queued + 1) / self.limit
+        return int(min(RETRY_AFTER_MAX, max(RETRY_AFTER_MIN, math.ceil(seconds))))
+
+    def _reject(self, reason):
+        ADMISSION_REJECTED.inc(pool=self.name, reason=reason)
+        return Overloaded(self.name, reason, self.retry_after())
+
+    async def acquire(self):
+        start = time.perf_counter()
+        with self._lock:
+            if self.active < self.limit and not self._waiters:
+                self.active += 1
+                self._update_gauges()
+                ADMISSION_WAIT_SECONDS.observe(0.0, pool=self.name)
+                return
+            if len(self._waiters) >= self.queue_size:
+                raise self._reject("queue_full")
+            waiter = _Waiter(asyncio.get_running_loop())
+            self._waiters.append(waiter)
+            self._update_gauges()
+
+        try:
+            await asyncio.wait([waiter.future], timeout=self.queue_timeout)
+        except BaseException:
+            self._abandon(waiter)
+            raise
+        with self._lock:
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+                self._update_gauges()
+                raise self._reject("timeout")
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - start, pool=self.name)
+
+    def _abandon(self, waiter):
+        # cancelled while queued: give up the place, or the slot if it was just handed over
+        with self._lock:
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+                self._update_gauges()
+                return
+        self.release()
+
+    def try_acquire(self):
+        """
+        Admits without waiting here, for work that queues elsewhere (ingest
+        jobs wait in the process pool's queue): up to limit + queue_size
+        slots, then Overloaded.
+        """
+        with self._lock:
+            if self.active >= self.limit + self.queue_size:
+                raise self._reject("queue_full")
+            self.active += 1
+            self._update_gauges()
+
+    def release(self, held_seconds=None):
+        with self._lock:
+            if held_seconds is not None:
+                self.hold_seconds += HOLD_TIME_SMOOTHING * (held_seconds - self.hold_seconds)
+            # the slot passes straight to the oldest waiter
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+                try:
+                    waiter.loop.call_soon_threadsafe(_wake, waiter.future)
+                    break
+                except RuntimeError:
+                    # its event loop has closed; nobody is left waiting there
+                    continue
+            else:
+                self.active -= 1
+            self._update_gauges()
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - start)
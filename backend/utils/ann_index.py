@@ -0,0 +1,188 @@
+import os
+
+import faiss
+import numpy as np
+
+# index tier by chunk count; ANN_INDEX_TYPE forces one of INDEX_TYPES instead
+#   flat  exact scan                     below ANN_HNSW_MIN_CHUNKS
+#   hnsw  graph, exact vectors           below ANN_IVF_MIN_CHUNKS
+#   ivf   trained centroids, exact lists below ANN_IVFPQ_MIN_CHUNKS
+#   ivfpq centroids + product-quantized codes (ANN_PQ_DIMS_PER_CODE dims per byte)
+INDEX_TYPES = ("flat", "hnsw", "ivf", "ivfpq")
+ANN_INDEX_TYPE = os.getenv("ANN_INDEX_TYPE", "auto").lower()
+if ANN_INDEX_TYPE not in INDEX_TYPES + ("auto",):
+    raise ValueError(f"ANN_INDEX_TYPE must be auto or one of {', '.join(INDEX_TYPES)}")
+ANN_HNSW_MIN_CHUNKS = int(os.getenv("ANN_HNSW_MIN_CHUNKS", "50000"))
+ANN_IVF_MIN_CHUNKS = int(os.getenv("ANN_IVF_MIN_CHUNKS", "500000"))
+ANN_IVFPQ_MIN_CHUNKS = int(os.getenv("ANN_IVFPQ_MIN_CHUNKS", "5000000"))
+
+ANN_HNSW_M = int(os.getenv("ANN_HNSW_M", "32"))
+ANN_HNSW_EF_CONSTRUCTION = int(os.getenv("ANN_HNSW_EF_CONSTRUCTION", "80"))
+ANN_PQ_DIMS_PER_CODE = int(os.getenv("ANN_PQ_DIMS_PER_CODE", "4"))
+
+# per-query defaults; search_params takes overrides
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "16"))
+ANN_EF_SEARCH = int(os.getenv("ANN_EF_SEARCH", "64"))
+
+# faiss wants at least this many training points per centroid; training
+# samples up to TRAIN_SAMPLE_PER_CENTROID per centroid
+TRAIN_POINTS_PER_CENTROID = 39
+TRAIN_SAMPLE_PER_CENTROID = 64
+PQ_CENTROIDS = 256
+
+
+def choose_index_type(num_chunks, index_type=ANN_INDEX_TYPE):
+    if index_type != "auto":
+        return index_type
+    if num_chunks >= ANN_IVFPQ_MIN_CHUNKS:
+        return "ivfpq"
+    if num_chunks >= ANN_IVF_MIN_CHUNKS:
+        return "ivf"
+    if num_chunks >= ANN_HNSW_MIN_CHUNKS:
+        return "hnsw"
+    return "flat"
+
+
+def num_lists(num_chunks):
+    # the usual ~4 * sqrt(n) inverted lists, each still trainable
+    nlist = int(4 * np.sqrt(num_chunks))
+    return max(1, min(nlist, num_chunks // TRAIN_POINTS_PER_CENTROID))
+
+
+def pq_subquantizers(d, dims_per_code=ANN_PQ_DIMS_PER_CODE):
+    """
+    The divisor of d closest to d / dims_per_code (faiss needs an exact split).
+    """
+    target = max(1, d // dims_per_code)
+    divisors = [m for m in range(1, d + 1) if d % m == 0]
+    return min(divisors, key=lambda m: (abs(m - target), m))
+
+
+def tier_of(index):
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivfpq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf"
+    return "flat"
+
+
+def stores_exact_vectors(index):
+    # product quantization reconstructs approximations only
+    return tier_of(index) != "ivfpq"
+
+
+def training_rows(num_chunks, size, seed=0):
+    """
+    Sorted rows of a random sample of size out of num_chunks (all of them
+    when there are fewer).
+    """
+    if num_chunks <= size:
+        return np.arange(num_chunks)
+    return np.sort(np.random.default_rng(seed).choice(num_chunks, size, replace=False))
+
+
+def training_size(index):
+    """
+    Vectors to train index on before adding any; 0 for tiers without training.
+    """
+    kind = tier_of(index)
+    if kind == "ivf":
+        return index.nlist * TRAIN_SAMPLE_PER_CENTROID
+    if kind == "ivfpq":
+        return max(index.nlist, PQ_CENTROIDS) * TRAIN_SAMPLE_PER_CENTROID
+    return 0
+
+
+def new_index(num_chunks, d, index_type=ANN_INDEX_TYPE):
+    """
+    Empty inner-product index for num_chunks L2-normalized vectors of d
+    dimensions, of the tier choose_index_type picks for the count. Tiers
+    that need more training points than there are vectors fall back to a
+    smaller tier. IVF tiers are untrained: train them on training_size
+    vectors (a sample, see training_rows) before adding, which can then
+    be done in batches.
+    """
+    kind = choose_index_type(num_chunks, index_type)
+    if kind == "ivfpq" and num_chunks < PQ_CENTROIDS * TRAIN_POINTS_PER_CENTROID:
+        kind = "ivf"
+    if kind in ("ivf", "ivfpq") and num_lists(num_chunks) < 2:
+        kind = "flat"
+
+    if kind == "flat":
+        return faiss.IndexFlatIP(d)
+    if kind == "hnsw":
+        index = faiss.IndexHNSWFlat(d, ANN_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = ANN_HNSW_EF_CONSTRUCTION
+        return index
+    nlist = num_lists(num_chunks)
+    quantizer = faiss.IndexFlatIP(d)
+    if kind == "ivf":
+        index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+    else:
+        index = faiss.IndexIVFPQ(quantizer, d, nlist, pq_subquantizers(d), 8, faiss.METRIC_INNER_PRODUCT)
+    # the index owns its quantizer once it outlives this function
+    index.own_fields = True
+    quantizer.this.disown()
+    # rows are looked up by id when re-indexing and in hybrid fusion
+    index.make_direct_map()
+    return index
+
+
+def build_index(vectors, index_type=ANN_INDEX_TYPE):
+    """
+    new_index for vectors, trained on a sample of them and filled.
+    """
+    num_chunks, d = vectors.shape
+    index = new_index(num_chunks, d, index_type)
+    if not index.is_trained:
+        index.train(vectors[training_rows(num_chunks, training_size(index))])
+    if num_chunks:
+        index.add(vectors)
+    return index
+
+
+def rebuild_index(index, index_type=ANN_INDEX_TYPE):
+    """
+    build_index over the vectors of a flat index.
+    """
+    if choose_index_type(index.ntotal, index_type) == "flat" and tier_of(index) == "flat":
+        return index
+    return build_index(index.reconstruct_n(0, index.ntotal), index_type)
+
+
+def search_params(index, selector=None, nprobe=None, ef_search=None):
+    """
+    faiss search parameters for index: nprobe for IVF tiers, efSearch for
+    HNSW (defaults ANN_NPROBE / ANN_EF_SEARCH), plus an optional id selector.
+    """
+    kind = tier_of(index)
+    if kind in ("ivf", "ivfpq"):
+        params = faiss.SearchParametersIVF(nprobe=nprobe or ANN_NPROBE)
+    elif kind == "hnsw":
+        params = faiss.SearchParametersHNSW(efSearch=ef_search or ANN_EF_SEARCH)
+    elif selector is None:
+        return None
+    else:
+        params = faiss.SearchParameters()
+    if selector is not None:
+        params.sel = selector
+    return params
+
+
+def index_nbytes(index, mapped=False):
+    """
+    Approximate resident size, for the document cache. mapped: flat vector
+    storage is read in place from a file mapping (see DocumentArtifact.index)
+    and lives in the shared page cache, not the process.
+    """
+    kind = tier_of(index)
+    if kind == "ivfpq":
+        return index.ntotal * (index.code_size + 8) + index.nlist * index.d * 4
+    nbytes = 0 if mapped and kind in ("flat", "hnsw") else index.ntotal * index.d * 4
+    if kind == "hnsw":
+        nbytes += index.ntotal * index.hnsw.nb_neighbors(0) * 4
+    elif kind == "ivf":
+        nbytes += index.ntotal * 8 + index.nlist * index.d * 4
+    return nbytes
@@ -0,0 +1,234 @@
+import os
+import mmap
+import json
+import struct
+import hashlib
+from collections.abc import Sequence
+
+import faiss
+import numpy as np
+
+from utils.bm25 import BM25Index
+
+# one file per document:
+#   header | term offsets | terms | idf | chunks | chunk offsets | faiss index
+#   | chunk hashes | metadata (json) | bm25 inverted index
+# sections are 8-byte aligned so the arrays can be viewed straight out of the mmap
+MAGIC = b"RDOCART\x00"
+FORMAT_VERSION = 3
+# older versions lack the later sections (hashes and metadata from 2, bm25
+# from 3); they are still readable
+VERSION_SECTIONS = {
+    1: ("term_offsets", "terms", "idf", "chunks", "chunk_offsets", "index"),
+    2: ("term_offsets", "terms", "idf", "chunks", "chunk_offsets", "index", "chunk_hashes", "meta"),
+    3: ("term_offsets", "terms", "idf", "chunks", "chunk_offsets", "index", "chunk_hashes", "meta", "bm25"),
+}
+SECTIONS = VERSION_SECTIONS[FORMAT_VERSION]
+PREAMBLE = struct.Struct("<8sI")
+
+
+def _header(version):
+    # magic, version, flags (reserved), num_terms, num_chunks, then (offset, length) per section
+    return struct.Struct("<8sIIII" + "QQ" * len(VERSION_SECTIONS[version]))
+
+
+HEADER = _header(FORMAT_VERSION)
+ALIGNMENT = 8
+CHUNK_HASH_SIZE = 16
+
+
+def chunk_hash(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=CHUNK_HASH_SIZE).digest()
+
+
+def read_index_in_place(data):
+    """
+    The faiss index serialized in data, a uint8 array over a file mapping.
+    IO_FLAG_MMAP_IFC leaves flat vector storage pointing into data.
+    """
+    reader = faiss.ZeroCopyIOReader(faiss.swig_ptr(data), data.size)
+    index = faiss.read_index(reader, faiss.IO_FLAG_MMAP_IFC)
+    # keeps the mapping alive for as long as the index reads from it
+    index.referenced_objects = [data]
+    return index
+
+
+class ArtifactWriter:
+    """
+    Writes a document artifact in three calls, in order:
+    write_vocabulary(terms, idf), add_chunks(texts) any number of times,
+    finish(index, meta, bm25). Chunks are streamed to disk, never held together.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "wb")
+        self.f.write(b"\0" * HEADER.size)
+        self.sections = {}
+        self.num_terms = 0
+        self.chunk_offsets = None
+        self.chunk_hashes = []
+        self.chunks_start = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is not None:
+            self.f.close()
+            os.remove(self.path)
+
+    def _align(self):
+        padding = -self.f.tell() % ALIGNMENT
+        self.f.write(b"\0" * padding)
+        return self.f.tell()
+
+    def _section(self, name, data):
+        offset = self._align()
+        self.f.write(data)
+        self.sections[name] = (offset, len(data))
+
+    def write_vocabulary(self, terms, idf):
+        encoded = [term.encode("utf-8") for term in terms]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.uint32)
+        np.cumsum([len(term) for term in encoded], out=offsets[1:])
+        self.num_terms = len(encoded)
+        self._section("term_offsets", offsets.tobytes())
+        self._section("terms", b"".join(encoded))
+        self._section("idf", np.asarray(idf, dtype=np.float32).tobytes())
+        self.chunks_start = self._align()
+        self.chunk_offsets = [0]
+
+    def add_chunks(self, texts, hashes=None):
+        for i, text in enumerate(texts):
+            data = text.encode("utf-8")
+            self.f.write(data)
+            self.chunk_offsets.append(self.chunk_offsets[-1] + len(data))
+            self.chunk_hashes.append(hashes[i] if hashes is not None else chunk_hash(text))
+
+    def finish(self, index, meta=None, bm25=None):
+        self.sections["chunks"] = (self.chunks_start, self.chunk_offsets[-1])
+        self._section("chunk_offsets", np.array(self.chunk_offsets, dtype=np.uint64).tobytes())
+        self._section("index", faiss.serialize_index(index).tobytes())
+        self._section("chunk_hashes", b"".join(self.chunk_hashes))
+        self._section("meta", json.dumps(meta or {}).encode("utf-8"))
+        # an empty section means the writer had no bm25 index to store
+        self._section("bm25", bm25 or b"")
+
+        num_chunks = len(self.chunk_offsets) - 1
+        fields = [field for name in SECTIONS for field in self.sections[name]]
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, self.num_terms, num_chunks, *fields))
+        self.f.close()
+
+
+class MappedChunks(Sequence):
+    """
+    Chunk texts sliced out of the mapped blob on access.
+    """
+
+    def __init__(self, buffer, offsets, start):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.start = start
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("chunk index out of range")
+        begin = self.start + int(self.offsets[i])
+        end = self.start + int(self.offsets[i + 1])
+        return self.buffer[begin:end].decode("utf-8")
+
+    def nbytes(self):
+        return int(self.offsets[-1])
+
+    def prefetch(self):
+        """
+        Asks the kernel to read the whole mapping ahead (chunk texts and the
+        BM25 postings), so the first query does not fault pages in one by one.
+        """
+        if hasattr(mmap, "MADV_WILLNEED"):
+            self.buffer.madvise(mmap.MADV_WILLNEED)
+
+
+class DocumentArtifact:
+    """
+    Read-only view of an artifact file. The file is memory-mapped, so the
+    chunk texts, the BM25 postings and the vectors of flat and HNSW indexes
+    are read in place from the page cache, one copy however many worker
+    processes map it; only the vocabulary and the rest of the faiss index
+    are copied into process memory.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            # the mapping outlives the descriptor, and an os.replace of the path
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.buffer) < PREAMBLE.size:
+            raise ValueError(f"{path} is not a document artifact")
+        magic, version = PREAMBLE.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a document artifact")
+        if version not in VERSION_SECTIONS:
+            raise ValueError(f"{path} has unsupported artifact version {version}")
+        header = _header(version).unpack_from(self.buffer, 0)
+        self.version = version
+        self.num_terms, self.num_chunks = header[3:5]
+        fields = header[5:]
+        self.sections = {
+            name: (fields[2 * i], fields[2 * i + 1])
+            for i, name in enumerate(VERSION_SECTIONS[version])
+        }
+
+    def _array(self, name, dtype):
+        offset, length = self.sections[name]
+        dtype = np.dtype(dtype)
+        return np.frombuffer(self.buffer, dtype=dtype, count=length // dtype.itemsize, offset=offset)
+
+    def terms(self):
+        offsets = self._array("term_offsets", np.uint32)
+        start = self.sections["terms"][0]
+        blob = self.buffer[start:start + int(offsets[-1])]
+        return [
+            blob[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(self.num_terms)
+        ]
+
+    def idf(self):
+        return self._array("idf", np.float32)
+
+    def chunks(self):
+        return MappedChunks(self.buffer, self._array("chunk_offsets", np.uint64), self.sections["chunks"][0])
+
+    def index(self):
+        return read_index_in_place(self._array("index", np.uint8))
+
+    def chunk_hashes(self):
+        """
+        (num_chunks, CHUNK_HASH_SIZE) uint8 array, or None for version 1 files.
+        """
+        if "chunk_hashes" not in self.sections:
+            return None
+        return self._array("chunk_hashes", np.uint8).reshape(-1, CHUNK_HASH_SIZE)
+
+    def meta(self):
+        if "meta" not in self.sections:
+            return {}
+        offset, length = self.sections["meta"]
+        return json.loads(self.buffer[offset:offset + length].decode("utf-8"))
+
+    def bm25(self):
+        """
+        BM25Index reading straight from the mapping, or None for files
+        written before version 3.
+        """
+        offset, length = self.sections.get("bm25", (0, 0))
+        if not length:
+            return None
+        return BM25Index(self.buffer, offset)
@@ -0,0 +1,343 @@
+import os
+import heapq
+import math
+import struct
+from array import array
+from collections import Counter, defaultdict
+
+import numpy as np
+
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+# postings per compressed block; whole blocks are skipped without decoding
+BLOCK_SIZE = 128
+
+# num_terms, num_docs, num_blocks, reserved, avgdl, k1, b
+HEADER = struct.Struct("<IIIIdff")
+ALIGNMENT = 8
+END = 2 ** 62
+
+
+def encode_varints(values):
+    """
+    LEB128-style: 7 bits per byte, high bit set on every byte but the last.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    shifts = np.arange(5, dtype=np.uint64) * np.uint64(7)
+    groups = ((values[:, None] >> shifts) & np.uint64(127)).astype(np.uint8)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for i in range(1, 5):
+        lengths += values >= np.uint64(1 << (7 * i))
+    position = np.arange(5)
+    groups[position < (lengths - 1)[:, None]] |= 128
+    return groups[position < lengths[:, None]].tobytes()
+
+
+def decode_varints(data):
+    data = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(data < 128)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    lengths = ends - starts + 1
+    position = np.arange(len(data)) - np.repeat(starts, lengths)
+    parts = (data & 127).astype(np.int64) << (7 * position)
+    return np.add.reduceat(parts, starts) if len(starts) else parts
+
+
+def _term_weights(tfs, doc_lengths, idf, avgdl, k1, b):
+    norm = k1 * (1 - b + b * doc_lengths / avgdl)
+    return idf * tfs * (k1 + 1) / (tfs + norm)
+
+
+def _idf(doc_freq, num_docs):
+    return math.log(1 + (num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+
+
+class BM25Builder:
+    """
+    Collects postings one document (chunk) at a time; documents are
+    numbered in the order they are added.
+    """
+
+    def __init__(self):
+        self.postings = defaultdict(lambda: (array("I"), array("I")))
+        self.doc_lengths = array("I")
+
+    def add(self, tokens):
+        doc_id = len(self.doc_lengths)
+        self.doc_lengths.append(len(tokens))
+        for term, tf in Counter(tokens).items():
+            docs, tfs = self.postings[term]
+            docs.append(doc_id)
+            tfs.append(tf)
+
+    def to_bytes(self, k1=BM25_K1, b=BM25_B):
+        terms = sorted(self.postings)
+        num_docs = len(self.doc_lengths)
+        doc_lengths = np.array(self.doc_lengths, dtype=np.float64)
+        avgdl = float(doc_lengths.mean()) if num_docs and doc_lengths.sum() else 1.0
+
+        doc_freq, term_max, term_blocks = [], [], [0]
+        block_last, block_max, block_offsets = [], [], [0]
+        blob = bytearray()
+        for term in terms:
+            docs, tfs = (np.array(values, dtype=np.int64) for values in self.postings[term])
+            weights = _term_weights(tfs, doc_lengths[docs], _idf(len(docs), num_docs), avgdl, k1, b)
+            previous = 0
+            for start in range(0, len(docs), BLOCK_SIZE):
+                block = slice(start, start + BLOCK_SIZE)
+                deltas = np.diff(docs[block], prepend=previous)
+                blob += encode_varints(deltas) + encode_varints(tfs[block])
+                previous = int(docs[block][-1])
+                block_last.append(previous)
+                block_max.append(float(weights[block].max()))
+                block_offsets.append(len(blob))
+            doc_freq.append(len(docs))
+            term_max.append(float(weights.max()))
+            term_blocks.append(len(block_last))
+
+        encoded = [term.encode("utf-8") for term in terms]
+        term_offsets = np.zeros(len(encoded) + 1, dtype=np.uint32)
+        np.cumsum([len(term) for term in encoded], out=term_offsets[1:])
+        sections = [
+            term_offsets.tobytes(),
+            b"".join(encoded),
+            np.array(doc_freq, dtype=np.uint32).tobytes(),
+            np.array(term_max, dtype=np.float32).tobytes(),
+            np.array(term_blocks, dtype=np.uint32).tobytes(),
+            np.array(block_last, dtype=np.uint32).tobytes(),
+            np.array(block_max, dtype=np.float32).tobytes(),
+            np.array(block_offsets, dtype=np.uint64).tobytes(),
+            np.array(self.doc_lengths, dtype=np.uint32).tobytes(),
+            bytes(blob),
+        ]
+        out = bytearray(HEADER.pack(len(terms), num_docs, len(block_last), 0, avgdl, k1, b))
+        for section in sections:
+            out += b"\0" * (-len(out) % ALIGNMENT)
+            out += struct.pack("<Q", len(section))
+            out += section
+        return bytes(out)
+
+
+class _Cursor:
+    """
+    Position in one term's posting list; blocks are decoded only when the
+    cursor lands in them.
+    """
+
+    def __init__(self, index, term_id):
+        self.index = index
+        self.first_block = int(index.term_blocks[term_id])
+        self.last_block = int(index.term_blocks[term_id + 1])
+        self.doc_freq = int(index.doc_freq[term_id])
+        self.idf = _idf(self.doc_freq, index.num_docs)
+        self.max_score = float(index.term_max[term_id])
+        self.block = None
+        self.docs = self.weights = None
+        self.pos = 0
+        self.doc = END
+        self._load(self.first_block)
+
+    def _load(self, block):
+        if block >= self.last_block:
+            self.block = self.last_block
+            self.doc = END
+            return
+        index = self.index
+        count = min(BLOCK_SIZE, self.doc_freq - (block - self.first_block) * BLOCK_SIZE)
+        values = decode_varints(index.blob[int(index.block_offsets[block]):int(index.block_offsets[block + 1])])
+        previous = int(index.block_last[block - 1]) if block > self.first_block else 0
+        self.docs = previous + np.cumsum(values[:count])
+        tfs = values[count:].astype(np.float64)
+        self.weights = _term_weights(
+            tfs, index.doc_lengths[self.docs], self.idf, index.avgdl, index.k1, index.b
+        )
+        self.block = block
+        self.pos = 0
+        self.doc = int(self.docs[0])
+
+    def score(self):
+        return float(self.weights[self.pos])
+
+    def advance(self):
+        self.pos += 1
+        if self.pos < len(self.docs):
+            self.doc = int(self.docs[self.pos])
+        else:
+            self._load(self.block + 1)
+
+    def seek(self, target):
+        """
+        Moves to the first posting with doc >= target, skipping whole blocks.
+        """
+        if self.doc >= target:
+            return
+        block_last = self.index.block_last
+        if block_last[self.block] < target:
+            block = self.block + int(np.searchsorted(block_last[self.block:self.last_block], target))
+            self._load(block)
+            if self.doc >= target:
+                return
+        self.pos = int(np.searchsorted(self.docs, target))
+        if self.pos < len(self.docs):
+            self.doc = int(self.docs[self.pos])
+        else:
+            self._load(self.block + 1)
+
+    def score_at(self, doc):
+        self.seek(doc)
+        return self.score() if self.doc == doc else 0.0
+
+    def skip_blocks(self, others, threshold):
+        """
+        Skips blocks in which no document can beat threshold, even with the
+        best possible score from every other term (others).
+        """
+        block = self.block
+        while block < self.last_block and self.index.block_max[block] + others <= threshold:
+            block += 1
+        if block != self.block:
+            self._load(block)
+
+
+class BM25Index:
+    """
+    Read-only BM25 index over a serialized buffer (bytes or a slice of the
+    document artifact's mmap); arrays are views, nothing is unpacked up front.
+    """
+
+    def __init__(self, buffer, offset=0):
+        (self.num_terms, self.num_docs, _, _, self.avgdl, self.k1, self.b) = HEADER.unpack_from(buffer, offset)
+        position = offset + HEADER.size
+        sections = []
+        for _ in range(10):
+            position += -(position - offset) % ALIGNMENT
+            (length,) = struct.unpack_from("<Q", buffer, position)
+            position += 8
+            sections.append((position, length))
+            position += length
+        self.buffer = buffer
+
+        def view(i, dtype):
+            start, length = sections[i]
+            return np.frombuffer(buffer, dtype=dtype, count=length // np.dtype(dtype).itemsize, offset=start)
+
+        self.term_offsets = view(0, np.uint32)
+        self.terms_start = sections[1][0]
+        self.doc_freq = view(2, np.uint32)
+        self.term_max = view(3, np.float32)
+        self.term_blocks = view(4, np.uint32)
+        self.block_last = view(5, np.uint32)
+        self.block_max = view(6, np.float32)
+        self.block_offsets = view(7, np.uint64)
+        self.doc_lengths = view(8, np.uint32).astype(np.float64)
+        self.blob = memoryview(buffer)[sections[9][0]:sections[9][0] + sections[9][1]]
+
+    @classmethod
+    def from_texts(cls, token_lists):
+        builder = BM25Builder()
+        for tokens in token_lists:
+            builder.add(tokens)
+        return cls(builder.to_bytes())
+
+    def _term(self, i):
+        start = self.terms_start + int(self.term_offsets[i])
+        end = self.terms_start + int(self.term_offsets[i + 1])
+        return bytes(self.buffer[start:end]).decode("utf-8")
+
+    def terms(self):
+        """
+        Every term, sorted; a term's position is its term_id.
+        """
+        return [self._term(i) for i in range(self.num_terms)]
+
+    def postings(self, term_id):
+        """
+        (docs, tfs) of every document containing the term, in doc order.
+        """
+        first, last = int(self.term_blocks[term_id]), int(self.term_blocks[term_id + 1])
+        values = decode_varints(self.blob[int(self.block_offsets[first]):int(self.block_offsets[last])])
+        # each block holds its doc gaps, then its tfs
+        counts = np.minimum(BLOCK_SIZE, int(self.doc_freq[term_id]) - np.arange(last - first) * BLOCK_SIZE)
+        starts = np.repeat(np.cumsum(2 * counts) - 2 * counts, 2 * counts)
+        is_gap = np.arange(len(values)) - starts < np.repeat(counts, 2 * counts)
+        # gaps continue from the previous block's last doc, so they sum to doc ids
+        return np.cumsum(values[is_gap]), values[~is_gap]
+
+    def term_id(self, term):
+        # terms are stored sorted: binary search instead of building a dict on load
+        low, high = 0, self.num_terms
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(middle) < term:
+                low = middle + 1
+            else:
+                high = middle
+        return low if low < self.num_terms and self._term(low) == term else None
+
+    def _cursors(self, tokens):
+        term_ids = (self.term_id(term) for term in set(tokens))
+        return [_Cursor(self, term_id) for term_id in term_ids if term_id is not None]
+
+    def max_query_score(self, tokens):
+        """
+        Upper bound of any document's score for tokens, for normalizing.
+        """
+        return sum(cursor.max_score for cursor in self._cursors(tokens))
+
+    def search(self, tokens, top_k=10, allowed=None):
+        """
+        Best-first [(doc, score)] by MaxScore: once the top_k threshold
+        exceeds the combined upper bound of the lowest-scoring terms, those
+        terms no longer produce candidates and are only probed (skipping
+        blocks) for documents that can still make the cut. Blocks whose
+        maximum cannot beat the threshold are skipped without decoding.
+        allowed is an optional boolean mask over documents.
+        """
+        cursors = sorted(self._cursors(tokens), key=lambda cursor: cursor.max_score)
+        if not cursors or top_k <= 0:
+            return []
+        # bounds[i]: the most cursors[0..i] can add together
+        bounds = list(np.cumsum([cursor.max_score for cursor in cursors]))
+        heap = []
+        threshold = 0.0
+        essential = 0
+        while essential < len(cursors):
+            if len(heap) == top_k:
+                for cursor in cursors[essential:]:
+                    cursor.skip_blocks(bounds[-1] - cursor.max_score, threshold)
+            doc = min(cursor.doc for cursor in cursors[essential:])
+            if doc == END:
+                break
+            score = 0.0
+            for cursor in cursors[essential:]:
+                if cursor.doc == doc:
+                    score += cursor.score()
+                    cursor.advance()
+            if allowed is not None and not allowed[doc]:
+                continue
+            for i in range(essential - 1, -1, -1):
+                if score + bounds[i] <= threshold:
+                    break
+                score += cursors[i].score_at(doc)
+            if len(heap) < top_k:
+                heapq.heappush(heap, (score, -doc))
+            elif score > threshold:
+                heapq.heapreplace(heap, (score, -doc))
+            else:
+                continue
+            if len(heap) == top_k:
+                threshold = heap[0][0]
+                while essential < len(cursors) and bounds[essential] <= threshold:
+                    essential += 1
+        return [(-doc, score) for score, doc in sorted(heap, reverse=True)]
+
+    def score(self, tokens, docs):
+        """
+        BM25 scores of the given documents (any order).
+        """
+        order = np.argsort(docs)
+        scores = np.zeros(len(docs), dtype=np.float64)
+        for cursor in self._cursors(tokens):
+            for i in order:
+                scores[i] += cursor.score_at(int(docs[i]))
+        return scores
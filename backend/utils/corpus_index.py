@@ -0,0 +1,501 @@
+import os
+import json
+import mmap
+import argparse
+from collections import Counter
+from contextlib import contextmanager
+from uuid import uuid4
+
+import faiss
+import numpy as np
+from scipy import sparse
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from utils.ann_index import index_nbytes, new_index, training_rows, training_size
+from utils.artifact_format import read_index_in_place
+from utils.atomic_file import atomic_path, write_json
+from utils.bm25 import BM25_B, BM25_K1, _idf, _term_weights
+from utils.embed_store import (
+    EMBED_BATCH_SIZE, INDEX_CACHE_MAX_MB, RETRIEVAL_MIN_SCORE, RETRIEVAL_MODE, VECTOR_DIR,
+    SimpleVectorizer, artifact_paths, build_bm25, list_documents, load_document,
+    rank_chunks_batch, vectorizer_from_arrays,
+)
+from utils.index_cache import INDEX_GENERATION_PATH, IndexCache, bump_generation, file_signature
+
+# one vectorizer space and one faiss index over the chunks of every indexed
+# document, kept on disk as segments: the one built over the whole library, in
+# the ann_index tier for its chunk count, and the ones added as documents were
+# indexed since, searched together and merged. Each document's chunks are a
+# contiguous range of rows in one segment; searches only visit the rows of the
+# documents queried.
+CORPUS_DIR = os.getenv("CORPUS_DIR", os.path.join(VECTOR_DIR, "corpus"))
+MANIFEST_NAME = "corpus.json"
+CORPUS_MAX_FEATURES = int(os.getenv("CORPUS_MAX_FEATURES", "2000"))
+# the library is refitted into one segment once the chunks added or replaced
+# since the vocabulary was fitted reach this fraction of the ones it was fitted
+# on, or there are CORPUS_MAX_SEGMENTS segments
+CORPUS_REFIT_FRACTION = float(os.getenv("CORPUS_REFIT_FRACTION", "0.3"))
+CORPUS_MAX_SEGMENTS = int(os.getenv("CORPUS_MAX_SEGMENTS", "8"))
+# the mapped corpus index stays resident within its own budget
+CORPUS_CACHE_MAX_MB = float(os.getenv("CORPUS_CACHE_MAX_MB", str(INDEX_CACHE_MAX_MB)))
+corpus_cache = IndexCache(max_entries=1, max_bytes=int(CORPUS_CACHE_MAX_MB * 1024 * 1024))
+
+
+def _manifest_path():
+    return os.path.join(CORPUS_DIR, MANIFEST_NAME)
+
+
+def _segment_path(segment):
+    return os.path.join(CORPUS_DIR, f"{segment}.index")
+
+
+def _signature(file_name):
+    # as the manifest stores it, lists rather than tuples
+    signature = file_signature(artifact_paths(file_name))
+    return None if signature is None else [list(part) for part in signature]
+
+
+class QueryPostings:
+    """
+    BM25 over the chunks of the documents one search is restricted to, with
+    idf and average length taken over all of them, scored exactly from each
+    document's stored postings (bm25s, one BM25Index per document).
+    """
+
+    def __init__(self, bm25s):
+        self.bm25s = bm25s
+        self.num_chunks = sum(bm25.num_docs for bm25 in bm25s)
+        total = sum(float(bm25.doc_lengths.sum()) for bm25 in bm25s)
+        self.avgdl = total / self.num_chunks if total else 1.0
+        self._weights = {}
+
+    def weights(self, term):
+        """
+        [(document position, chunk ids, weights)] of every document with term.
+        """
+        if term not in self._weights:
+            hits = []
+            for position, bm25 in enumerate(self.bm25s):
+                term_id = bm25.term_id(term)
+                if term_id is not None:
+                    hits.append((position, bm25, term_id))
+            doc_freq = sum(int(bm25.doc_freq[term_id]) for _, bm25, term_id in hits)
+            weights = []
+            if doc_freq:
+                idf = _idf(doc_freq, self.num_chunks)
+                for position, bm25, term_id in hits:
+                    docs, tfs = bm25.postings(term_id)
+                    weights.append((position, docs, _term_weights(
+                        tfs.astype(np.float64), bm25.doc_lengths[docs], idf, self.avgdl, BM25_K1, BM25_B
+                    )))
+            self._weights[term] = weights
+        return self._weights[term]
+
+    def bound(self, tokens):
+        # the best score any chunk of these documents can reach, for normalizing
+        return sum(
+            max((float(term_weights.max()) for _, _, term_weights in self.weights(term)), default=0.0)
+            for term in set(tokens)
+        )
+
+
+class SegmentBM25:
+    """
+    The BM25 side of rank_chunks_batch for one segment: QueryPostings over
+    the chunks of members, (document position, first row) of the queried
+    documents stored in the segment, numbered by segment row. Only those
+    chunks are ever scored.
+    """
+
+    def __init__(self, postings, members):
+        self.postings = postings
+        self.members = sorted(members, key=lambda member: member[1])
+        lengths = [postings.bm25s[position].num_docs for position, _ in self.members]
+        self.offsets = {
+            position: offset for (position, _), offset in zip(self.members, np.cumsum([0] + lengths))
+        }
+        self.starts = np.array([start for _, start in self.members], dtype=np.int64)
+        self.rows = np.concatenate(
+            [np.arange(start, start + length) for (_, start), length in zip(self.members, lengths)]
+        ) if self.members else np.zeros(0, dtype=np.int64)
+        self._last = (None, None)
+
+    def _scores(self, tokens):
+        key = frozenset(tokens)
+        if self._last[0] != key:
+            scores = np.zeros(len(self.rows))
+            for term in key:
+                for position, docs, weights in self.postings.weights(term):
+                    if position in self.offsets:
+                        scores[self.offsets[position] + docs] += weights
+            self._last = (key, scores)
+        return self._last[1]
+
+    def max_query_score(self, tokens):
+        return self.postings.bound(tokens)
+
+    def search(self, tokens, top_k=10):
+        scores = self._scores(tokens)
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        ranked = sorted(candidates.tolist(), key=lambda i: (-scores[i], self.rows[i]))
+        return [(int(self.rows[i]), float(scores[i])) for i in ranked]
+
+    def score(self, tokens, rows):
+        scores = self._scores(tokens)
+        rows = np.asarray(rows, dtype=np.int64)
+        member = np.searchsorted(self.starts, rows, side="right") - 1
+        offsets = np.array([self.offsets[self.members[i][0]] for i in member], dtype=np.int64)
+        return scores[offsets + rows - self.starts[member]]
+
+
+def _selector(ranges, num_rows):
+    """
+    faiss IDSelector for the rows in ranges ([start, end) pairs), and the
+    arrays it reads from, to be kept alive while it is in use.
+    """
+    if len(ranges) == 1:
+        return faiss.IDSelectorRange(*ranges[0]), None
+    mask = np.zeros(num_rows, dtype=bool)
+    for start, end in ranges:
+        mask[start:end] = True
+    bits = np.packbits(mask, bitorder="little")
+    return faiss.IDSelectorBitmap(len(bits), faiss.swig_ptr(bits)), bits
+
+
+class CorpusIndex:
+    """
+    The mapped segments of the corpus index with the shared vectorizer.
+    documents maps each file name to its (segment, start, end, signature).
+    """
+
+    def __init__(self, vectorizer, segments, documents):
+        self.vectorizer = vectorizer
+        self.segments = segments
+        self.documents = documents
+
+    def nbytes(self):
+        return (
+            sum(index_nbytes(index, mapped=True) for index in self.segments.values())
+            + len(self.vectorizer.vocabulary) * 100 + len(self.documents) * 200
+        )
+
+    def covers(self, file_names):
+        """
+        Whether every one of file_names that is indexed is in the corpus
+        index as it is on disk now.
+        """
+        for name in file_names:
+            signature = _signature(name)
+            if signature is not None and (name not in self.documents or self.documents[name][3] != signature):
+                return False
+        return True
+
+    def search_batch(self, queries, file_names, top_k=6, min_score=RETRIEVAL_MIN_SCORE,
+                     mode=RETRIEVAL_MODE, nprobe=None, ef_search=None):
+        """
+        Globally ranked top_k chunks of file_names for each of queries, as
+        lists of {file_name, chunk_id, text, score}: each segment holding
+        some of the documents is searched once for all the queries,
+        restricted to their rows, and the results are merged.
+        """
+        names = [name for name in dict.fromkeys(file_names) if name in self.documents]
+        loaded = [load_document(name) for name in names]
+        names = [name for name, document in zip(names, loaded) if document is not None]
+        loaded = [document for document in loaded if document is not None]
+        if not queries or not names:
+            return [[] for _ in queries]
+
+        postings = None
+        if mode != "vector":
+            bm25s = [
+                document[3] if document[3] is not None else build_bm25(document[1]) for document in loaded
+            ]
+            postings = QueryPostings(bm25s)
+
+        merged = [[] for _ in queries]
+        for segment, index in self.segments.items():
+            members = [
+                (position, self.documents[name][1], self.documents[name][2])
+                for position, name in enumerate(names) if self.documents[name][0] == segment
+            ]
+            if not members:
+                continue
+            selector, bits = _selector([(start, end) for _, start, end in members], index.ntotal)
+            bm25 = SegmentBM25(postings, [(position, start) for position, start, _ in members]) if postings else None
+            batch = rank_chunks_batch(
+                queries, index, self.vectorizer, bm25, top_k, mode,
+                selector=selector, nprobe=nprobe, ef_search=ef_search,
+            )
+            starts = np.array([start for _, start, _ in members])
+            for results, ranked in zip(merged, batch):
+                for row, score in ranked:
+                    position, start, _ = members[int(np.searchsorted(starts, row, side="right")) - 1]
+                    results.append((score, position, row - start))
+
+        return [
+            [
+                {"file_name": names[position], "chunk_id": chunk_id,
+                 "text": loaded[position][1][chunk_id], "score": score}
+                for score, position, chunk_id in sorted(results, key=lambda r: (-r[0], r[1], r[2]))[:top_k]
+                if score >= min_score
+            ]
+            for results in merged
+        ]
+
+
+def _document_vectors(vectorizer, bm25, num_chunks):
+    """
+    Sparse L2-normalized rows of a document's chunks in vectorizer's space.
+    Term counts are decoded from the document's BM25 postings (BM25 and the
+    vectorizer share a tokenizer), reading only the vocabulary's terms, so
+    chunks are never tokenized again.
+    """
+    rows, columns, counts = [], [], []
+    for term, column in vectorizer.vocabulary.items():
+        term_id = bm25.term_id(term)
+        if term_id is None:
+            continue
+        docs, tfs = bm25.postings(term_id)
+        rows.append(docs)
+        columns.append(np.full(len(docs), column))
+        counts.append(tfs)
+    shape = (num_chunks, len(vectorizer.vocabulary))
+    if rows:
+        counts = sparse.csr_matrix(
+            (np.concatenate(counts).astype(np.float64), (np.concatenate(rows), np.concatenate(columns))),
+            shape=shape,
+        )
+    else:
+        counts = sparse.csr_matrix(shape, dtype=np.float64)
+    vectors = vectorizer._weight(counts, bm25.doc_lengths, vectorizer._idf_array())
+    norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+    return sparse.diags(1 / np.maximum(norms, 1e-12)).dot(vectors).astype(np.float32).tocsr()
+
+
+def _document_postings(file_name):
+    document = load_document(file_name)
+    if document is None:
+        return None
+    _, chunks, _, bm25 = document
+    return bm25 if bm25 is not None else build_bm25(chunks)
+
+
+def _write_segment(vectorizer, names, bm25s, index_type=None):
+    """
+    Builds a segment over the chunks of names, in the ann_index tier for
+    their count, and writes it. Returns (segment, {name: (start, end)}).
+    """
+    sizes = [bm25.num_docs for bm25 in bm25s]
+    bounds = np.cumsum([0] + sizes)
+    total = int(bounds[-1])
+    d = len(vectorizer.vocabulary)
+    index = new_index(total, d) if index_type is None else new_index(total, d, index_type)
+    if not index.is_trained:
+        sample = training_rows(total, training_size(index))
+        parts = []
+        for i, bm25 in enumerate(bm25s):
+            local = sample[(sample >= bounds[i]) & (sample < bounds[i + 1])] - bounds[i]
+            if len(local):
+                parts.append(_document_vectors(vectorizer, bm25, sizes[i])[local].toarray())
+        index.train(np.ascontiguousarray(np.vstack(parts)))
+    for bm25, size in zip(bm25s, sizes):
+        vectors = _document_vectors(vectorizer, bm25, size)
+        for start in range(0, size, EMBED_BATCH_SIZE):
+            index.add(np.ascontiguousarray(vectors[start:start + EMBED_BATCH_SIZE].toarray()))
+
+    segment = uuid4().hex
+    with atomic_path(_segment_path(segment)) as tmp:
+        faiss.write_index(index, tmp)
+    ranges = {name: (int(bounds[i]), int(bounds[i + 1])) for i, name in enumerate(names)}
+    return segment, ranges
+
+
+def _read_manifest():
+    try:
+        with open(_manifest_path(), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(manifest, previous):
+    write_json(_manifest_path(), manifest)
+    # segments no longer listed; workers still mapping one keep reading it until they reload
+    if previous is not None:
+        for segment in set(previous["segments"]) - set(manifest["segments"]):
+            try:
+                os.remove(_segment_path(segment))
+            except OSError:
+                pass
+    bump_generation(INDEX_GENERATION_PATH)
+
+
+@contextmanager
+def _corpus_lock():
+    # ingest jobs in any process and warm-ups in every web worker update the corpus
+    os.makedirs(CORPUS_DIR, exist_ok=True)
+    with open(os.path.join(CORPUS_DIR, "lock"), "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _build(names, previous, index_type=None):
+    """
+    Fits the vocabulary over every document in names and writes them as
+    one segment.
+    """
+    names = [name for name in names if _signature(name) is not None]
+    bm25s = [_document_postings(name) for name in names]
+    names = [name for name, bm25 in zip(names, bm25s) if bm25 is not None]
+    bm25s = [bm25 for bm25 in bm25s if bm25 is not None]
+
+    doc_freq = Counter()
+    for bm25 in bm25s:
+        doc_freq.update(dict(zip(bm25.terms(), bm25.doc_freq.tolist())))
+    num_chunks = sum(bm25.num_docs for bm25 in bm25s)
+    vectorizer = SimpleVectorizer(max_features=CORPUS_MAX_FEATURES)
+    vectorizer.fit_doc_freq(doc_freq, num_chunks)
+    terms = sorted(vectorizer.vocabulary, key=vectorizer.vocabulary.get)
+
+    manifest = {
+        "terms": terms,
+        "idf": [float(value) for value in vectorizer._idf_array()],
+        "fitted_chunks": num_chunks,
+        "changed_chunks": 0,
+        "segments": {},
+        "documents": {},
+    }
+    if names:
+        segment, ranges = _write_segment(vectorizer, names, bm25s, index_type)
+        manifest["segments"][segment] = num_chunks
+        for name in names:
+            manifest["documents"][name] = [segment, *ranges[name], _signature(name)]
+    _write_manifest(manifest, previous)
+    return manifest
+
+
+def sync_corpus_index(rebuild=False, index_type=None):
+    """
+    Brings the corpus index up to date with the indexed documents, off the
+    request path (ingest jobs, warm-up, the command line). Documents added
+    or re-indexed since are written as a new segment in the existing
+    vocabulary; rows of replaced or deleted documents are dropped from the
+    manifest, and a segment left without any is deleted. The library is
+    refitted into a single segment when there is no corpus index yet,
+    when rebuild is set, or past CORPUS_REFIT_FRACTION / CORPUS_MAX_SEGMENTS.
+    Returns True if anything changed.
+    """
+    with _corpus_lock():
+        manifest = _read_manifest()
+        current = {name: _signature(name) for name in list_documents()}
+        current = {name: signature for name, signature in current.items() if signature is not None}
+        if manifest is None or rebuild:
+            _build(sorted(current), manifest, index_type)
+            return True
+
+        documents = manifest["documents"]
+        live = {name: entry for name, entry in documents.items() if current.get(name) == entry[3]}
+        added = sorted(name for name in current if name not in live)
+        if not added and len(live) == len(documents):
+            return False
+
+        replaced = sum(entry[2] - entry[1] for name, entry in documents.items() if name not in live)
+        bm25s = [_document_postings(name) for name in added]
+        added = [name for name, bm25 in zip(added, bm25s) if bm25 is not None]
+        bm25s = [bm25 for bm25 in bm25s if bm25 is not None]
+        changed = manifest["changed_chunks"] + replaced + sum(bm25.num_docs for bm25 in bm25s)
+        if (changed > CORPUS_REFIT_FRACTION * max(manifest["fitted_chunks"], 1)
+                or len(manifest["segments"]) + bool(added) > CORPUS_MAX_SEGMENTS):
+            _build(sorted(current), manifest, index_type)
+            return True
+
+        updated = dict(manifest, changed_chunks=changed, documents=live)
+        if added:
+            vectorizer = vectorizer_from_arrays(manifest["terms"], manifest["idf"])
+            segment, ranges = _write_segment(vectorizer, added, bm25s)
+            for name in added:
+                updated["documents"][name] = [segment, *ranges[name], current[name]]
+            updated["segments"] = dict(manifest["segments"], **{segment: sum(b.num_docs for b in bm25s)})
+        in_use = {entry[0] for entry in updated["documents"].values()}
+        updated["segments"] = {
+            segment: rows for segment, rows in updated["segments"].items() if segment in in_use
+        }
+        _write_manifest(updated, manifest)
+        return True
+
+
+def _map_segment(segment):
+    with open(_segment_path(segment), "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return read_index_in_place(np.frombuffer(buffer, dtype=np.uint8))
+
+
+def _load_corpus_index():
+    for _ in range(2):
+        manifest = _read_manifest()
+        if manifest is None:
+            return None, 0
+        try:
+            segments = {segment: _map_segment(segment) for segment in manifest["segments"]}
+        except FileNotFoundError:
+            # replaced by a sync since the manifest was read; read the new one
+            continue
+        index = CorpusIndex(
+            vectorizer_from_arrays(manifest["terms"], manifest["idf"]),
+            segments,
+            {name: tuple(entry) for name, entry in manifest["documents"].items()},
+        )
+        return index, index.nbytes()
+    return None, 0
+
+
+def get_corpus_index():
+    """
+    The corpus index as last synced, mapped from disk; None if there is
+    none yet. Never builds it.
+    """
+    return corpus_cache.get("corpus", file_signature([_manifest_path()]), _load_corpus_index)
+
+
+def refresh_corpus_index():
+    """
+    Maps the corpus index again after a sync, in processes that use it.
+    """
+    if corpus_cache.keys():
+        get_corpus_index()
+
+
+def query_corpus_batch(queries, file_names, top_k=6, nprobe=None, ef_search=None):
+    """
+    CorpusIndex.search_batch over the corpus index, or None if it does not
+    cover file_names yet (the caller searches them one by one instead).
+    """
+    index = get_corpus_index()
+    if index is None or not index.covers(file_names):
+        return None
+    return index.search_batch(queries, file_names, top_k=top_k, nprobe=nprobe, ef_search=ef_search)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Update the corpus index over every indexed document")
+    parser.add_argument("--rebuild", action="store_true", help="refit it from scratch")
+    args = parser.parse_args(argv)
+    changed = sync_corpus_index(rebuild=args.rebuild)
+    manifest = _read_manifest() or {"documents": {}, "segments": {}}
+    print(f"{'updated' if changed else 'up to date'}: {len(manifest['documents'])} documents "
+          f"in {len(manifest['segments'])} segments")
+
+
+if __name__ == "__main__":
+    main()
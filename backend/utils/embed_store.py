@@ -2,13 +2,46 @@ import os
 import re
 import json
 import math
+import shutil
+import tempfile
 import textwrap
+import time
 import faiss
+import numpy as np
 from collections import Counter
+from scipy import sparse
+
+from utils.ann_index import (
+    index_nbytes, new_index, rebuild_index, search_params, stores_exact_vectors, training_rows, training_size,
+)
+from utils.artifact_format import ArtifactWriter, DocumentArtifact, MappedChunks, chunk_hash
+from utils.atomic_file import atomic_path, write_text
+from utils.bm25 import BM25Builder, BM25Index
+from utils.index_cache import INDEX_GENERATION_PATH, IndexCache, bump_generation, file_signature
+from utils.metrics import INDEX_LOAD_SECONDS, INDEX_LOADS, span
+from utils.suggestions import PhraseCollector, retrievable
+from utils.tokens import estimate_tokens, tokenize
 
 VECTOR_DIR = "vector_db"
+# one binary file per document; see utils/artifact_format.py
+ARTIFACT_SUFFIX = ".rdoc"
 if not os.path.exists(VECTOR_DIR):
     os.makedirs(VECTOR_DIR)
+# sha256 of an uploaded file -> a document indexed from it, one small file per
+# hash, so ingest jobs finishing together never rewrite each other's entries
+SOURCE_HASH_DIR = os.path.join(VECTOR_DIR, "source_hashes")
+# written once the documents indexed before SOURCE_HASH_DIR existed are in it
+SOURCE_HASH_INDEX_COMPLETE = ".complete"
+
+# loaded indexes stay resident between queries, keyed by file name + artifact mtimes
+INDEX_CACHE_MAX_ENTRIES = int(os.getenv("INDEX_CACHE_MAX_ENTRIES", "32"))
+INDEX_CACHE_MAX_MB = float(os.getenv("INDEX_CACHE_MAX_MB", "128"))
+document_cache = IndexCache(
+    max_entries=INDEX_CACHE_MAX_ENTRIES,
+    max_bytes=int(INDEX_CACHE_MAX_MB * 1024 * 1024),
+)
+# suggestion candidates per document, read from the artifact metadata
+suggestion_cache = IndexCache(max_entries=INDEX_CACHE_MAX_ENTRIES * 4)
 
 
 class SimpleVectorizer:
@@ -16,75 +49,147 @@ class SimpleVectorizer:
         self.max_features = max_features
         self.vocabulary = {}
         self.idf_values = {}
+        self.idf = np.zeros(0, dtype=np.float64)
+
+    def set_vocabulary(self, vocabulary, idf_values):
+        """
+        Installs a fitted or loaded vocabulary with its idf values, and the
+        idf array (by column) that transform weights with.
+        """
+        self.vocabulary = vocabulary
+        self.idf_values = idf_values
+        self.idf = np.zeros(len(vocabulary), dtype=np.float64)
+        for word, idx in vocabulary.items():
+            self.idf[idx] = idf_values.get(word, 0)
 
     def _tokenize(self, text):
-        text = text.lower()
-        words = re.findall(r'\b[a-zA-Z]{2,}\b', text)
-        stop_words = {
-            'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for',
-            'of', 'with', 'by', 'is', 'are', 'was', 'were', 'be', 'been', 'have',
-            'has', 'had', 'do', 'does', 'did', 'will', 'would', 'could', 'should',
-            'this', 'that', 'these', 'those', 'i', 'you', 'he', 'she', 'it', 'we', 'they'
-        }
-        return [word for word in words if word not in stop_words and len(word) > 2]
+        return tokenize(text)
 
-    def fit_transform(self, documents):
-        tokenized_docs = [self._tokenize(doc) for doc in documents]
-        word_freq = Counter()
-        for tokens in tokenized_docs:
-            word_freq.update(set(tokens))
+    def _count_matrix(self, documents, term_ids, grow):
+        """
+        One pass over the documents: CSR term-count matrix plus the number
+        of (non stop word) tokens in each document.
+        """
+        indptr = [0]
+        indices = []
+        token_totals = []
+        for doc in documents:
+            tokens = self._tokenize(doc)
+            for word in tokens:
+                idx = term_ids.get(word)
+                if idx is None:
+                    if not grow:
+                        continue
+                    idx = term_ids[word] = len(term_ids)
+                indices.append(idx)
+            indptr.append(len(indices))
+            token_totals.append(len(tokens))
+
+        indptr = np.array(indptr, dtype=np.int64)
+        token_totals = np.array(token_totals, dtype=np.int64)
+        counts = sparse.csr_matrix(
+            (np.ones(len(indices), dtype=np.float64), np.array(indices, dtype=np.int64), indptr),
+            shape=(len(documents), len(term_ids)),
+        )
+        counts.sum_duplicates()
+        return counts, token_totals
+
+    def _weight(self, counts, token_totals, idf):
+        rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+        tf = counts.data / np.maximum(token_totals, 1)[rows]
+        return sparse.csr_matrix(
+            ((tf * idf[counts.indices]).astype(np.float32), counts.indices, counts.indptr),
+            shape=counts.shape,
+        )
+
+    def _idf_array(self):
+        return self.idf
+
+    def fit_transform_sparse(self, documents):
+        term_ids = {}
+        counts, token_totals = self._count_matrix(documents, term_ids, grow=True)
 
-        most_common = word_freq.most_common(self.max_features)
-        self.vocabulary = {word: idx for idx, (word, _) in enumerate(most_common)}
+        # document frequency per term; stable sort keeps first-seen order on ties
+        doc_freq = np.diff(counts.tocsc().indptr)
+        top = np.argsort(-doc_freq, kind="stable")[:self.max_features]
+        terms = list(term_ids)
 
         num_docs = len(documents)
-        for word in self.vocabulary:
-            doc_count = sum(1 for tokens in tokenized_docs if word in tokens)
-            self.idf_values[word] = math.log(num_docs / (doc_count + 1))
-
-        vectors = []
-        for tokens in tokenized_docs:
-            vector = [0.0] * len(self.vocabulary)
-            token_counts = Counter(tokens)
-            total_tokens = len(tokens)
-            for word, count in token_counts.items():
-                if word in self.vocabulary:
-                    tf = count / total_tokens
-                    idf = self.idf_values[word]
-                    vector[self.vocabulary[word]] = tf * idf
-            vectors.append(vector)
-        return vectors
+        self.set_vocabulary(
+            {terms[col]: idx for idx, col in enumerate(top)},
+            {terms[col]: math.log(num_docs / (int(doc_freq[col]) + 1)) for col in top},
+        )
+
+        counts = counts[:, top].tocsr()
+        counts.sort_indices()
+        return self._weight(counts, token_totals, self._idf_array())
+
+    def fit_doc_freq(self, doc_freq, num_docs):
+        """
+        Fits vocab/idf from a Counter of document frequencies (in first-seen
+        order), for callers that stream documents instead of holding them.
+        """
+        most_common = doc_freq.most_common(self.max_features)
+        self.set_vocabulary(
+            {word: idx for idx, (word, _) in enumerate(most_common)},
+            {word: math.log(num_docs / (count + 1)) for word, count in most_common},
+        )
+
+    def fit_transform(self, documents):
+        return self.fit_transform_sparse(documents).toarray()
+
+    def transform_sparse(self, documents):
+        counts, token_totals = self._count_matrix(documents, self.vocabulary, grow=False)
+        return self._weight(counts, token_totals, self._idf_array())
 
     def transform(self, documents):
-        vectors = []
-        for doc in documents:
-            tokens = self._tokenize(doc)
-            vector = [0.0] * len(self.vocabulary)
-            token_counts = Counter(tokens)
-            total_tokens = len(tokens) if tokens else 1
-            for word, count in token_counts.items():
-                if word in self.vocabulary:
-                    tf = count / total_tokens
-                    idf = self.idf_values.get(word, 0)
-                    vector[self.vocabulary[word]] = tf * idf
-            vectors.append(vector)
-        return vectors
+        return self.transform_sparse(documents).toarray()
 
 
-def embed_and_store(text, file_name):
-    section_pattern = r"(?:\n|^)(\d[\d\.]*[\)\.]?|Step \d+|Section \d+)[^\n]*\n"
-    sections = re.split(section_pattern, text)
+SECTION_PATTERN = r"(?:\n|^)(\d[\d\.]*[\)\.]?|Step \d+|Section \d+)[^\n]*\n"
+SECTION_RE = re.compile(SECTION_PATTERN)
+CHUNK_WIDTH = 450
+# a section longer than this is wrapped and emitted before it ends
+MAX_CARRY_CHARS = 64 * 1024
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))
+
+# chunks scoring below RETRIEVAL_MIN_SCORE never reach the prompt, and at
+# most RETRIEVAL_TOKEN_BUDGET estimated tokens of context are kept
+RETRIEVAL_MIN_SCORE = float(os.getenv("RETRIEVAL_MIN_SCORE", "0.05"))
+RETRIEVAL_TOKEN_BUDGET = int(os.getenv("RETRIEVAL_TOKEN_BUDGET", "1500"))
 
+# how chunks are ranked: "vector" (cosine over TF-IDF), "bm25" (BM25 over the
+# inverted index, divided by the query's best possible score) or "hybrid"
+# (HYBRID_ALPHA * cosine + (1 - HYBRID_ALPHA) * normalized BM25), so scores
+# stay in [0, 1] in every mode
+RETRIEVAL_MODES = ("vector", "bm25", "hybrid")
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "vector").lower()
+if RETRIEVAL_MODE not in RETRIEVAL_MODES:
+    raise ValueError(f"RETRIEVAL_MODE must be one of {', '.join(RETRIEVAL_MODES)}")
+HYBRID_ALPHA = float(os.getenv("HYBRID_ALPHA", "0.5"))
+# each retriever proposes this many times top_k candidates for fusion
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "4"))
+
+# re-indexing a revised document keeps its vocabulary and the vectors of unchanged
+# chunks while at most this fraction of the chunks changed since the vocabulary was
+# fitted, and no new term would make the vocabulary; otherwise it is rebuilt
+REINDEX_MAX_CHANGED = float(os.getenv("REINDEX_MAX_CHANGED", "0.3"))
+
+
+def _wrap(text):
+    return textwrap.wrap(text, width=CHUNK_WIDTH, break_long_words=False, break_on_hyphens=False)
+
+
+def _chunks_from_sections(sections):
     structured_chunks = []
     i = 0
     while i < len(sections):
-        if i < len(sections) and re.match(section_pattern, sections[i]):
+        if i < len(sections) and SECTION_RE.match(sections[i]):
             heading = sections[i].strip()
             if i + 1 < len(sections):
                 content = sections[i + 1].strip()
                 full_text = f"{heading}: {content}"
-                chunks = textwrap.wrap(full_text, width=450, break_long_words=False, break_on_hyphens=False)
-                structured_chunks.extend(chunks)
+                structured_chunks.extend(_wrap(full_text))
                 i += 2
             else:
                 i += 1
@@ -92,31 +197,302 @@ def embed_and_store(text, file_name):
             if i < len(sections):
                 plain = sections[i].strip()
                 if plain:
-                    chunks = textwrap.wrap(plain, width=450, break_long_words=False, break_on_hyphens=False)
-                    structured_chunks.extend(chunks)
+                    structured_chunks.extend(_wrap(plain))
             i += 1
 
-    structured_chunks = [chunk for chunk in structured_chunks if chunk.strip()]
-    if not structured_chunks:
-        print(f"Warning: No chunks extracted from {file_name}")
-        return
+    return [chunk for chunk in structured_chunks if chunk.strip()]
+
+
+def split_into_chunks(text):
+    return _chunks_from_sections(SECTION_RE.split(text))
+
+
+class StreamingChunker:
+    """
+    Incremental split_into_chunks over "\n".join(pages). Only the section
+    still open at the end of a page is carried over, together with the
+    heading/content pairing state. A section longer than max_carry_chars
+    has its finished lines emitted early; only the whitespace at those
+    seams can differ from wrapping the whole section at once.
+    """
+
+    def __init__(self, max_carry_chars=MAX_CARRY_CHARS):
+        self.max_carry_chars = max_carry_chars
+        self.carry = None
+        # carry starts at a section match whose preceding piece was emitted
+        self.carry_cut = False
+        # already-wrapped start of the open piece, and whether it is a heading
+        self.lead = None
+        self.lead_is_heading = False
+        # heading piece waiting for its content piece
+        self.heading = None
+
+    def _feed_section(self, section, is_heading):
+        if self.heading is not None:
+            full_text = f"{self.heading.strip()}: {section.strip()}"
+            self.heading = None
+            return _wrap(full_text)
+        if is_heading:
+            self.heading = section
+            return []
+        plain = section.strip()
+        return _wrap(plain) if plain else []
+
+    def _feed_sections(self, sections):
+        chunks = []
+        for i, section in enumerate(sections):
+            if i == 0 and self.carry_cut:
+                continue
+            if i == 0 and self.lead is not None:
+                is_heading = self.lead_is_heading
+                section = self.lead + section
+                self.lead = None
+            else:
+                is_heading = bool(SECTION_RE.match(section))
+            chunks.extend(self._feed_section(section, is_heading))
+        self.carry_cut = False
+        return chunks
+
+    def _flush_open_section(self, buffer, last):
+        cut = buffer.rfind("\n")
+        if cut <= 0 or (last is not None and last.end() > cut):
+            return []
+
+        sections = SECTION_RE.split(buffer[:cut])
+        open_section = sections.pop()
+        if sections or self.lead is None:
+            is_heading = bool(SECTION_RE.match(open_section))
+            if not is_heading and SECTION_RE.match(open_section + "\n"):
+                # decided by whether the next section match takes this newline
+                return []
+        else:
+            is_heading = self.lead_is_heading
+            open_section = self.lead + open_section
+            self.lead = None
+        chunks = self._feed_sections(sections)
+
+        prefix = f"{self.heading.strip()}: " if self.heading is not None else ""
+        lines = _wrap(prefix + open_section.lstrip())
+        if len(lines) < 2:
+            self.lead = open_section
+            self.lead_is_heading = is_heading
+        else:
+            chunks.extend(lines[:-1])
+            self.lead = lines[-1]
+            self.lead_is_heading = is_heading and not prefix
+            self.heading = None
 
+        self.carry = buffer[cut:]
+        return chunks
+
+    def feed(self, page):
+        buffer = page if self.carry is None else self.carry + "\n" + page
+
+        last = None
+        for last in SECTION_RE.finditer(buffer):
+            pass
+
+        chunks = []
+        if last is not None and last.start() > 0:
+            chunks.extend(self._feed_sections(SECTION_RE.split(buffer[:last.start()])))
+            buffer = buffer[last.start():]
+            self.carry_cut = True
+            last = SECTION_RE.match(buffer)
+
+        self.carry = buffer
+        if len(buffer) > self.max_carry_chars:
+            chunks.extend(self._flush_open_section(buffer, last))
+        return chunks
+
+    def finish(self):
+        if self.carry is None:
+            return []
+        chunks = self._feed_sections(SECTION_RE.split(self.carry))
+        self.carry = None
+        self.heading = None
+        return [chunk for chunk in chunks if chunk.strip()]
+
+
+def iter_chunks(pages, max_carry_chars=MAX_CARRY_CHARS):
+    chunker = StreamingChunker(max_carry_chars)
+    for page in pages:
+        for chunk in chunker.feed(page):
+            if chunk.strip():
+                yield chunk
+    yield from chunker.finish()
+
+
+def _collect_headings(pages, phrases):
+    for page in pages:
+        for match in SECTION_RE.finditer(page):
+            phrases.add_heading(match.group(0))
+        yield page
+
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _previous_version(file_name):
+    """
+    (vectorizer, index, {chunk hash: row}, chunks changed since the
+    vocabulary was fitted) of the indexed version of file_name, or None if
+    there is none with chunk hashes and exact vectors.
+    """
+    path = artifact_path(file_name)
+    if not os.path.exists(path):
+        return None
+    try:
+        artifact = DocumentArtifact(path)
+    except ValueError:
+        return None
+    hashes = artifact.chunk_hashes()
+    if hashes is None:
+        return None
+    index = artifact.index()
+    if not stores_exact_vectors(index):
+        return None
+    rows = {bytes(digest): row for row, digest in enumerate(hashes)}
+    changed = artifact.meta().get("changed_since_fit", 0)
+    return vectorizer_from_arrays(artifact.terms(), artifact.idf()), index, rows, changed
+
+
+def _vocabulary_changed(vocabulary, doc_freq, max_features):
+    # would a fresh fit pick a term the old vocabulary lacks? ties at the cutoff are arbitrary anyway
+    top = doc_freq.most_common(max_features)
+    cutoff = top[-1][1] if len(top) == max_features else 0
+    return any(word not in vocabulary for word, count in top if count > cutoff)
+
+
+def _embed_batch(vectorizer, chunks, hashes, previous):
+    if previous is None:
+        return normalized(vectorizer.transform(chunks))
+    _, previous_index, previous_rows, _ = previous
+    vectors = np.empty((len(chunks), previous_index.d), dtype=np.float32)
+    old = [i for i, digest in enumerate(hashes) if digest in previous_rows]
+    new = [i for i, digest in enumerate(hashes) if digest not in previous_rows]
+    if old:
+        rows = np.array([previous_rows[hashes[i]] for i in old], dtype=np.int64)
+        vectors[old] = previous_index.reconstruct_batch(rows)
+    if new:
+        vectors[new] = normalized(vectorizer.transform([chunks[i] for i in new]))
+    return vectors
+
+
+def _sample_vectors(spool, rows, vectorizer):
+    # one pass over the spooled chunks for the sampled (sorted) rows
+    spool.seek(0)
+    wanted = iter(rows.tolist())
+    next_row = next(wanted, None)
+    sample = []
+    for row, line in enumerate(spool):
+        if row == next_row:
+            sample.append(json.loads(line))
+            next_row = next(wanted, None)
+    return normalized(vectorizer.transform(sample))
+
+
+def embed_and_store_pages(pages, file_name, batch_size=EMBED_BATCH_SIZE, progress=None,
+                          source_hash=None):
+    """
+    Streaming ingestion: chunks are spooled to disk while document
+    frequencies are counted, then vectorized and added to the index in
+    batches, so memory is bounded by a page rather than the document.
+    When file_name is already indexed and few chunks changed, unchanged
+    chunks keep their vectors and only new ones are embedded. Vectors go
+    straight into the ANN tier that suits the chunk count (see
+    utils/ann_index.py), trained first on a sample of the chunks. A BM25
+    inverted index over the full (uncapped) vocabulary is built alongside,
+    and suggestion candidates (headings and key phrases, see
+    utils/suggestions.py) are stored in the artifact metadata.
+    progress(stage, **counts) is called as the index is built. Returns the
+    number of chunks indexed; with none, nothing is written.
+    """
     vectorizer = SimpleVectorizer(max_features=300)
-    vectors = vectorizer.fit_transform(structured_chunks)
+    doc_freq = Counter()
+    hashes = []
+    bm25 = BM25Builder()
+    phrases = PhraseCollector()
+
+    path = artifact_path(file_name)
+
+    with tempfile.TemporaryFile("w+", encoding="utf-8") as spool:
+        for chunk in iter_chunks(_collect_headings(pages, phrases)):
+            spool.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+            hashes.append(chunk_hash(chunk))
+            doc_freq.update(list(dict.fromkeys(vectorizer._tokenize(chunk))))
+            phrases.add(chunk)
+        num_chunks = len(hashes)
+
+        if not num_chunks:
+            print(f"Warning: No chunks extracted from {file_name}")
+            return 0
+
+        previous = _previous_version(file_name)
+        reused = changed = 0
+        if previous is not None:
+            previous_vectorizer, _, previous_rows, changed_since_fit = previous
+            reused = sum(1 for digest in hashes if digest in previous_rows)
+            changed = changed_since_fit + num_chunks - reused
+            if (changed > REINDEX_MAX_CHANGED * num_chunks
+                    or _vocabulary_changed(previous_vectorizer.vocabulary, doc_freq, vectorizer.max_features)):
+                previous = None
+        if previous is not None:
+            vectorizer = previous_vectorizer
+        else:
+            vectorizer.fit_doc_freq(doc_freq, num_chunks)
+            reused = changed = 0
+        # inner product over L2-normalized TF-IDF vectors is cosine similarity
+        index = new_index(num_chunks, len(vectorizer.vocabulary))
+        if not index.is_trained:
+            index.train(_sample_vectors(spool, training_rows(num_chunks, training_size(index)), vectorizer))
 
+        spool.seek(0)
+        with atomic_path(path) as tmp, ArtifactWriter(tmp) as writer:
+            writer.write_vocabulary(vocabulary_terms(vectorizer), vectorizer._idf_array())
+            for start, batch in zip(range(0, num_chunks, batch_size), _batched(spool, batch_size)):
+                chunks = [json.loads(line) for line in batch]
+                batch_hashes = hashes[start:start + batch_size]
+                index.add(_embed_batch(vectorizer, chunks, batch_hashes, previous))
+                for chunk in chunks:
+                    bm25.add(tokenize(chunk))
+                if progress:
+                    progress("vectorize", chunks=index.ntotal, total=num_chunks, reused=reused)
+                writer.add_chunks(chunks, batch_hashes)
+            if progress:
+                progress("write", chunks=num_chunks)
+            writer.finish(
+                index,
+                {
+                    "source_sha256": source_hash,
+                    "changed_since_fit": changed,
+                    "suggestions": phrases.finish(doc_freq, num_chunks),
+                },
+                bm25.to_bytes(),
+            )
 
-    import numpy as np
-    index = faiss.IndexFlatL2(len(vectors[0])) 
-    index.add(np.array(vectors).astype("float32"))
+    remove_legacy_artifacts(file_name)
+    record_source_hash(file_name, source_hash)
+    _document_changed(file_name)
+    return num_chunks
 
-    faiss.write_index(index, os.path.join(VECTOR_DIR, f"{file_name}.index"))
-    with open(os.path.join(VECTOR_DIR, f"{file_name}_chunks.json"), "w", encoding="utf-8") as f:
-        json.dump(structured_chunks, f, ensure_ascii=False, indent=2)
-    with open(os.path.join(VECTOR_DIR, f"{file_name}_vectorizer.json"), "w", encoding="utf-8") as f:
-        json.dump({
-            "vocab": vectorizer.vocabulary,
-            "idf": vectorizer.idf_values
-        }, f, indent=2)
+
+def _document_changed(file_name):
+    # this process drops its copy now, the web workers when they see the bump
+    document_cache.invalidate(file_name)
+    suggestion_cache.invalidate(file_name)
+    bump_generation(INDEX_GENERATION_PATH)
+
+
+def embed_and_store(text, file_name):
+    embed_and_store_pages([text], file_name)
 
 
 def load_vectorizer(file_name):
@@ -124,37 +500,450 @@ def load_vectorizer(file_name):
     with open(path, "r", encoding="utf-8") as f:
         data = json.load(f)
     vectorizer = SimpleVectorizer()
-    vectorizer.vocabulary = {k: int(v) for k, v in data["vocab"].items()}
-    vectorizer.idf_values = data["idf"]
+    vectorizer.set_vocabulary({k: int(v) for k, v in data["vocab"].items()}, data["idf"])
     return vectorizer
 
 
-def query_vector_store(query, file_name, top_k=3):
-    index_path = os.path.join(VECTOR_DIR, f"{file_name}.index")
-    chunks_path = os.path.join(VECTOR_DIR, f"{file_name}_chunks.json")
-    vectorizer_path = os.path.join(VECTOR_DIR, f"{file_name}_vectorizer.json")
+def artifact_path(file_name):
+    return os.path.join(VECTOR_DIR, f"{file_name}{ARTIFACT_SUFFIX}")
+
+
+def legacy_artifact_paths(file_name):
+    return [
+        os.path.join(VECTOR_DIR, f"{file_name}.index"),
+        os.path.join(VECTOR_DIR, f"{file_name}_chunks.json"),
+        os.path.join(VECTOR_DIR, f"{file_name}_vectorizer.json"),
+    ]
+
+
+# written by versions before the JSON artifacts; only read by utils.migrate_artifacts
+PICKLE_SUFFIXES = ("_chunks.pkl", "_vectorizer.pkl", "_vectors.pkl")
+
 
-    if not all(os.path.exists(p) for p in [index_path, chunks_path, vectorizer_path]):
-        return "Document not indexed."
+def remove_legacy_artifacts(file_name):
+    pickles = [os.path.join(VECTOR_DIR, f"{file_name}{suffix}") for suffix in PICKLE_SUFFIXES]
+    for path in legacy_artifact_paths(file_name) + pickles:
+        if os.path.exists(path):
+            os.remove(path)
 
+
+def artifact_paths(file_name):
+    """
+    Files the document is loaded from: the binary artifact, or the JSON
+    artifacts of a document that has not been migrated yet.
+    """
+    path = artifact_path(file_name)
+    legacy = legacy_artifact_paths(file_name)
+    if not os.path.exists(path) and os.path.exists(legacy[-1]):
+        return legacy
+    return [path]
+
+
+def document_source_hash(file_name):
+    """
+    sha256 of the file the document was indexed from, if recorded.
+    """
+    try:
+        return DocumentArtifact(artifact_path(file_name)).meta().get("source_sha256")
+    except (OSError, ValueError):
+        return None
+
+
+def _source_hash_path(source_hash):
+    return os.path.join(SOURCE_HASH_DIR, source_hash)
+
+
+def record_source_hash(file_name, source_hash):
+    if source_hash:
+        os.makedirs(SOURCE_HASH_DIR, exist_ok=True)
+        write_text(_source_hash_path(source_hash), file_name)
+
+
+def _index_source_hashes():
+    for file_name in list_documents():
+        source_hash = document_source_hash(file_name)
+        if source_hash and not os.path.exists(_source_hash_path(source_hash)):
+            record_source_hash(file_name, source_hash)
+    os.makedirs(SOURCE_HASH_DIR, exist_ok=True)
+    write_text(os.path.join(SOURCE_HASH_DIR, SOURCE_HASH_INDEX_COMPLETE), "")
+
+
+def find_document_by_source_hash(source_hash):
+    """
+    A document indexed from a file with this sha256, or None. Looked up in
+    SOURCE_HASH_DIR, which the first lookup fills from the artifacts of
+    documents indexed before it existed.
+    """
+    if not os.path.exists(os.path.join(SOURCE_HASH_DIR, SOURCE_HASH_INDEX_COMPLETE)):
+        _index_source_hashes()
     try:
-        index = faiss.read_index(index_path)
+        with open(_source_hash_path(source_hash), "r", encoding="utf-8") as f:
+            file_name = f.read()
+    except OSError:
+        return None
+    # the document may have been re-indexed from other bytes since
+    if document_source_hash(file_name) == source_hash:
+        return file_name
+    return None
+
+
+def copy_document(source_name, file_name):
+    """
+    Indexes file_name as a copy of source_name, for uploads with the same bytes.
+    """
+    with atomic_path(artifact_path(file_name)) as tmp:
+        shutil.copyfile(artifact_path(source_name), tmp)
+    remove_legacy_artifacts(file_name)
+    # the copy stays a match if source_name is re-indexed from other bytes
+    record_source_hash(file_name, document_source_hash(file_name))
+    _document_changed(file_name)
+
+
+def list_documents():
+    suffixes = (ARTIFACT_SUFFIX, "_vectorizer.json")
+    return sorted({
+        name[:-len(suffix)]
+        for name in os.listdir(VECTOR_DIR)
+        for suffix in suffixes
+        if name.endswith(suffix)
+    })
+
+
+def normalized(vectors):
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def _to_cosine_index(index):
+    # indexes written before cosine scoring hold raw TF-IDF vectors under L2
+    cosine = faiss.IndexFlatIP(index.d)
+    if index.ntotal:
+        cosine.add(normalized(index.reconstruct_n(0, index.ntotal)))
+    return cosine
+
+
+def vocabulary_terms(vectorizer):
+    # terms in column order, as the artifact stores them
+    return sorted(vectorizer.vocabulary, key=vectorizer.vocabulary.get)
+
+
+def write_artifact(file_name, vectorizer, chunks, index, source_hash=None):
+    """
+    Writes an already built document (used when migrating old artifacts,
+    which do not record the file they were indexed from).
+    """
+    with atomic_path(artifact_path(file_name)) as tmp, ArtifactWriter(tmp) as writer:
+        writer.write_vocabulary(vocabulary_terms(vectorizer), vectorizer._idf_array())
+        writer.add_chunks(chunks)
+        writer.finish(
+            rebuild_index(index), {"source_sha256": source_hash}, bm25=build_bm25(chunks).buffer
+        )
+    record_source_hash(file_name, source_hash)
+    _document_changed(file_name)
+
+
+def vectorizer_from_arrays(terms, idf):
+    vectorizer = SimpleVectorizer(max_features=len(terms))
+    vectorizer.set_vocabulary(
+        {term: idx for idx, term in enumerate(terms)},
+        {term: float(value) for term, value in zip(terms, idf)},
+    )
+    return vectorizer
+
+
+def build_bm25(chunks):
+    return BM25Index.from_texts(tokenize(chunk) for chunk in chunks)
+
+
+def _bm25_for(chunks):
+    """
+    In-memory BM25 index for documents written before artifacts carried
+    one; only built when RETRIEVAL_MODE uses it. Returns (bm25, nbytes).
+    """
+    if RETRIEVAL_MODE == "vector":
+        return None, 0
+    bm25 = build_bm25(chunks)
+    return bm25, len(bm25.buffer)
+
+
+def _read_document(file_name):
+    start = time.perf_counter()
+    path = artifact_path(file_name)
+    legacy = not os.path.exists(path)
+    with span("index_load"):
+        document = _read_legacy_document(file_name) if legacy else _read_artifact(path)
+    INDEX_LOADS.inc(format="legacy" if legacy else "rdoc")
+    INDEX_LOAD_SECONDS.observe(time.perf_counter() - start)
+    return document
+
+
+def _read_artifact(path):
+    artifact = DocumentArtifact(path)
+    index = artifact.index()
+    chunks = artifact.chunks()
+    vectorizer = vectorizer_from_arrays(artifact.terms(), artifact.idf())
+    bm25 = artifact.bm25()
+    if bm25 is None:
+        bm25, bm25_bytes = _bm25_for(chunks)
+    else:
+        # postings stay in the page cache; only document lengths are copied
+        bm25_bytes = bm25.num_docs * 8
+
+    # chunk texts stay in the page cache; only offsets are resident
+    nbytes = (
+        index_nbytes(index, mapped=True)
+        + len(chunks) * 8
+        + len(vectorizer.vocabulary) * 100
+        + bm25_bytes
+    )
+    return (index, chunks, vectorizer, bm25), nbytes
 
-        with open(chunks_path, "r", encoding="utf-8") as f:
-            chunks = json.load(f)
 
-        vectorizer = load_vectorizer(file_name)
-        query_vec = vectorizer.transform([query])[0]
+def _read_legacy_document(file_name):
+    index_path, chunks_path, _ = legacy_artifact_paths(file_name)
+    index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP_IFC)
+    mapped = index.metric_type == faiss.METRIC_INNER_PRODUCT
+    if not mapped:
+        index = _to_cosine_index(index)
 
-        import numpy as np
-        query_array = np.array([query_vec], dtype="float32")
-        distances, indices = index.search(query_array, top_k)
+    with open(chunks_path, "r", encoding="utf-8") as f:
+        chunks = json.load(f)
 
-        results = []
-        for idx in indices[0]:
-            if idx < len(chunks):
-                results.append(chunks[idx])
-        return "\n\n".join(results) if results else "No relevant chunks found."
+    vectorizer = load_vectorizer(file_name)
+    bm25, bm25_bytes = _bm25_for(chunks)
 
+    nbytes = (
+        index_nbytes(index, mapped=mapped)
+        + sum(len(chunk) for chunk in chunks)
+        + len(vectorizer.vocabulary) * 100
+        + bm25_bytes
+    )
+    return (index, chunks, vectorizer, bm25), nbytes
+
+
+def load_document(file_name):
+    """
+    Returns (index, chunks, vectorizer, bm25) from the resident cache, reading
+    from disk only when the document is new or its artifacts have changed.
+    bm25 is None for documents without one while RETRIEVAL_MODE is "vector".
+    Returns None if the document is not indexed.
+    """
+    signature = file_signature(artifact_paths(file_name))
+    if signature is None:
+        document_cache.invalidate(file_name)
+        return None
+    return document_cache.get(file_name, signature, lambda: _read_document(file_name))
+
+
+def document_suggestions(file_name):
+    """
+    Suggestion candidates stored when file_name was indexed, or None if it
+    is not indexed or was indexed before they were stored.
+    """
+    paths = artifact_paths(file_name)
+    signature = file_signature(paths)
+    if signature is None or not paths[0].endswith(ARTIFACT_SUFFIX):
+        return None
+    return suggestion_cache.get(file_name, signature, lambda: _read_suggestions(paths[0]))
+
+
+def _read_suggestions(path):
+    artifact = DocumentArtifact(path)
+    suggestions = artifact.meta().get("suggestions")
+    bm25 = artifact.bm25()
+    if suggestions and bm25 is not None:
+        suggestions = retrievable(suggestions, bm25)
+    nbytes = sum(len(candidate["text"]) + 200 for candidate in suggestions or ())
+    return suggestions, nbytes
+
+
+def preload_document(file_name):
+    """
+    load_document for warming a fresh worker: also reads the memory-mapped
+    parts of the artifact ahead. Returns False if the document is not indexed.
+    """
+    document = load_document(file_name)
+    if document is None:
+        return False
+    chunks = document[1]
+    if isinstance(chunks, MappedChunks):
+        chunks.prefetch()
+    return True
+
+
+def refresh_documents():
+    """
+    Brings the document cache up to date after a generation bump: drops
+    documents that were deleted and reloads the ones re-indexed since they
+    were cached, releasing the old version's mapping and sparing the next
+    query the load. Returns the names that changed.
+    """
+    changed = []
+    for file_name in document_cache.keys():
+        signature = file_signature(artifact_paths(file_name))
+        if signature == document_cache.signature(file_name):
+            continue
+        changed.append(file_name)
+        if signature is None:
+            document_cache.invalidate(file_name)
+        else:
+            preload_document(file_name)
+    return changed
+
+
+def apply_token_budget(chunks, token_budget=RETRIEVAL_TOKEN_BUDGET):
+    """
+    Keeps the best-first prefix of chunks that fits in token_budget; the
+    top chunk is always kept.
+    """
+    kept = []
+    used = 0
+    for chunk in chunks:
+        cost = estimate_tokens(chunk["text"])
+        if kept and used + cost > token_budget:
+            break
+        kept.append(chunk)
+        used += cost
+    return kept
+
+
+def _clip(score):
+    return min(max(float(score), 0.0), 1.0)
+
+
+def _ranked(scores, rows):
+    return [(int(row), _clip(score)) for score, row in zip(scores, rows) if row >= 0]
+
+
+def rank_chunks_batch(queries, index, vectorizer, bm25, top_k, mode=RETRIEVAL_MODE,
+                      selector=None, nprobe=None, ef_search=None):
+    """
+    Best-first [(row, score)] for each of queries under mode (see
+    RETRIEVAL_MODE): they are transformed into one matrix and searched
+    with a single faiss call; BM25 still walks its postings per query.
+    selector (a faiss IDSelector) restricts the vector search to some rows,
+    which bm25 must then be restricted to as well (see utils.corpus_index).
+    nprobe / ef_search tune approximate indexes for these queries. Without
+    a BM25 index every mode ranks by cosine.
+    """
+    if not queries:
+        return []
+    params = search_params(index, selector, nprobe, ef_search)
+    with span("transform"):
+        query_array = normalized(vectorizer.transform(queries))
+    if mode == "vector" or bm25 is None:
+        with span("search"):
+            scores, rows = index.search(query_array, top_k, params=params)
+        return [_ranked(*hits) for hits in zip(scores, rows)]
+
+    tokens = [tokenize(query) for query in queries]
+    bounds = [bm25.max_query_score(query_tokens) for query_tokens in tokens]
+    with span("search"):
+        if mode == "bm25":
+            return [
+                [(doc, score / bound) for doc, score in bm25.search(query_tokens, top_k)]
+                for query_tokens, bound in zip(tokens, bounds)
+            ]
+        scores, rows = index.search(query_array, top_k * HYBRID_CANDIDATES, params=params)
+        return [
+            _fuse(query_array[i], tokens[i], bounds[i], scores[i], rows[i], index, bm25, top_k)
+            # no query term in the BM25 index: ranked by cosine alone
+            if bounds[i] else _ranked(scores[i][:top_k], rows[i][:top_k])
+            for i in range(len(queries))
+        ]
+
+
+def _fuse(query_vector, tokens, bound, scores, rows, index, bm25, top_k):
+    cosine = dict(_ranked(scores, rows))
+    lexical = {doc: score / bound for doc, score in bm25.search(tokens, len(scores))}
+
+    # a candidate found by only one retriever is scored exactly by the other
+    missing = np.array([doc for doc in lexical if doc not in cosine], dtype=np.int64)
+    if len(missing):
+        vectors = index.reconstruct_batch(missing)
+        for doc, score in zip(missing, vectors @ query_vector):
+            cosine[int(doc)] = _clip(score)
+    missing = np.array([row for row in cosine if row not in lexical], dtype=np.int64)
+    if len(missing):
+        for row, score in zip(missing, bm25.score(tokens, missing)):
+            lexical[int(row)] = score / bound
+
+    fused = [
+        (row, HYBRID_ALPHA * cosine[row] + (1 - HYBRID_ALPHA) * lexical[row]) for row in cosine
+    ]
+    fused.sort(key=lambda item: (-item[1], item[0]))
+    return fused[:top_k]
+
+
+def search_vector_store(query, file_name, top_k=3, min_score=RETRIEVAL_MIN_SCORE,
+                        mode=RETRIEVAL_MODE, nprobe=None, ef_search=None):
+    """
+    Top chunks of file_name for query as a best-first list of
+    {file_name, chunk_id, text, score}, score being the cosine similarity
+    or, for the "bm25" and "hybrid" modes, the score described at
+    RETRIEVAL_MODE. Returns None if the document is not indexed.
+    """
+    batch = search_vector_store_batch([query], file_name, top_k, min_score, mode, nprobe, ef_search)
+    return None if batch is None else batch[0]
+
+
+def search_vector_store_batch(queries, file_name, top_k=3, min_score=RETRIEVAL_MIN_SCORE,
+                              mode=RETRIEVAL_MODE, nprobe=None, ef_search=None):
+    """
+    search_vector_store for each of queries, loading the document once
+    and searching it once for all of them (see rank_chunks_batch).
+    """
+    document = load_document(file_name)
+    if document is None:
+        return None
+    index, chunks, vectorizer, bm25 = document
+
+    batch = rank_chunks_batch(
+        queries, index, vectorizer, bm25, top_k, mode, nprobe=nprobe, ef_search=ef_search
+    )
+    return [
+        [
+            {"file_name": file_name, "chunk_id": int(idx), "text": chunks[idx], "score": score}
+            for idx, score in ranked
+            if 0 <= idx < len(chunks) and score >= min_score
+        ]
+        for ranked in batch
+    ]
+
+
+def query_vector_store(query, file_name, top_k=3, min_score=RETRIEVAL_MIN_SCORE,
+                       token_budget=RETRIEVAL_TOKEN_BUDGET, nprobe=None, ef_search=None):
+    """
+    Returns {"text", "score", "chunks"}: the joined chunk texts, the best
+    chunk's score and the chunks themselves (see search_vector_store).
+    """
+    return query_vector_store_batch(
+        [query], file_name, top_k, min_score, token_budget, nprobe, ef_search
+    )[0]
+
+
+def _query_result(results):
+    if not results:
+        return {"text": "No relevant chunks found.", "score": 0.0, "chunks": []}
+    return {
+        "text": "\n\n".join(result["text"] for result in results),
+        "score": results[0]["score"],
+        "chunks": results,
+    }
+
+
+def query_vector_store_batch(queries, file_name, top_k=3, min_score=RETRIEVAL_MIN_SCORE,
+                             token_budget=RETRIEVAL_TOKEN_BUDGET, nprobe=None, ef_search=None):
+    """
+    query_vector_store for each of queries, with one document load and one
+    search (see search_vector_store_batch).
+    """
+    try:
+        batch = search_vector_store_batch(
+            queries, file_name, top_k=top_k, min_score=min_score, nprobe=nprobe, ef_search=ef_search
+        )
     except Exception as e:
-        return f"Error during query: {str(e)}"
+        return [{"text": f"Error during query: {str(e)}", "score": 0.0, "chunks": []} for _ in queries]
+    if batch is None:
+        return [{"text": "Document not indexed.", "score": 0.0, "chunks": []} for _ in queries]
+    return [_query_result(apply_token_budget(results, token_budget)) for results in batch]
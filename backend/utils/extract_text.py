@@ -1,10 +1,138 @@
 import pdfplumber
 from docx import Document
 import os
+import signal
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 
-def extract_text_from_pdf(file_path):
+from utils.jobs import ingest_cores, running_jobs
+
+# paragraphs / bytes per "page" for formats without real pages
+DOCX_PARAGRAPHS_PER_PAGE = 50
+TXT_PAGE_CHARS = 64 * 1024
+
+# PDFs with at least PDF_PARALLEL_MIN_PAGES pages are split into ranges of
+# PDF_PAGES_PER_TASK pages, extracted on a pool of PDF_EXTRACT_WORKERS processes;
+# 0 sizes it as extraction starts, sharing the web worker's cores among the
+# ingest jobs running then, so a lone upload gets all of them
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", "0"))
+# the pool is started per document and every range reopens the file, which
+# only pays off for long documents
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "64"))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+# seconds per page before it is skipped; 0 disables the limit
+PDF_PAGE_TIMEOUT = float(os.getenv("PDF_PAGE_TIMEOUT", "30"))
+
+class PageTimeout(Exception):
+    pass
+
+def _raise_page_timeout(signum, frame):
+    raise PageTimeout()
+
+def _page_text(page, number, timeout=PDF_PAGE_TIMEOUT):
+    """
+    Text of one page, or "" if it fails or runs out of time: one malformed
+    page must not fail the whole document.
+    """
+    # SIGALRM can only be handled on the main thread of a process
+    use_alarm = (
+        timeout > 0
+        and hasattr(signal, "setitimer")
+        and threading.current_thread() is threading.main_thread()
+    )
+    if use_alarm:
+        previous = signal.signal(signal.SIGALRM, _raise_page_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return page.extract_text() or ""
+    except Exception as e:
+        # pdfplumber re-raises errors from the parser wrapped in its own exception
+        if isinstance(e, PageTimeout) or isinstance(e.__context__, PageTimeout):
+            print(f"Warning: page {number} took longer than {timeout}s, skipped")
+        else:
+            print(f"Warning: page {number} could not be extracted, skipped: {e}")
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+        # drop the page's parsed layout objects before moving on
+        page.close()
+    return ""
+
+def _extract_page_range(file_path, start, stop, timeout=PDF_PAGE_TIMEOUT):
+    # runs in a pool worker, which opens the file on its own
     with pdfplumber.open(file_path) as pdf:
-        return "\n".join([page.extract_text() or "" for page in pdf.pages])
+        return [_page_text(pdf.pages[i], i + 1, timeout) for i in range(start, stop)]
+
+def _pdf_page_count(file_path):
+    with pdfplumber.open(file_path) as pdf:
+        return len(pdf.pages)
+
+def _new_extract_pool(workers):
+    # spawn, as for the ingestion pool: this may itself run inside a pool worker
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+def _range_result(future, start, stop, timeout):
+    # pages of a finished range; a range still running past its budget is skipped
+    try:
+        return future.result(timeout=(stop - start) * timeout + 30 if timeout else None)
+    except FutureTimeoutError:
+        print(f"Warning: pages {start + 1}-{stop} timed out, skipped")
+        return [""] * (stop - start)
+
+def iter_pages_from_pdf_parallel(file_path, num_pages, workers,
+                                 pages_per_task=PDF_PAGES_PER_TASK, timeout=PDF_PAGE_TIMEOUT):
+    """
+    Yields pages in order while later page ranges are extracted on a
+    process pool. If a worker dies, the ranges that were in flight are
+    retried one at a time, and only a range that crashes again is skipped.
+    """
+    ranges = deque(
+        (start, min(start + pages_per_task, num_pages))
+        for start in range(0, num_pages, pages_per_task)
+    )
+    executor = _new_extract_pool(workers)
+    # a bounded window of ranges in flight, so finished pages do not pile up
+    in_flight = deque()
+    try:
+        while ranges or in_flight:
+            while ranges and len(in_flight) < workers * 2:
+                start, stop = ranges.popleft()
+                future = executor.submit(_extract_page_range, file_path, start, stop, timeout)
+                in_flight.append(((start, stop), future))
+            (start, stop), future = in_flight.popleft()
+            try:
+                pages = _range_result(future, start, stop, timeout)
+            except BrokenProcessPool:
+                retry = [(start, stop)] + [page_range for page_range, _ in in_flight]
+                in_flight.clear()
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = None
+                pages = []
+                for start, stop in retry:
+                    if executor is None:
+                        executor = _new_extract_pool(workers)
+                    future = executor.submit(_extract_page_range, file_path, start, stop, timeout)
+                    try:
+                        pages.extend(_range_result(future, start, stop, timeout))
+                    except BrokenProcessPool:
+                        print(f"Warning: pages {start + 1}-{stop} crashed the extractor, skipped")
+                        pages.extend([""] * (stop - start))
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        executor = None
+                if executor is None:
+                    executor = _new_extract_pool(workers)
+            yield from pages
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+def extract_text_from_pdf(file_path):
+    return "\n".join(iter_pages_from_pdf(file_path))
 
 def extract_text_from_docx(file_path):
     doc = Document(file_path)
@@ -14,6 +142,59 @@ def extract_text_from_txt(file_path):
     with open(file_path, 'r', encoding='utf-8') as file:
         return file.read()
 
+def pdf_extract_workers():
+    if PDF_EXTRACT_WORKERS:
+        return PDF_EXTRACT_WORKERS
+    return max(1, ingest_cores() // running_jobs())
+
+def iter_pages_from_pdf(file_path, workers=None):
+    if workers is None:
+        workers = pdf_extract_workers()
+    if workers > 1:
+        num_pages = _pdf_page_count(file_path)
+        if num_pages >= PDF_PARALLEL_MIN_PAGES:
+            yield from iter_pages_from_pdf_parallel(file_path, num_pages, workers)
+            return
+    # small files: starting a pool would cost more than it saves
+    with pdfplumber.open(file_path) as pdf:
+        for number, page in enumerate(pdf.pages, 1):
+            yield _page_text(page, number)
+
+def iter_pages_from_docx(file_path):
+    doc = Document(file_path)
+    paragraphs = doc.paragraphs
+    for start in range(0, max(len(paragraphs), 1), DOCX_PARAGRAPHS_PER_PAGE):
+        yield "\n".join(para.text for para in paragraphs[start:start + DOCX_PARAGRAPHS_PER_PAGE])
+
+def iter_pages_from_txt(file_path):
+    with open(file_path, 'r', encoding='utf-8') as file:
+        block = []
+        size = 0
+        for line in file:
+            block.append(line)
+            size += len(line)
+            if size >= TXT_PAGE_CHARS and line.endswith('\n'):
+                # pages are re-joined with "\n", so drop the one ending this block
+                yield "".join(block)[:-1]
+                block = []
+                size = 0
+        yield "".join(block)
+
+def iter_text_pages(file_path):
+    """
+    Yields the document text page by page; "\n".join() of the pages is
+    the same text extract_text returns.
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == '.pdf':
+        return iter_pages_from_pdf(file_path)
+    elif ext == '.docx':
+        return iter_pages_from_docx(file_path)
+    elif ext == '.txt':
+        return iter_pages_from_txt(file_path)
+    else:
+        raise ValueError("Unsupported file type.")
+
 def extract_text(file_path):
     ext = os.path.splitext(file_path)[1].lower()
     if ext == '.pdf':
@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict, deque
+
+from utils.atomic_file import write_text
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# message history: one JSON object per line, appended, never rewritten per message
+HISTORY_TAIL_SIZE = int(os.getenv("HISTORY_TAIL_SIZE", "20"))
+HISTORY_CACHE_USERS = int(os.getenv("HISTORY_CACHE_USERS", "1000"))
+# 0 disables the limit
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "0"))
+HISTORY_RETENTION_DAYS = float(os.getenv("HISTORY_RETENTION_DAYS", "0"))
+
+LOCK_STRIPES = 64
+READ_BLOCK = 8192
+# next to each history: "<messages> <bytes>" as of the last count, so a worker
+# that has not cached the tail only counts the lines appended since
+COUNT_SUFFIX = ".count"
+
+
+class _FileLock:
+    """
+    Exclusive flock on an open file, so appends and compaction from
+    other worker processes do not interleave.
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    def __enter__(self):
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        return self.f
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+
+
+class _Tail:
+    def __init__(self, messages, count, size, maxlen):
+        self.messages = deque(messages, maxlen=maxlen)
+        self.count = count
+        self.size = size
+
+
+def _read_tail_lines(path, n):
+    """
+    Last n non-empty lines of path, reading backwards in blocks.
+    """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b""
+        while position > 0 and data.count(b"\n") <= n:
+            step = min(READ_BLOCK, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+    lines = [line for line in data.split(b"\n") if line.strip()]
+    return lines[-n:] if n else []
+
+
+def _count_lines(f, start):
+    f.seek(start)
+    return sum(1 for line in f if line.strip())
+
+
+class HistoryStore:
+    def __init__(self, directory, tail_size=HISTORY_TAIL_SIZE, cache_users=HISTORY_CACHE_USERS,
+                 max_messages=HISTORY_MAX_MESSAGES, retention_days=HISTORY_RETENTION_DAYS):
+        self.directory = directory
+        self.tail_size = tail_size
+        self.cache_users = cache_users
+        self.max_messages = max_messages
+        self.retention_seconds = retention_days * 86400
+        os.makedirs(directory, exist_ok=True)
+        self._tails = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    def _path(self, user_id):
+        return os.path.join(self.directory, f"{user_id}.jsonl")
+
+    def _count_path(self, user_id):
+        return self._path(user_id) + COUNT_SUFFIX
+
+    def _lock(self, user_id):
+        return self._locks[hash(user_id) % LOCK_STRIPES]
+
+    def _migrate_legacy(self, user_id):
+        # histories written before the JSONL store were a single JSON array
+        legacy = os.path.join(self.directory, f"{user_id}.json")
+        if not os.path.exists(legacy):
+            return
+        with open(legacy, "r") as f:
+            messages = json.load(f)
+        with open(self._path(user_id), "a") as f:
+            with _FileLock(f):
+                f.write("".join(json.dumps(m) + "\n" for m in messages))
+        os.remove(legacy)
+
+    def _cached_tail(self, user_id, path):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        with self._cache_lock:
+            tail = self._tails.get(user_id)
+            if tail is not None and tail.size == size:
+                self._tails.move_to_end(user_id)
+                return tail
+        return None
+
+    def _remember(self, user_id, tail):
+        with self._cache_lock:
+            self._tails[user_id] = tail
+            self._tails.move_to_end(user_id)
+            while len(self._tails) > self.cache_users:
+                self._tails.popitem(last=False)
+
+    def _load_tail(self, user_id):
+        path = self._path(user_id)
+        tail = self._cached_tail(user_id, path)
+        if tail is not None:
+            return tail
+        if not os.path.exists(path):
+            return _Tail([], 0, 0, self.tail_size)
+        count, size = self._count_messages(user_id, path)
+        messages = [json.loads(line) for line in _read_tail_lines(path, self.tail_size)]
+        tail = _Tail(messages, count, size, self.tail_size)
+        self._remember(user_id, tail)
+        return tail
+
+    def _count_messages(self, user_id, path):
+        """
+        (messages, bytes) of the history, counting only what was appended
+        since the count file was written. Under the file lock, so a
+        compaction cannot change the file in between.
+        """
+        count_path = self._count_path(user_id)
+        with open(path, "rb") as f:
+            with _FileLock(f):
+                size = os.fstat(f.fileno()).st_size
+                try:
+                    with open(count_path, "r") as counted:
+                        count, counted_size = (int(value) for value in counted.read().split())
+                except (OSError, ValueError):
+                    count, counted_size = 0, 0
+                if counted_size > size:
+                    count, counted_size = 0, 0
+                if counted_size < size:
+                    count += _count_lines(f, counted_size)
+                    write_text(count_path, f"{count} {size}")
+        return count, size
+
+    def append(self, user_id, messages):
+        """
+        Appends [(role, message), ...] for user_id in a single write.
+        """
+        records = [{"role": role, "message": message, "ts": time.time()} for role, message in messages]
+        data = "".join(json.dumps(record) + "\n" for record in records)
+        with self._lock(user_id):
+            self._migrate_legacy(user_id)
+            tail = self._load_tail(user_id)
+            path = self._path(user_id)
+            with open(path, "a") as f:
+                with _FileLock(f):
+                    f.write(data)
+                    f.flush()
+                    size = os.fstat(f.fileno()).st_size
+            # another process appended in between: re-read instead of patching the cache
+            if size == tail.size + len(data.encode()):
+                tail.messages.extend(records)
+                tail.count += len(records)
+                tail.size = size
+                self._remember(user_id, tail)
+            if self.max_messages and tail.count > self.max_messages * 1.5:
+                self._compact(user_id)
+
+    def tail(self, user_id, n):
+        """
+        Last n messages (n <= tail_size is served from memory).
+        """
+        if n > self.tail_size:
+            return self.load(user_id)[-n:]
+        with self._lock(user_id):
+            self._migrate_legacy(user_id)
+            return list(self._load_tail(user_id).messages)[-n:] if n else []
+
+    def count(self, user_id):
+        with self._lock(user_id):
+            self._migrate_legacy(user_id)
+            return self._load_tail(user_id).count
+
+    def load(self, user_id):
+        with self._lock(user_id):
+            self._migrate_legacy(user_id)
+            path = self._path(user_id)
+            if not os.path.exists(path):
+                return []
+            with open(path, "r") as f:
+                return [json.loads(line) for line in f if line.strip()]
+
+    def _compact(self, user_id):
+        path = self._path(user_id)
+        with open(path, "r+") as f:
+            with _FileLock(f):
+                messages = [json.loads(line) for line in f if line.strip()]
+                if self.retention_seconds:
+                    cutoff = time.time() - self.retention_seconds
+                    messages = [m for m in messages if m.get("ts", cutoff) >= cutoff]
+                if self.max_messages:
+                    messages = messages[-self.max_messages:]
+                # rewritten in place: appenders blocked on the lock keep the same inode
+                f.seek(0)
+                f.write("".join(json.dumps(m) + "\n" for m in messages))
+                f.truncate()
+                f.flush()
+                write_text(self._count_path(user_id), f"{len(messages)} {os.fstat(f.fileno()).st_size}")
+        with self._cache_lock:
+            self._tails.pop(user_id, None)
+
+    def compact(self, user_id):
+        """
+        Rewrites the history keeping max_messages and dropping messages
+        older than the retention period.
+        """
+        with self._lock(user_id):
+            if os.path.exists(self._path(user_id)):
+                self._compact(user_id)
+
+    def prune_expired(self):
+        """
+        Deletes histories untouched for longer than the retention period.
+        """
+        if not self.retention_seconds:
+            return 0
+        cutoff = time.time() - self.retention_seconds
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith((".jsonl", ".json")) and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+            # a history recreated later must not inherit the count
+            if name.endswith(".jsonl") and not os.path.exists(path):
+                try:
+                    os.remove(path + COUNT_SUFFIX)
+                except OSError:
+                    pass
+        with self._cache_lock:
+            self._tails.clear()
+        return removed
@@ -0,0 +1,139 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from utils.atomic_file import write_text
+
+# bumped whenever a document is (re-)indexed, by whichever process did it; every
+# web worker polls it every INDEX_WATCH_INTERVAL seconds and refreshes its cache
+INDEX_GENERATION_PATH = os.getenv("INDEX_GENERATION_PATH", os.path.join("vector_db", "generation"))
+INDEX_WATCH_INTERVAL = float(os.getenv("INDEX_WATCH_INTERVAL", "1"))
+# "document": one search per file, "corpus": the library-wide corpus index
+# (utils.corpus_index) ranks the queried files together, "auto": it does only
+# when several files are queried together
+INDEX_MODE = os.getenv("INDEX_MODE", "auto").lower()
+
+
+def file_signature(paths):
+    """
+    (mtime_ns, size) of every artifact, or None if any of them is missing
+    """
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        signature.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def bump_generation(path):
+    """
+    Tells every process watching path (a GenerationWatcher) that indexes
+    changed. Each bump is a new file, so it has a new signature even
+    within the same clock tick.
+    """
+    write_text(path, str(time.time()))
+
+
+class GenerationWatcher:
+    """
+    Calls on_change from a daemon thread whenever the generation file at
+    path is bumped, checking every interval seconds. One stat per check,
+    however many documents are cached.
+    """
+
+    def __init__(self, path, on_change, interval):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def _signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def start(self):
+        # a fresh event per start, so a stopped watcher can be started again
+        self._stop = threading.Event()
+        threading.Thread(target=self.run, args=(self._stop,), name="index-generation", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self, stop):
+        seen = self._signature()
+        while not stop.wait(self.interval):
+            current = self._signature()
+            if current == seen:
+                continue
+            seen = current
+            try:
+                self.on_change()
+            except Exception as e:
+                print(f">> Error refreshing indexes: {e}")
+
+
+class IndexCache:
+    def __init__(self, max_entries=32, max_bytes=128 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, signature, loader):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value, nbytes = loader()
+
+        with self._lock:
+            self._remove(key)
+            if nbytes <= self.max_bytes and self.max_entries > 0:
+                self._entries[key] = (signature, value, nbytes)
+                self.total_bytes += nbytes
+                self._evict()
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def signature(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry is not None else None
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+    def _evict(self):
+        while self._entries and (
+            len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes
+        ):
+            _, (_, _, nbytes) = self._entries.popitem(last=False)
+            self.total_bytes -= nbytes
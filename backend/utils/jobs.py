@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from uuid import uuid4
+
+from utils.admission import AdmissionLimiter
+from utils.atomic_file import write_json
+from utils.index_cache import INDEX_MODE
+
+# job status lives on disk so the worker processes and every web worker see the same record
+JOBS_DIR = os.getenv("JOBS_DIR", "jobs")
+os.makedirs(JOBS_DIR, exist_ok=True)
+
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+
+
+def ingest_cores():
+    # every web worker has its own pool; together they use the cores once
+    return max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)
+
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(ingest_cores())))
+# uploads queued behind the running jobs before new ones are turned away
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "16"))
+ingest_admission = AdmissionLimiter("ingest", INGEST_WORKERS, INGEST_QUEUE_SIZE, queue_timeout=0)
+# minimum seconds between progress writes from a running job
+PROGRESS_INTERVAL = 0.5
+# job records untouched for longer than this are deleted; 0 keeps them forever
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", str(24 * 3600)))
+# minimum seconds between sweeps, which run as new jobs are created
+JOB_PRUNE_INTERVAL = 3600
+
+_last_prune = None
+
+_executor = None
+# jobs running on this web worker's pool, shared with its processes so a
+# job can spread its own work (PDF extraction) over the cores left idle
+_running_jobs = None
+
+
+def _init_ingest_worker(running_jobs):
+    global _running_jobs
+    _running_jobs = running_jobs
+
+
+def running_jobs():
+    """
+    Ingest jobs running on this pool, the caller's included; 1 outside it.
+    """
+    if _running_jobs is None:
+        return 1
+    return max(1, _running_jobs.value)
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        # spawn: forking a process that is running the event loop and threadpool is unsafe
+        context = multiprocessing.get_context("spawn")
+        _executor = ProcessPoolExecutor(
+            max_workers=INGEST_WORKERS,
+            mp_context=context,
+            initializer=_init_ingest_worker,
+            initargs=(context.Value("i", 0),),
+        )
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _job_path(job_id, suffix=""):
+    return os.path.join(JOBS_DIR, f"{job_id}{suffix}.json")
+
+
+def _read_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def prune_jobs(retention_seconds=JOB_RETENTION_SECONDS):
+    """
+    Deletes job records (and their suggestions) untouched for longer than
+    retention_seconds; a running job rewrites its record as it goes.
+    Returns how many files were removed.
+    """
+    global _last_prune
+    _last_prune = time.monotonic()
+    if not retention_seconds:
+        return 0
+    cutoff = time.time() - retention_seconds
+    removed = 0
+    for name in os.listdir(JOBS_DIR):
+        path = os.path.join(JOBS_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            # another worker pruned it first
+            continue
+    return removed
+
+
+def get_job(job_id):
+    # job ids are hex uuids; anything else cannot name a job file
+    if not job_id.isalnum():
+        return None
+    job = _read_json(_job_path(job_id))
+    if job is None:
+        return None
+    extra = _read_json(_job_path(job_id, ".suggestions"))
+    if extra is not None:
+        job["suggested_questions"] = extra
+    return job
+
+
+def save_job_suggestions(job_id, suggestions):
+    write_json(_job_path(job_id, ".suggestions"), suggestions)
+
+
+class JobReporter:
+    def __init__(self, job):
+        self.job = job
+        self.last_write = 0.0
+
+    def update(self, force=False, **fields):
+        self.job.update(fields)
+        self.job["updated_at"] = time.time()
+        if force or self.job["updated_at"] - self.last_write >= PROGRESS_INTERVAL:
+            write_json(_job_path(self.job["id"]), self.job)
+            self.last_write = self.job["updated_at"]
+
+    def progress(self, stage, **counts):
+        self.job["stages"].setdefault(stage, {}).update(counts)
+        self.update(force=stage != self.job["stage"], stage=stage)
+
+
+def _count_running(delta):
+    if _running_jobs is not None:
+        with _running_jobs.get_lock():
+            _running_jobs.value += delta
+
+
+def run_ingest_job(job, file_path, file_name, source_hash=None):
+    # extraction and indexing libraries load in the pool worker, not the web worker
+    from utils.embed_store import document_suggestions
+    from utils.processor import process_and_store
+    from utils.suggestions import rank_suggestions
+
+    reporter = JobReporter(job)
+    reporter.update(force=True, status="running", started_at=time.time())
+    _count_running(1)
+    try:
+        num_chunks = process_and_store(file_path, file_name, progress=reporter.progress, source_hash=source_hash)
+    except Exception as e:
+        reporter.update(force=True, status="failed", error=str(e), finished_at=time.time())
+        return reporter.job
+    finally:
+        _count_running(-1)
+    if not num_chunks:
+        # nothing was indexed, so the document cannot be queried
+        reporter.update(force=True, status="failed", error="No text could be extracted from the file",
+                        finished_at=time.time())
+        return reporter.job
+    # the document's strongest headings and phrases, for a first question
+    suggestions = rank_suggestions("", document_suggestions(file_name) or [])
+    reporter.update(force=True, status="done", stage="done", finished_at=time.time(),
+                    suggested_questions=suggestions)
+    # until then queries search the document on its own
+    update_corpus_index()
+    return reporter.job
+
+
+def update_corpus_index():
+    """
+    Takes documents indexed since into the library-wide corpus index, off
+    the request path; a no-op when INDEX_MODE never searches it.
+    """
+    if INDEX_MODE == "document":
+        return
+    try:
+        from utils.corpus_index import sync_corpus_index
+
+        sync_corpus_index()
+    except Exception as e:
+        print(f">> Could not update the corpus index: {e}")
+
+
+def _new_job(file_name, **fields):
+    if _last_prune is None or time.monotonic() - _last_prune >= JOB_PRUNE_INTERVAL:
+        prune_jobs()
+    job = {
+        "id": uuid4().hex,
+        "file_name": file_name,
+        "status": "queued",
+        "stage": "queued",
+        "stages": {},
+        "created_at": time.time(),
+        "updated_at": time.time(),
+    }
+    job.update(fields)
+    write_json(_job_path(job["id"]), job)
+    return job
+
+
+def record_skipped_job(file_name, reason, suggested_questions=None):
+    """
+    Records a finished job for an upload that needed no processing, so
+    clients can poll it like any other; returns the job id.
+    """
+    job = _new_job(
+        file_name, status="done", stage="done", skipped=reason, finished_at=time.time(),
+        suggested_questions=suggested_questions or [],
+    )
+    return job["id"]
+
+
+def submit_ingest_job(file_path, file_name, source_hash=None):
+    """
+    Queues file_path for extraction and indexing on the process pool.
+    Returns (job_id, future); progress is read back with get_job.
+    """
+    job = _new_job(file_name)
+    try:
+        future = get_executor().submit(run_ingest_job, job, file_path, file_name, source_hash)
+    except BrokenProcessPool:
+        # a crashed worker poisons the whole pool; start a fresh one
+        shutdown_executor()
+        future = get_executor().submit(run_ingest_job, job, file_path, file_name, source_hash)
+    future.add_done_callback(lambda f: _mark_lost(job, f))
+    return job["id"], future
+
+
+def _mark_lost(job, future):
+    # the worker died or the job was cancelled before it could record the outcome
+    if future.cancelled() or future.exception() is not None:
+        error = "cancelled" if future.cancelled() else str(future.exception())
+        JobReporter(dict(job)).update(force=True, status="failed", error=error, finished_at=time.time())
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import httpx
+
+from utils.admission import AdmissionLimiter
+from utils.metrics import LLM_ERRORS, LLM_FIRST_TOKEN_SECONDS, LLM_REQUEST_SECONDS
+
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+LLM_MODEL = os.getenv("LLM_MODEL", "mistralai/mistral-7b-instruct")
+
+# one pooled keep-alive client per worker; at most LLM_MAX_CONCURRENCY upstream calls
+# run at once and LLM_QUEUE_SIZE more wait up to LLM_QUEUE_TIMEOUT seconds for a
+# slot, past which calls fail fast with Overloaded (see utils/admission.py)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", "32"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "10"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "16"))
+LLM_KEEPALIVE_SECONDS = float(os.getenv("LLM_KEEPALIVE_SECONDS", "30"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+
+_client = None
+llm_admission = AdmissionLimiter("llm", LLM_MAX_CONCURRENCY, LLM_QUEUE_SIZE, LLM_QUEUE_TIMEOUT)
+
+
+class LLMError(Exception):
+    def __init__(self, status_code, body):
+        super().__init__(f"LLM request failed with status {status_code}")
+        self.status_code = status_code
+        self.body = body
+
+
+def get_client():
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                keepalive_expiry=LLM_KEEPALIVE_SECONDS,
+            ),
+            timeout=httpx.Timeout(30.0, connect=LLM_CONNECT_TIMEOUT),
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _headers():
+    return {
+        "Authorization": f"Bearer {os.getenv('OPENROUTER_API_KEY')}",
+        "Content-Type": "application/json"
+    }
+
+
+async def chat_completion(messages, max_tokens, temperature, timeout=30):
+    """
+    Returns the content of the first choice; raises LLMError on a non-200
+    response, httpx.HTTPError on network errors or timeouts and Overloaded
+    when no slot frees up in time.
+    """
+    payload = {
+        "model": LLM_MODEL,
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": temperature
+    }
+    async with llm_admission.slot():
+        # timed once a slot is free: queueing behind LLM_MAX_CONCURRENCY is ours, not upstream's
+        start = time.perf_counter()
+        try:
+            response = await get_client().post(
+                OPENROUTER_URL,
+                headers=_headers(),
+                json=payload,
+                timeout=httpx.Timeout(timeout, connect=LLM_CONNECT_TIMEOUT)
+            )
+        except httpx.HTTPError:
+            LLM_ERRORS.inc(status=0)
+            raise
+        LLM_REQUEST_SECONDS.observe(time.perf_counter() - start, kind="chat")
+
+    if response.status_code != 200:
+        LLM_ERRORS.inc(status=response.status_code)
+        raise LLMError(response.status_code, response.text)
+    return response.json()["choices"][0]["message"]["content"]
+
+
+async def stream_chat_completion(messages, max_tokens, temperature, timeout=30):
+    """
+    Yields the content of the first choice as it is generated (the
+    upstream's server-sent "data:" events); raises like chat_completion.
+    """
+    payload = {
+        "model": LLM_MODEL,
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "stream": True
+    }
+    async with llm_admission.slot():
+        start = time.perf_counter()
+        first_token = True
+        try:
+            async with get_client().stream(
+                "POST",
+                OPENROUTER_URL,
+                headers=_headers(),
+                json=payload,
+                timeout=httpx.Timeout(timeout, connect=LLM_CONNECT_TIMEOUT)
+            ) as response:
+                if response.status_code != 200:
+                    LLM_ERRORS.inc(status=response.status_code)
+                    raise LLMError(response.status_code, (await response.aread()).decode(errors="replace"))
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        # blank separators and ": keep-alive" comments
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    choices = json.loads(data).get("choices") or [{}]
+                    content = choices[0].get("delta", {}).get("content")
+                    if content:
+                        if first_token:
+                            LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - start)
+                            first_token = False
+                        yield content
+        except httpx.HTTPError:
+            LLM_ERRORS.inc(status=0)
+            raise
+        LLM_REQUEST_SECONDS.observe(time.perf_counter() - start, kind="stream")
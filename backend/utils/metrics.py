@@ -0,0 +1,396 @@
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from utils.atomic_file import write_json
+
+# requests slower than this (seconds) are logged with their stage breakdown; 0 disables
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "0"))
+METRICS_PREFIX = "roledoc_"
+# with several workers, each writes its metrics here every METRICS_FLUSH_INTERVAL
+# seconds and /metrics serves them all, labelled by worker pid; empty: this process only
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "10"))
+# spans kept per request trace; a /query-batch request runs its stages per query
+TRACE_MAX_SPANS = 256
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = METRICS_PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), self._copy(value)] for key, value in sorted(self._values.items())]
+
+    def _copy(self, value):
+        return value
+
+    def render(self):
+        lines = self.header()
+        for key, value in self.snapshot():
+            lines.extend(self._samples(key, value))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, total, **labels):
+        # for counters kept elsewhere (cache hit counts), copied in at scrape time
+        with self._lock:
+            self._values[self._key(labels)] = total
+
+    def _samples(self, key, value, extra=()):
+        return [f"{self.name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}"]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.set_total(value, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            counts, _, _ = state
+            counts[bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _copy(self, state):
+        return [list(state[0]), state[1], state[2]]
+
+    def _samples(self, key, state, extra=()):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, list(extra) + [("le", _format_value(bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key, extra)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # called before every scrape to copy in values kept elsewhere
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self):
+        for collect in self.collectors:
+            collect()
+
+    def render(self):
+        self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def write_snapshot(self, directory):
+        self.collect()
+        snapshot = {metric.name: metric.snapshot() for metric in self.metrics}
+        write_json(os.path.join(directory, f"{os.getpid()}.json"), snapshot)
+
+    def render_workers(self, directory):
+        """
+        render() for every worker writing snapshots to directory (see
+        start_snapshots), each series labelled with its worker's pid. This
+        worker's numbers are current, the others' as of their last write;
+        snapshots of workers that exited are removed.
+        """
+        self.write_snapshot(directory)
+        snapshots = {}
+        for name in os.listdir(directory):
+            pid = name[:-len(".json")]
+            if not name.endswith(".json") or not pid.isdigit():
+                continue
+            path = os.path.join(directory, name)
+            if not _alive(int(pid)):
+                _remove(path)
+                continue
+            try:
+                with open(path, "r") as f:
+                    snapshots[pid] = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.header())
+            for pid in sorted(snapshots, key=int):
+                for key, value in snapshots[pid].get(metric.name, []):
+                    lines.extend(metric._samples(key, value, [("worker", pid)]))
+        return "\n".join(lines) + "\n"
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+registry = Registry()
+
+HTTP_REQUEST_SECONDS = registry.register(Histogram(
+    "http_request_duration_seconds", "Time from request start to the last response byte.",
+    ("method", "path", "status"),
+))
+STAGE_SECONDS = registry.register(Histogram(
+    "stage_duration_seconds", "Time spent per request stage (retrieval, llm, ...).", ("stage",),
+))
+LLM_REQUEST_SECONDS = registry.register(Histogram(
+    "llm_request_duration_seconds", "Upstream LLM call time, to the end of the answer.", ("kind",),
+))
+LLM_FIRST_TOKEN_SECONDS = registry.register(Histogram(
+    "llm_first_token_seconds", "Upstream LLM time to the first streamed token.",
+))
+LLM_ERRORS = registry.register(Counter(
+    "llm_errors_total", "Failed upstream LLM calls by HTTP status (0: no response).", ("status",),
+))
+INDEX_LOADS = registry.register(Counter(
+    "index_loads_total", "Document indexes read from disk, by artifact format.", ("format",),
+))
+INDEX_LOAD_SECONDS = registry.register(Histogram(
+    "index_load_duration_seconds", "Time to read one document index from disk.",
+))
+CACHE_HITS = registry.register(Counter("cache_hits_total", "Cache hits by cache.", ("cache",)))
+CACHE_MISSES = registry.register(Counter("cache_misses_total", "Cache misses by cache.", ("cache",)))
+CACHE_HIT_RATIO = registry.register(Gauge(
+    "cache_hit_ratio", "Hits over lookups since the worker started, by cache.", ("cache",),
+))
+ADMISSION_IN_FLIGHT = registry.register(Gauge(
+    "admission_in_flight", "Admitted calls holding a slot, by pool (llm, retrieval, ingest).", ("pool",),
+))
+ADMISSION_QUEUE_DEPTH = registry.register(Gauge(
+    "admission_queue_depth", "Admitted calls waiting for a slot, by pool.", ("pool",),
+))
+ADMISSION_REJECTED = registry.register(Counter(
+    "admission_rejected_total", "Calls turned away, by pool and reason (queue_full, timeout).",
+    ("pool", "reason"),
+))
+ADMISSION_WAIT_SECONDS = registry.register(Histogram(
+    "admission_wait_seconds", "Time admitted calls waited for a slot, by pool.", ("pool",),
+))
+
+
+def start_snapshots(directory=METRICS_DIR, interval=METRICS_FLUSH_INTERVAL):
+    """
+    Writes this worker's snapshot to directory every interval seconds, from
+    a daemon thread, for render_workers in whichever worker gets scraped.
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    def run():
+        while True:
+            try:
+                registry.write_snapshot(directory)
+            except Exception as e:
+                print(f">> Could not save metrics: {e}")
+            time.sleep(interval)
+
+    threading.Thread(target=run, name="metrics-snapshots", daemon=True).start()
+
+
+def _copy_cache_counts(name, cache):
+    lookups = cache.hits + cache.misses
+    CACHE_HITS.set_total(cache.hits, cache=name)
+    CACHE_MISSES.set_total(cache.misses, cache=name)
+    CACHE_HIT_RATIO.set(cache.hits / lookups if lookups else 0.0, cache=name)
+
+
+def track_cache(name, cache):
+    """
+    Exposes cache.hits / cache.misses (IndexCache, ResponseCache) at every scrape.
+    """
+    registry.collectors.append(lambda: _copy_cache_counts(name, cache))
+
+
+def track_module_cache(name, module, attribute):
+    """
+    track_cache for a cache living in a module that is imported lazily:
+    reported once something else has imported it.
+    """
+    def collect():
+        # a module another thread is still importing has no cache yet
+        cache = getattr(sys.modules.get(module), attribute, None)
+        if cache is not None:
+            _copy_cache_counts(name, cache)
+    registry.collectors.append(collect)
+
+
+class Trace:
+    """
+    Stages of one request: (name, offset from the request start, seconds),
+    the first TRACE_MAX_SPANS of them.
+    """
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.start = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+
+    def add(self, stage, start, seconds):
+        if len(self.spans) < TRACE_MAX_SPANS:
+            self.spans.append((stage, start - self.start, seconds))
+        else:
+            self.dropped += 1
+
+    def breakdown(self):
+        return [
+            {"stage": name, "start_ms": round(offset * 1000, 2), "ms": round(seconds * 1000, 2)}
+            for name, offset, seconds in self.spans
+        ]
+
+
+_current_trace = ContextVar("trace", default=None)
+
+
+def current_request_id():
+    trace = _current_trace.get()
+    return trace.request_id if trace is not None else None
+
+
+@contextmanager
+def span(stage):
+    """
+    Times a stage into STAGE_SECONDS and, inside a request, into its
+    trace. Threadpool calls and tasks started by the request inherit it.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        STAGE_SECONDS.observe(seconds, stage=stage)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(stage, start, seconds)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware: gives every HTTP request an id (X-Request-ID, taken
+    from the request when it has one), a trace for its spans and a
+    duration measured to the last body byte, so streamed answers count in
+    full. Requests slower than SLOW_REQUEST_SECONDS are logged with
+    their stage breakdown.
+    """
+
+    def __init__(self, app, slow_request_seconds=SLOW_REQUEST_SECONDS):
+        self.app = app
+        self.slow_request_seconds = slow_request_seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1")[:64] or uuid.uuid4().hex
+        trace = Trace(request_id)
+        token = _current_trace.set(trace)
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            _current_trace.reset(token)
+            seconds = time.perf_counter() - trace.start
+            route = scope.get("route")
+            # the route template keeps path parameters (job ids) out of the labels
+            path = getattr(route, "path", None) or "unmatched"
+            HTTP_REQUEST_SECONDS.observe(seconds, method=scope["method"], path=path, status=status)
+            if self.slow_request_seconds and seconds >= self.slow_request_seconds:
+                print(">> Slow request " + json.dumps({
+                    "request_id": request_id,
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status,
+                    "ms": round(seconds * 1000, 2),
+                    "stages": trace.breakdown(),
+                    "stages_dropped": trace.dropped,
+                }))
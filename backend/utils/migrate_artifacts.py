@@ -0,0 +1,125 @@
+"""
+Converts the JSON (.index, _chunks.json, _vectorizer.json) and pickle
+(_chunks.pkl, _vectorizer.pkl, _vectors.pkl) artifacts in VECTOR_DIR into
+the binary per-document artifact:
+
+    cd backend
+    python -m utils.migrate_artifacts            # migrate and delete the old files
+    python -m utils.migrate_artifacts --dry-run  # only list what would change
+    python -m utils.migrate_artifacts --keep     # migrate, keep the old files
+
+Pickles are only ever loaded from VECTOR_DIR; do not point this at files
+you do not trust.
+"""
+import os
+import json
+import pickle
+import argparse
+
+import faiss
+import numpy as np
+
+from utils.embed_store import (
+    ARTIFACT_SUFFIX, PICKLE_SUFFIXES, VECTOR_DIR, _to_cosine_index, artifact_path,
+    legacy_artifact_paths, load_vectorizer, normalized, remove_legacy_artifacts,
+    write_artifact,
+)
+
+LEGACY_SUFFIXES = (".index", "_chunks.json", "_vectorizer.json") + PICKLE_SUFFIXES
+
+
+def legacy_documents():
+    names = set()
+    for name in os.listdir(VECTOR_DIR):
+        for suffix in LEGACY_SUFFIXES:
+            if name.endswith(suffix):
+                names.add(name[:-len(suffix)])
+    return sorted(names)
+
+
+def _load_pickle(file_name, suffix):
+    with open(os.path.join(VECTOR_DIR, f"{file_name}{suffix}"), "rb") as f:
+        return pickle.load(f)
+
+
+def read_legacy(file_name):
+    """
+    Returns (vectorizer, chunks, index) from the newest legacy artifacts
+    present, or None if they are incomplete.
+    """
+    index_path, chunks_path, vectorizer_path = legacy_artifact_paths(file_name)
+    if os.path.exists(chunks_path) and os.path.exists(vectorizer_path):
+        with open(chunks_path, "r", encoding="utf-8") as f:
+            chunks = json.load(f)
+        vectorizer = load_vectorizer(file_name)
+    elif all(os.path.exists(os.path.join(VECTOR_DIR, f"{file_name}{s}")) for s in PICKLE_SUFFIXES[:2]):
+        chunks = _load_pickle(file_name, "_chunks.pkl")
+        vectorizer = _load_pickle(file_name, "_vectorizer.pkl")
+        vectorizer.set_vocabulary(
+            {word: int(idx) for word, idx in vectorizer.vocabulary.items()}, vectorizer.idf_values
+        )
+    else:
+        return None
+
+    if os.path.exists(index_path):
+        index = faiss.read_index(index_path)
+        if index.metric_type != faiss.METRIC_INNER_PRODUCT:
+            index = _to_cosine_index(index)
+    elif os.path.exists(os.path.join(VECTOR_DIR, f"{file_name}_vectors.pkl")):
+        vectors = np.array(_load_pickle(file_name, "_vectors.pkl"), dtype=np.float32)
+        index = faiss.IndexFlatIP(len(vectorizer.vocabulary))
+        if len(vectors):
+            index.add(normalized(np.ascontiguousarray(vectors)))
+    else:
+        return None
+
+    if index.ntotal != len(chunks) or index.d != len(vectorizer.vocabulary):
+        return None
+    return vectorizer, chunks, index
+
+
+def migrate(dry_run=False, keep=False):
+    migrated, removed, skipped = [], [], []
+    for file_name in legacy_documents():
+        if os.path.exists(artifact_path(file_name)):
+            # already migrated or re-indexed; what is left is stale
+            removed.append(file_name)
+            if not dry_run and not keep:
+                remove_legacy_artifacts(file_name)
+            continue
+        document = read_legacy(file_name)
+        if document is None:
+            skipped.append(file_name)
+            continue
+        migrated.append(file_name)
+        if dry_run:
+            continue
+        vectorizer, chunks, index = document
+        write_artifact(file_name, vectorizer, chunks, index)
+        if not keep:
+            remove_legacy_artifacts(file_name)
+    return migrated, removed, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=f"Convert legacy index files to {ARTIFACT_SUFFIX} artifacts")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would change")
+    parser.add_argument("--keep", action="store_true", help="keep the legacy files")
+    args = parser.parse_args(argv)
+
+    migrated, removed, skipped = migrate(dry_run=args.dry_run, keep=args.keep)
+    for file_name in migrated:
+        print(f"would migrate {file_name}" if args.dry_run else f"migrated {file_name}")
+    for file_name in removed:
+        if args.keep:
+            print(f"stale legacy files for {file_name} kept")
+        elif args.dry_run:
+            print(f"would remove stale legacy files for {file_name}")
+        else:
+            print(f"stale legacy files for {file_name} removed")
+    for file_name in skipped:
+        print(f"skipped {file_name}: incomplete or inconsistent legacy files")
+
+
+if __name__ == "__main__":
+    main()
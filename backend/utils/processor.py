@@ -1,8 +1,30 @@
-from utils.extract_text import extract_text
-from utils.embed_store import embed_and_store, query_vector_store
+import os
 
-def process_and_store(file_path, file_name):
+from utils.extract_text import extract_text, iter_text_pages
+from utils.embed_store import embed_and_store_pages, query_vector_store
+
+# page-by-page ingestion keeps peak memory bounded by a page instead of the document
+STREAMING_INGEST = os.getenv("STREAMING_INGEST", "true").lower() == "true"
+
+def _report_pages(pages, progress):
+    for count, page in enumerate(pages, 1):
+        yield page
+        progress("extract", pages=count)
+
+def process_and_store(file_path, file_name, streaming=STREAMING_INGEST, progress=None,
+                      source_hash=None):
+    """
+    Extracts and indexes file_path; returns the number of chunks indexed
+    (0 when no text could be extracted, leaving any earlier version).
+    """
+    if streaming:
+        pages = iter_text_pages(file_path)
+        if progress:
+            pages = _report_pages(pages, progress)
+        return embed_and_store_pages(pages, file_name, progress=progress, source_hash=source_hash)
+    if progress:
+        progress("extract")
     text = extract_text(file_path)
-    embed_and_store(text, file_name)
+    return embed_and_store_pages([text], file_name, progress=progress, source_hash=source_hash)
 
 __all__ = ['process_and_store', 'query_vector_store']
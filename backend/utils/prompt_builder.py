@@ -0,0 +1,217 @@
+import os
+import re
+import json
+import threading
+from collections import OrderedDict
+
+from utils.tokens import estimate_tokens
+
+# context window per model, in tokens; other models get PROMPT_DEFAULT_CONTEXT_TOKENS
+MODEL_CONTEXT_TOKENS = {
+    "mistralai/mistral-7b-instruct": 32768,
+    "meta-llama/llama-3-8b-instruct": 8192,
+    "google/gemma-7b-it": 8192,
+    "openai/gpt-3.5-turbo": 16385,
+    "openai/gpt-4o-mini": 128000,
+}
+PROMPT_DEFAULT_CONTEXT_TOKENS = int(os.getenv("PROMPT_DEFAULT_CONTEXT_TOKENS", "4096"))
+# input tokens worth sending whatever the window: past this, more context mostly
+# adds latency and cost. PROMPT_MODEL_INPUT_TOKENS is a JSON {model: tokens} override
+PROMPT_MAX_INPUT_TOKENS = int(os.getenv("PROMPT_MAX_INPUT_TOKENS", "2500"))
+PROMPT_MODEL_INPUT_TOKENS = json.loads(os.getenv("PROMPT_MODEL_INPUT_TOKENS", "{}"))
+
+# history: the last PROMPT_HISTORY_RECENT messages verbatim, older ones folded into
+# a rolling summary; both together get at most PROMPT_HISTORY_TOKENS
+PROMPT_HISTORY_RECENT = int(os.getenv("PROMPT_HISTORY_RECENT", "4"))
+PROMPT_HISTORY_TOKENS = int(os.getenv("PROMPT_HISTORY_TOKENS", "500"))
+PROMPT_SUMMARY_WORDS = int(os.getenv("PROMPT_SUMMARY_WORDS", "25"))
+# summary lines kept per user; older ones would not fit the budget anyway
+PROMPT_SUMMARY_LINES = int(os.getenv("PROMPT_SUMMARY_LINES", "40"))
+PROMPT_SUMMARY_USERS = int(os.getenv("PROMPT_SUMMARY_USERS", "1000"))
+
+# a chunk sharing this much of its word 5-grams with a better chunk is dropped
+PROMPT_DEDUP_THRESHOLD = float(os.getenv("PROMPT_DEDUP_THRESHOLD", "0.6"))
+SHINGLE_SIZE = 5
+
+# the full prompt context is printed only when asked for
+PROMPT_LOG_CONTEXT = os.getenv("PROMPT_LOG_CONTEXT", "false").lower() == "true"
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+
+def input_budget(model, max_tokens):
+    """
+    Tokens the prompt may use for model, leaving room for max_tokens of reply.
+    """
+    window = MODEL_CONTEXT_TOKENS.get(model, PROMPT_DEFAULT_CONTEXT_TOKENS)
+    cap = PROMPT_MODEL_INPUT_TOKENS.get(model, PROMPT_MAX_INPUT_TOKENS)
+    return max(0, min(cap, window - max_tokens))
+
+
+def _shingles(text):
+    words = text.lower().split()
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def select_chunks(results, token_budget, dedup_threshold=PROMPT_DEDUP_THRESHOLD):
+    """
+    Best-first chunks (dicts with "text" and "score") that fit token_budget,
+    skipping any chunk mostly contained in one already kept (the same
+    section in two files, or two copies of a document). A chunk that does
+    not fit is skipped so a smaller one after it can still be used; the
+    top chunk is always kept, cut to the budget if it has to be.
+    """
+    kept = []
+    kept_shingles = []
+    used = 0
+    for chunk in sorted(results, key=lambda chunk: chunk["score"], reverse=True):
+        shingles = _shingles(chunk["text"])
+        if shingles and any(
+            len(shingles & other) >= dedup_threshold * len(shingles) for other in kept_shingles
+        ):
+            continue
+        cost = estimate_tokens(chunk["text"])
+        if used + cost > token_budget:
+            if kept:
+                continue
+            chunk = dict(chunk, text=chunk["text"][:max(token_budget, 1) * 4])
+            cost = estimate_tokens(chunk["text"])
+        kept.append(chunk)
+        kept_shingles.append(shingles)
+        used += cost
+    return kept
+
+
+def format_context(chunks, file_names):
+    """
+    (context, high_quality_match, sources) for the selected chunks, grouped
+    per file in the order file_names were given, best chunk first.
+    """
+    context_parts = []
+    sources = []
+    high_quality_match = False
+    for fname in file_names:
+        file_chunks = [chunk for chunk in chunks if chunk["file_name"] == fname]
+        if not file_chunks:
+            continue
+        ctx = "\n\n".join(chunk["text"] for chunk in file_chunks)
+        sources.extend(
+            {"file_name": fname, "chunk_id": chunk["chunk_id"], "score": chunk["score"]}
+            for chunk in file_chunks
+        )
+        if len(ctx) > 100 and file_chunks[0]["score"] >= 0.6:
+            high_quality_match = True
+        context_parts.append(f"Document context for {fname}:\n{ctx}")
+
+    if not context_parts:
+        return "No specific document context available.", False, []
+    document_list = ", ".join(file_names)
+    context = f"The following document(s) are relevant: {document_list}.\n\n" + "\n\n".join(context_parts)
+    return context, high_quality_match, sources
+
+
+def _role(message):
+    return "User" if message["role"] == "user" else "Assistant"
+
+
+def _gist(message, max_words=PROMPT_SUMMARY_WORDS):
+    # first sentence, cut to max_words
+    text = " ".join(message["message"].split())
+    sentence = SENTENCE_END.split(text, 1)[0]
+    words = sentence.split()
+    gist = " ".join(words[:max_words])
+    return gist + ("..." if len(words) > max_words else "")
+
+
+class HistorySummaries:
+    """
+    Per user rolling summary of the messages older than the verbatim
+    window: one line with the gist of each message, newest kept when it
+    outgrows its budget. Each request only folds in the messages that
+    left the window since the last one, so the summary is never rebuilt
+    from the whole history.
+    """
+
+    def __init__(self, history_store, recent=PROMPT_HISTORY_RECENT, max_users=PROMPT_SUMMARY_USERS):
+        self.history_store = history_store
+        self.recent = recent
+        self.max_users = max_users
+        # user_id -> (messages summarized, summary lines)
+        self._summaries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _summary(self, user_id, count, window):
+        """
+        Summary lines for messages [0, count - recent), window being the
+        newest messages as history_store.tail returned them.
+        """
+        end = count - self.recent
+        with self._lock:
+            covered, lines = self._summaries.get(user_id, (0, []))
+        if covered > end:
+            # history was compacted or rewritten underneath us; start over
+            covered, lines = 0, []
+        first = count - len(window)
+        start = max(covered, first)
+        if start < end:
+            lines = lines + [f"{_role(m)}: {_gist(m)}" for m in window[start - first:end - first]]
+            lines = lines[-PROMPT_SUMMARY_LINES:]
+            covered = end
+        with self._lock:
+            self._summaries[user_id] = (covered, lines)
+            self._summaries.move_to_end(user_id)
+            while len(self._summaries) > self.max_users:
+                self._summaries.popitem(last=False)
+        return lines
+
+    def render(self, user_id, token_budget=PROMPT_HISTORY_TOKENS):
+        """
+        (conversation text, recent messages) within token_budget: the
+        recent messages verbatim (newest first to be kept), then as much of
+        the summary of earlier ones as still fits.
+        """
+        if not user_id:
+            return "", []
+        count = self.history_store.count(user_id)
+        if not count:
+            return "", []
+        window = self.history_store.tail(user_id, min(count, self.history_store.tail_size))
+        recent = window[-self.recent:] if self.recent else []
+        summary = self._summary(user_id, count, window)
+
+        used = 0
+        recent_lines = []
+        for message in reversed(recent):
+            line = f"{_role(message)}: {message['message']}"
+            cost = estimate_tokens(line)
+            if used + cost > token_budget:
+                break
+            recent_lines.append(line)
+            used += cost
+        summary_lines = []
+        for line in reversed(summary):
+            cost = estimate_tokens(line)
+            if used + cost > token_budget:
+                break
+            summary_lines.append(line)
+            used += cost
+
+        text = ""
+        if summary_lines:
+            text += "Earlier in the conversation:\n" + "\n".join(reversed(summary_lines)) + "\n\n"
+        text += "".join(f"{line}\n" for line in reversed(recent_lines))
+        return text, recent
+
+
+def log_prompt(messages, context, chunks, history_text):
+    if PROMPT_LOG_CONTEXT:
+        print(">>> Final context sent to LLM:\n", context)
+        return
+    total = sum(estimate_tokens(message["content"]) for message in messages)
+    files = len({chunk["file_name"] for chunk in chunks})
+    print(
+        f">> Prompt: ~{total} tokens ({len(chunks)} chunks from {files} files, "
+        f"~{estimate_tokens(context)} context, ~{estimate_tokens(history_text)} history)"
+    )
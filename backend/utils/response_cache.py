@@ -0,0 +1,168 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from utils.atomic_file import write_json
+from utils.index_cache import file_signature
+from utils.tokens import STOP_WORDS
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+# empty keeps the cache in memory only
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "")
+# also key on the retrieved chunk ids, so a changed retrieval never reuses an answer
+RESPONSE_CACHE_KEY_CHUNKS = os.getenv("RESPONSE_CACHE_KEY_CHUNKS", "false").lower() == "true"
+
+WORD_PATTERN = re.compile(r"\w+")
+# words that point back at the conversation; only a query using one is
+# answered from its history, so only its key includes that history
+FOLLOW_UP_WORDS = frozenset({
+    'it', 'its', 'this', 'that', 'these', 'those', 'they', 'them', 'their', 'he', 'she',
+    'him', 'her', 'his', 'one', 'ones', 'same', 'other', 'another', 'else', 'more',
+    'again', 'also', 'above', 'previous', 'earlier', 'before', 'last', 'then',
+})
+
+
+def normalize_query(query):
+    """
+    "Summarize the file!" and "summarize file" normalize to the same key.
+    """
+    words = WORD_PATTERN.findall(query.lower())
+    return " ".join(word for word in words if word not in STOP_WORDS)
+
+
+def refers_to_history(query):
+    """
+    "Summarize the file" reads the same after any conversation; "tell me
+    more about that" does not.
+    """
+    return any(word in FOLLOW_UP_WORDS for word in WORD_PATTERN.findall(query.lower()))
+
+
+class ResponseCache:
+    def __init__(self, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 directory=RESPONSE_CACHE_DIR):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # keys dropped on the event loop whose files put removes from its thread
+        self._stale_files = []
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load_directory()
+
+    def make_key(self, query, file_names, mode, chunk_ids=None, conversation=""):
+        from utils.embed_store import artifact_paths
+
+        # a re-indexed document changes its artifact signature, and with it every key
+        documents = [
+            [name, file_signature(artifact_paths(name))] for name in sorted(set(file_names))
+        ]
+        # conversation is the history rendered into the prompt; a follow-up
+        # is answered from it, so it only shares an answer with the same history
+        history = ""
+        if conversation and refers_to_history(query):
+            history = hashlib.sha256(conversation.encode()).hexdigest()
+        raw = json.dumps([normalize_query(query), documents, mode, chunk_ids, history])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Never touches the disk, so it is safe on the event loop.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["expires_at"] < time.time():
+                if entry is not None:
+                    del self._entries[key]
+                    self._stale_files.append(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry["value"]
+
+    def put(self, key, value, file_names):
+        """
+        Blocks on a disk write when the cache has a directory; call it from
+        a thread in async code.
+        """
+        entry = {
+            "expires_at": time.time() + self.ttl,
+            "documents": sorted(set(file_names)),
+            "value": value,
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            evicted = []
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[0])
+            evicted += [stale for stale in self._stale_files if stale not in self._entries]
+            self._stale_files = []
+        if self.directory:
+            self._write_entry(key, entry)
+            self._remove_files(evicted)
+
+    def invalidate_document(self, file_name):
+        """
+        Blocks on removing files when the cache has a directory; call it
+        from a thread in async code.
+        """
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if file_name in entry["documents"]]
+            for key in stale:
+                del self._entries[key]
+        self._remove_files(stale)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            stale = list(self._entries)
+            self._entries.clear()
+        self._remove_files(stale)
+
+    def _remove_files(self, keys):
+        if not self.directory:
+            return
+        for key in keys:
+            try:
+                os.remove(os.path.join(self.directory, f"{key}.json"))
+            except OSError:
+                pass
+
+    def _write_entry(self, key, entry):
+        write_json(os.path.join(self.directory, f"{key}.json"), entry, ensure_ascii=False)
+
+    def _load_directory(self):
+        now = time.time()
+        loaded = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if entry.get("expires_at", 0) < now:
+                os.remove(path)
+                continue
+            loaded.append((os.path.getmtime(path), name[:-len(".json")], entry))
+        # oldest first, so the most recently written entries survive the size limit
+        for _, key, entry in sorted(loaded):
+            self._entries[key] = entry
+        evicted = []
+        while len(self._entries) > self.max_entries:
+            evicted.append(self._entries.popitem(last=False)[0])
+        self._remove_files(evicted)
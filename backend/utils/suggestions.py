@@ -0,0 +1,194 @@
+import os
+import re
+import math
+from collections import Counter
+
+from utils.tokens import STOP_WORDS, tokenize
+
+# where follow-up questions come from: "local" ranks phrases picked from the
+# document when it was indexed, in microseconds; "llm" asks the model every time
+SUGGESTIONS_SOURCE = os.getenv("SUGGESTIONS_SOURCE", "local").lower()
+if SUGGESTIONS_SOURCE not in ("local", "llm"):
+    raise ValueError("SUGGESTIONS_SOURCE must be local or llm")
+# with "local", documents indexed before phrases were stored ask the llm instead
+SUGGESTIONS_LLM_FALLBACK = os.getenv("SUGGESTIONS_LLM_FALLBACK", "true").lower() == "true"
+SUGGESTION_COUNT = 4
+# phrases stored per document
+SUGGESTION_CANDIDATES = int(os.getenv("SUGGESTION_CANDIDATES", "40"))
+
+HEADING_MAX_WORDS = 5
+# distinct headings kept per document, in the order they appear
+HEADING_LIMIT = 1000
+# distinct word pairs counted before the ones seen once are dropped
+PHRASE_COUNTER_LIMIT = 200000
+# documents with fewer chunks keep phrases that occur only once
+PHRASE_MIN_CHUNKS = 20
+
+# words that make a poor start or end of a phrase, on top of STOP_WORDS
+PHRASE_STOP_WORDS = STOP_WORDS | frozenset({
+    'also', 'any', 'can', 'each', 'from', 'into', 'its', 'may', 'more', 'most',
+    'must', 'not', 'one', 'only', 'other', 'our', 'out', 'over', 'such', 'than',
+    'their', 'them', 'then', 'there', 'through', 'under', 'upon', 'use', 'used',
+    'using', 'very', 'what', 'when', 'where', 'which', 'while', 'who', 'why', 'how',
+    'all', 'both', 'either', 'every', 'few', 'her', 'him', 'his', 'many', 'much',
+    'own', 'same', 'some', 'your', 'about', 'above', 'after', 'again', 'against',
+    'before', 'below', 'between', 'during', 'further', 'here', 'once', 'off', 'well',
+    'like', 'just', 'even', 'still', 'yet', 'shall', 'being', 'having', 'doing',
+    'page', 'figure', 'table', 'example', 'see', 'etc', 'per', 'via', 'without', 'within',
+    'whether', 'until', 'since', 'because', 'although', 'though', 'however', 'therefore',
+    'thus', 'might', 'often', 'usually', 'always', 'never', 'several', 'various', 'another',
+    'now', 'new', 'known', 'across', 'make', 'makes', 'made', 'get', 'gets', 'take', 'takes',
+})
+# words and single other characters, which end a run of phrase words
+PHRASE_TOKEN = re.compile(r"[A-Za-z]+(?:[-'][A-Za-z]+)*|\S")
+HEADING_NUMBER = re.compile(r"^(?:\d[\d\.]*[\)\.]?|Step \d+|Section \d+)\s*[:\-.]?\s*", re.IGNORECASE)
+
+
+def _phrase_word(word):
+    word = word.lower()
+    return len(word) > 2 and word.isalpha() and word not in PHRASE_STOP_WORDS
+
+
+class PhraseCollector:
+    """
+    Suggestion candidates for one document, gathered while it is indexed:
+    section headings (the lines SECTION_PATTERN matches) and key phrases,
+    word pairs repeated across the chunks, weighted by the TF-IDF inverse
+    document frequency of their words. Memory is bounded by
+    PHRASE_COUNTER_LIMIT distinct pairs and HEADING_LIMIT headings, not
+    by the document.
+    """
+
+    def __init__(self, limit=SUGGESTION_CANDIDATES):
+        self.limit = limit
+        self.headings = {}
+        self.pairs = Counter()
+        # spelling of each pair for display, preferring consistent capitalization
+        self.spellings = {}
+
+    def add_heading(self, line):
+        text = HEADING_NUMBER.sub("", line.strip()).strip(" :.-")
+        words = text.split()
+        if not 1 <= len(words) <= HEADING_MAX_WORDS or not tokenize(text):
+            return
+        if not all(any(ch.isalpha() for ch in word) for word in words):
+            return
+        if len(self.headings) < HEADING_LIMIT:
+            self.headings.setdefault(text.lower(), text)
+
+    def add(self, chunk):
+        run = []
+        for token in PHRASE_TOKEN.findall(chunk):
+            if _phrase_word(token):
+                run.append(token)
+                continue
+            self._count(run)
+            run = []
+        self._count(run)
+        if len(self.pairs) > PHRASE_COUNTER_LIMIT:
+            self.pairs = Counter({pair: count for pair, count in self.pairs.items() if count > 1})
+            self.spellings = {pair: self.spellings[pair] for pair in self.pairs}
+
+    def _count(self, run):
+        for first, second in zip(run, run[1:]):
+            pair = (first.lower(), second.lower())
+            self.pairs[pair] += 1
+            if pair not in self.spellings or first[0].isupper() == second[0].isupper():
+                self.spellings[pair] = f"{first} {second}"
+
+    def finish(self, doc_freq, num_chunks):
+        """
+        Up to limit candidates, {"text", "kind": "heading" | "phrase",
+        "terms", "score"}, strongest first. Phrase scores are occurrences
+        times the mean idf of their words over doc_freq, the counts the
+        vectorizer is fitted from (smoothed to stay positive), times how
+        often the words occur together rather than apart, relative to the
+        strongest phrase; headings score by position, the first ones being
+        the document's outline. The chunker keeps only a heading's number,
+        so a heading is kept only when all its words occur in the chunks,
+        or asking it would retrieve nothing.
+        """
+        min_count = 2 if num_chunks >= PHRASE_MIN_CHUNKS else 1
+        weighted = []
+        for pair, count in self.pairs.items():
+            if count < min_count:
+                continue
+            freqs = [doc_freq.get(word, 0) for word in pair]
+            idf = sum(math.log((num_chunks + 1) / (freq + 1)) + 1 for freq in freqs) / 2
+            cohesion = min(1.0, count / max(max(freqs), 1))
+            weighted.append((count * idf * cohesion, pair))
+        weighted.sort(reverse=True)
+        top = weighted[0][0] if weighted else 1.0
+
+        candidates = []
+        seen = set()
+        headings = [
+            text for text in self.headings.values()
+            if all(doc_freq.get(term, 0) for term in tokenize(text))
+        ]
+        for position, text in enumerate(headings):
+            terms = tokenize(text)
+            key = tuple(sorted(term.rstrip("s") for term in terms))
+            if key in seen:
+                continue
+            seen.add(key)
+            score = 1.0 - position / (2 * len(headings))
+            candidates.append({"text": text, "kind": "heading", "terms": terms, "score": round(score, 4)})
+        for weight, pair in weighted:
+            # "control chart" and "control charts" are one suggestion
+            key = tuple(sorted(word.rstrip("s") for word in pair))
+            if key in seen:
+                continue
+            seen.add(key)
+            candidates.append({
+                "text": self.spellings[pair],
+                "kind": "phrase",
+                "terms": list(pair),
+                "score": round(weight / top, 4),
+            })
+            if len(candidates) >= 2 * self.limit:
+                break
+        candidates.sort(key=lambda candidate: candidate["score"], reverse=True)
+        return candidates[:self.limit]
+
+
+def retrievable(candidates, bm25):
+    """
+    The candidates whose words all occur in the document's chunks, for
+    candidates stored before finish checked them; bm25 is the document's
+    BM25Index.
+    """
+    return [
+        candidate for candidate in candidates
+        if all(bm25.term_id(term) is not None for term in candidate["terms"])
+    ]
+
+
+def rank_suggestions(query, candidates, chunks=(), limit=SUGGESTION_COUNT):
+    """
+    Follow-up suggestions for query from the stored candidates of the
+    queried documents. A candidate found in the retrieved chunks (dicts
+    with "text" and "score") gains those chunks' scores, one sharing a term
+    with the query gains a bonus, and the stored score breaks ties, so
+    without a query or chunks the document's strongest come first.
+    Candidates the query already covers are skipped.
+    """
+    query_terms = set(tokenize(query))
+    chunk_terms = [(set(tokenize(chunk["text"])), chunk["score"]) for chunk in chunks]
+    ranked = []
+    for candidate in candidates:
+        terms = set(candidate["terms"])
+        if not terms or terms <= query_terms:
+            continue
+        relevance = sum(score for words, score in chunk_terms if terms <= words)
+        if terms & query_terms:
+            relevance += 0.5
+        ranked.append((relevance + 0.1 * candidate["score"], candidate))
+    ranked.sort(key=lambda item: item[0], reverse=True)
+
+    suggestions = {}
+    for _, candidate in ranked:
+        suggestions.setdefault(candidate["text"].lower(), candidate["text"])
+        if len(suggestions) >= limit:
+            break
+    return list(suggestions.values())
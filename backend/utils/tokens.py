@@ -0,0 +1,21 @@
+import re
+
+STOP_WORDS = frozenset({
+    'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for',
+    'of', 'with', 'by', 'is', 'are', 'was', 'were', 'be', 'been', 'have',
+    'has', 'had', 'do', 'does', 'did', 'will', 'would', 'could', 'should',
+    'this', 'that', 'these', 'those', 'i', 'you', 'he', 'she', 'it', 'we', 'they'
+})
+WORD_PATTERN = re.compile(r'\b[a-zA-Z]{2,}\b')
+
+
+def tokenize(text):
+    return [
+        word for word in WORD_PATTERN.findall(text.lower())
+        if len(word) > 2 and word not in STOP_WORDS
+    ]
+
+
+def estimate_tokens(text):
+    # roughly 4 characters per token for English text
+    return len(text) // 4 + 1
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import threading
+
+from utils.atomic_file import write_json
+
+# a fresh worker loads the documents queried most recently (the hot set) in
+# the background, instead of paying for each one on its first query
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+# comma-separated documents preloaded ahead of the hot set
+WARMUP_DOCUMENTS = [name.strip() for name in os.getenv("WARMUP_DOCUMENTS", "").split(",") if name.strip()]
+WARMUP_HOT_SET_SIZE = int(os.getenv("WARMUP_HOT_SET_SIZE", "8"))
+# shared by every worker; lives next to the indexes it points at
+HOT_SET_PATH = os.getenv("HOT_SET_PATH", os.path.join("vector_db", "hot_documents.json"))
+# minimum seconds between hot set writes from one worker
+HOT_SET_FLUSH_INTERVAL = float(os.getenv("HOT_SET_FLUSH_INTERVAL", "30"))
+
+
+class HotSet:
+    """
+    Last query time per document. Each worker buffers its queries and
+    merges them into one file, so a restarted worker knows what to load.
+    Concurrent merges can drop an update; the file is only a hint.
+    """
+
+    def __init__(self, path=HOT_SET_PATH, size=WARMUP_HOT_SET_SIZE, flush_interval=HOT_SET_FLUSH_INTERVAL):
+        self.path = path
+        self.size = size
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def touch(self, file_names):
+        now = time.time()
+        with self._lock:
+            for name in file_names:
+                self._pending[name] = now
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def _read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+        merged = self._read()
+        for name, queried_at in pending.items():
+            merged[name] = max(queried_at, merged.get(name, 0))
+        # keep some history beyond the hot set, for documents that get deleted
+        kept = sorted(merged.items(), key=lambda item: item[1], reverse=True)[:self.size * 4]
+        try:
+            write_json(self.path, dict(kept))
+        except OSError as e:
+            print(f">> Could not save hot documents: {e}")
+
+    def documents(self):
+        """
+        Most recently queried first, this worker's unsaved queries included.
+        """
+        merged = self._read()
+        with self._lock:
+            for name, queried_at in self._pending.items():
+                merged[name] = max(queried_at, merged.get(name, 0))
+        return sorted(merged, key=merged.get, reverse=True)
+
+
+class Warmup:
+    """
+    Background warm-up of a fresh worker: imports the retrieval stack,
+    brings the corpus index up to date and maps it when corpus is set, and
+    preloads WARMUP_DOCUMENTS and the hot set into the document cache.
+    status goes pending -> warming -> ready; a document that fails to load
+    is reported in errors without holding readiness back.
+    """
+
+    def __init__(self, hot_set, documents=None, enabled=WARMUP_ENABLED, corpus=False):
+        self.hot_set = hot_set
+        self.documents = WARMUP_DOCUMENTS if documents is None else documents
+        self.enabled = enabled
+        self.corpus = corpus
+        self.status = "pending"
+        self.started_at = None
+        self.finished_at = None
+        self.loaded = []
+        self.errors = {}
+
+    @property
+    def ready(self):
+        return self.status == "ready"
+
+    def start(self):
+        if not self.enabled:
+            self.status = "ready"
+            return
+        threading.Thread(target=self.run, name="warmup", daemon=True).start()
+
+    def run(self):
+        self.status = "warming"
+        self.started_at = time.time()
+        try:
+            # faiss, numpy and scipy load here rather than while the worker boots
+            from utils.embed_store import INDEX_CACHE_MAX_ENTRIES, list_documents, preload_document
+
+            if self.corpus:
+                from utils.corpus_index import get_corpus_index, sync_corpus_index
+
+                try:
+                    # documents indexed while no worker was running; other workers wait on its lock
+                    sync_corpus_index()
+                    get_corpus_index()
+                except Exception as e:
+                    self.errors["corpus"] = str(e)
+
+            indexed = set(list_documents())
+            names = [
+                name for name in dict.fromkeys(self.documents + self.hot_set.documents()[:self.hot_set.size])
+                if name in indexed
+            ]
+            for name in names[:INDEX_CACHE_MAX_ENTRIES]:
+                try:
+                    if preload_document(name):
+                        self.loaded.append(name)
+                except Exception as e:
+                    self.errors[name] = str(e)
+        except Exception as e:
+            self.errors["warmup"] = str(e)
+        finally:
+            self.finished_at = time.time()
+            self.status = "ready"
+            print(f">> Warm-up done in {self.finished_at - self.started_at:.2f}s: {len(self.loaded)} documents loaded")
+
+    def state(self):
+        return {
+            "ready": self.ready,
+            "status": self.status,
+            "documents_loaded": self.loaded,
+            "errors": self.errors,
+            "seconds": (
+                round(self.finished_at - self.started_at, 3)
+                if self.finished_at is not None and self.started_at is not None else None
+            ),
+        }
@@ -4,6 +4,27 @@ import { useNavigate } from "react-router-dom";
 import "../styles/Upload.css";
 import Navbar from "../pages/Navbar";
 
+const API_BASE = "https://roledoc.onrender.com";
+const POLL_INTERVAL_MS = 1000;
+const POLL_TIMEOUT_MS = 10 * 60 * 1000;
+
+// rough share of the work done, from the job's current stage
+const jobProgress = (job) => {
+  const stage = job.stages?.[job.stage] || {};
+  switch (job.stage) {
+    case "extract":
+      return 20;
+    case "vectorize":
+      return stage.total ? 30 + Math.round((60 * stage.chunks) / stage.total) : 30;
+    case "write":
+      return 95;
+    default:
+      return 10;
+  }
+};
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
 export default function UploadPage() {
   const [file, setFile] = useState(null);
   const [uploading, setUploading] = useState(false);
@@ -34,36 +55,50 @@ export default function UploadPage() {
     formData.append("file", file);
 
     try {
-      const response = await fetch("https://roledoc.onrender.com/upload", {
+      const response = await fetch(`${API_BASE}/upload`, {
         method: "POST",
         body: formData,
       });
 
+      if (response.status === 503) {
+        const retryAfter = response.headers.get("Retry-After") || "a few";
+        alert(`The server is busy. Please try again in ${retryAfter} seconds.`);
+        setUploading(false);
+        return;
+      }
       if (!response.ok) throw new Error("Upload failed");
 
-      // Animate fake progress
-      let prog = 0;
-      const interval = setInterval(() => {
-        prog += 10;
-        setProgress(prog);
-        if (prog >= 100) {
-          clearInterval(interval);
-          setTimeout(() => {
-            navigate("/chat", {
-              state: {
-                fileName: file.name,
-                fileUrl: URL.createObjectURL(file),
-              },
-            });
-          }, 500);
-        }
-      }, 100);
+      // indexing runs in the background; the document can be queried once its job is done
+      const { status_url: statusUrl } = await response.json();
+      const job = await waitForJob(statusUrl);
+      setProgress(100);
+      navigate("/chat", {
+        state: {
+          fileName: file.name,
+          fileUrl: URL.createObjectURL(file),
+          suggestedQuestions: job.suggested_questions || [],
+        },
+      });
     } catch (err) {
-      alert("Something went wrong while uploading the file.");
+      alert(`Something went wrong while processing the file. ${err.message}`);
       setUploading(false);
     }
   };
 
+  const waitForJob = async (statusUrl) => {
+    const deadline = Date.now() + POLL_TIMEOUT_MS;
+    while (Date.now() < deadline) {
+      const response = await fetch(`${API_BASE}${statusUrl}`);
+      if (!response.ok) throw new Error("Could not check the processing status.");
+      const job = await response.json();
+      if (job.status === "done") return job;
+      if (job.status === "failed") throw new Error(job.error || "Processing failed.");
+      setProgress(jobProgress(job));
+      await sleep(POLL_INTERVAL_MS);
+    }
+    throw new Error("Processing is taking too long.");
+  };
+
   return (
     <div className="main-content">
       <Navbar hideLinks={["Home", "Upload"]} />
@@ -94,7 +129,7 @@ export default function UploadPage() {
                 style={{ width: `${progress}%` }}
               ></div>
             </div>
-            <p className="progress-text">{progress}% uploaded</p>
+            <p className="progress-text">{progress}% processed</p>
           </div>
         )}
       </div>